@@ -0,0 +1,194 @@
+#!/usr/bin/env python3
+"""Benchmark the core operations of `MetricsCollection` at growing scale
+
+Measures `addMetric`, `__str__`, `load`, `mergeMetrics` and `renameMetrics` on
+generated series. The generator is seeded, so every run works on the same data:
+series are spread over a few metrics with labels of low (`job`, `code`), medium
+(`instance`) and high (`path`) cardinality. Results are printed as JSON.
+
+Absolute timings depend on the machine, so a fixed pure Python workload is timed as
+calibration first and every operation is also reported relative to it. With `--check`,
+these relative costs per series are compared with the thresholds of a JSON file like
+`metrics_thresholds.json` – the exit code is `1` if any operation is slower, so
+regressions show up in the pre-commit hooks run by the CI.
+"""
+import argparse
+import json
+import logging
+import random
+import sys
+import time
+
+from macwinnie_pyhelpers.Metrics import MetricsCollection
+
+families = ["bench_requests_total", "bench_errors_total", "bench_latency_seconds"]
+
+
+def generate(series, seed=0):
+    """generate reproducible series
+
+    Args:
+        series (int): number of series
+        seed (int): seed of the generator (default: `0`)
+
+    Returns:
+        list: tuples of metric name, labels and value
+    """
+    rng = random.Random(seed)
+    instances = max(1, series // 100)
+    generated = []
+    for i in range(series):
+        labels = {
+            "job": f"job-{rng.randrange(10)}",
+            "instance": f"10.0.{rng.randrange(instances) // 256}.{rng.randrange(256)}:9100",
+            "code": str(rng.choice((200, 201, 404, 500, 503))),
+            # unique per series, so collisions of the other labels do not matter
+            "path": f"/api/v{rng.randrange(3)}/items/{i}",
+        }
+        generated.append((families[i % len(families)], labels, rng.randrange(10**6)))
+    return generated
+
+
+def populate(generated):
+    """build a collection from generated series
+
+    Args:
+        generated (list): series from `generate`
+
+    Returns:
+        MetricsCollection: the collection
+    """
+    mc = MetricsCollection()
+    for name in families:
+        mc.ensureMetric(name, helpText=f"benchmark metric {name}", metricType="counter")
+    for name, labels, value in generated:
+        mc.addMetric(name, value, labels)
+    return mc
+
+
+def measure(function):
+    """measure a function
+
+    Args:
+        function (callable): function to call
+
+    Returns:
+        float: seconds the call took
+    """
+    start = time.perf_counter()
+    function()
+    return time.perf_counter() - start
+
+
+def calibrate(rounds=100000):
+    """time a fixed pure Python workload similar to handling series
+
+    Args:
+        rounds (int): number of rounds of the workload (default: `100000`)
+
+    Returns:
+        float: microseconds per round, best of three runs
+    """
+
+    def workload():
+        index = {}
+        for i in range(rounds):
+            labels = {"job": f"job-{i % 10}", "path": f"/items/{i}"}
+            index[tuple(sorted(labels.items()))] = f"{i * 0.5}"
+
+    return min(measure(workload) for _ in range(3)) / rounds * 1e6
+
+
+def run(series, seed=0):
+    """run all benchmarks for one number of series
+
+    Args:
+        series (int): number of series
+        seed (int): seed of the generator (default: `0`)
+
+    Returns:
+        dict: seconds per operation
+    """
+    generated = generate(series, seed)
+    results = {"addMetric": measure(lambda: populate(generated))}
+    mc = populate(generated)
+    rendered = []
+    results["__str__"] = measure(lambda: rendered.append(str(mc)))
+    results["load"] = measure(lambda: MetricsCollection().load(rendered[0]))
+    results["mergeMetrics"] = measure(
+        lambda: mc.mergeMetrics("bench_requests_total", "bench_errors_total")
+    )
+    results["renameMetrics"] = measure(
+        lambda: mc.renameMetrics("bench_requests_total", "bench_handled_total")
+    )
+    return results
+
+
+def check(results, thresholds):
+    """compare results with thresholds
+
+    Args:
+        results (list): results of the benchmark
+        thresholds (dict): maximum costs per series relative to the calibration by
+                           operation
+
+    Returns:
+        list: descriptions of exceeded thresholds
+    """
+    exceeded = []
+    for result in results:
+        limit = thresholds.get(result["operation"])
+        if limit is not None and result["relative"] > limit:
+            exceeded.append(
+                f"{result['operation']} at {result['series']} series: "
+                f"{result['relative']} calibration rounds per series exceed {limit}"
+            )
+    return exceeded
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument(
+        "--series", type=int, nargs="+", default=[1000, 100000, 1000000]
+    )
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument(
+        "--check", metavar="THRESHOLDS", help="JSON file with thresholds to check"
+    )
+    args = parser.parse_args()
+    # e.g. merging logs on info level per instance
+    logging.disable(logging.WARNING)
+
+    calibration = calibrate()
+    results = []
+    for series in args.series:
+        for operation, seconds in run(series, args.seed).items():
+            perSeries = seconds / series * 1e6
+            results.append(
+                {
+                    "operation": operation,
+                    "series": series,
+                    "seconds": round(seconds, 4),
+                    "us_per_series": round(perSeries, 3),
+                    "relative": round(perSeries / calibration, 3),
+                }
+            )
+    report = {
+        "python": sys.version,
+        "seed": args.seed,
+        "calibration_us": round(calibration, 4),
+        "results": results,
+    }
+    exceeded = []
+    if args.check:
+        with open(args.check) as f:
+            exceeded = check(results, json.load(f))
+        report["exceeded"] = exceeded
+    json.dump(report, sys.stdout, indent=2)
+    print()
+    if exceeded:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
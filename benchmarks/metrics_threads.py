@@ -0,0 +1,105 @@
+#!/usr/bin/env python3
+"""Benchmark concurrent updates of a thread safe `MetricsCollection`
+
+Compares writers updating their own metric, so each one takes a different
+per-metric lock, with writers all updating the same metric, which serialises
+them on one lock like a single global lock would. Both `incMetric` and
+`addMetric` are measured, the latter only takes the lock of the collection to
+create a metric. Results are printed as JSON.
+
+Keep in mind that on interpreters with a global interpreter lock, pure Python
+updates cannot run in parallel – the per-metric locks only avoid additional
+contention on top of it.
+"""
+import argparse
+import json
+import sys
+import threading
+import time
+
+from macwinnie_pyhelpers.Metrics import MetricsCollection
+
+
+def run(threads, updates, sharedMetric, operation="incMetric"):
+    """run one benchmark round
+
+    Args:
+        threads (int): number of writer threads
+        updates (int): updates per thread
+        sharedMetric (bool): all threads update the same metric
+        operation (str): `incMetric` or `addMetric` (default: `"incMetric"`)
+
+    Returns:
+        float: updates per second
+    """
+    mc = MetricsCollection(threadSafe=True)
+    names = [
+        "bench_updates_total" if sharedMetric else f"bench_updates_{i}_total"
+        for i in range(threads)
+    ]
+    for name in set(names):
+        mc.ensureMetric(name, metricType="counter")
+    barrier = threading.Barrier(threads + 1)
+
+    def writer(name, idx):
+        labels = {"writer": str(idx)}
+        barrier.wait()
+        if operation == "addMetric":
+            for value in range(updates):
+                mc.addMetric(name, value, labels)
+        else:
+            for _ in range(updates):
+                mc.incMetric(name, 1, labels)
+
+    workers = [
+        threading.Thread(target=writer, args=(name, i)) for i, name in enumerate(names)
+    ]
+    for w in workers:
+        w.start()
+    barrier.wait()
+    start = time.perf_counter()
+    for w in workers:
+        w.join()
+    return threads * updates / (time.perf_counter() - start)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--threads", type=int, nargs="+", default=[1, 2, 4, 8])
+    parser.add_argument("--updates", type=int, default=50000)
+    parser.add_argument(
+        "--operations",
+        nargs="+",
+        choices=["incMetric", "addMetric"],
+        default=["incMetric", "addMetric"],
+    )
+    args = parser.parse_args()
+
+    results = []
+    for operation in args.operations:
+        for threads in args.threads:
+            for shared in (False, True):
+                results.append(
+                    {
+                        "operation": operation,
+                        "threads": threads,
+                        "locking": "single lock" if shared else "per metric",
+                        "updates_per_second": round(
+                            run(threads, args.updates, shared, operation)
+                        ),
+                    }
+                )
+    json.dump(
+        {
+            "python": sys.version,
+            "gil": getattr(sys, "_is_gil_enabled", lambda: True)(),
+            "results": results,
+        },
+        sys.stdout,
+        indent=2,
+    )
+    print()
+
+
+if __name__ == "__main__":
+    main()
@@ -1,14 +1,57 @@
 #!/usr/bin/env python3
+import asyncio
 import copy
+import fnmatch
+import functools
+import hashlib
+import heapq
+import inspect
+import itertools
+import json
 import logging
+import math
 import os
 import re
+import struct
+import tempfile
+import threading
+import time
+import zlib
+from array import array
+from bisect import bisect_left
+from collections import deque
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor
+from concurrent.futures import TimeoutError
+from contextlib import contextmanager
+from contextlib import ExitStack
+from contextlib import nullcontext
+from urllib.parse import urljoin
+from urllib.parse import urlsplit
 
 from jinja2 import Environment
 from jinja2 import FileSystemLoader
 
 logger = logging.getLogger(__name__)
 
+Sample = namedtuple("Sample", ["name", "labels", "value"])
+"""derived sample only existing for rendering, e.g. rolling window statistics"""
+
+validationFailures = {"metric_name": 0, "label_name": 0, "metric_type": 0}
+"""number of names and types not matching the Prometheus specifications, by kind"""
+
+_validationLock = threading.Lock()
+
+
+def _countValidationFailure(kind):
+    """count a name or type not matching the Prometheus specifications
+
+    Args:
+        kind (str): key of `validationFailures`
+    """
+    with _validationLock:
+        validationFailures[kind] += 1
+
 
 class MetricsCollection:
     """Prometheus like metrics collection
@@ -31,21 +74,33 @@ class MetricsCollection:
             """
 
             labelRegEx = "[a-zA-Z_][a-zA-Z0-9_]*"
+            _labelPattern = re.compile(labelRegEx)
+            # label names already validated, there are only a few per collection
+            _validLabels = set()
 
-            def __init__(self, name, value, labels={}):
+            def __init__(self, name, value, labels={}, suffix=""):
                 """initialize the metric instance
 
                 Args:
                     value (mixed): actual value of the metric instance
                     labels (dict): set of labels for the metric instance (default: `{}`)
+                    suffix (str): suffix of the sample name, e.g. `_bucket`, `_sum` or `_count`
+                                  for histograms and summaries (default: `""`)
                 """
+                self.window = None
+                self.suffix = suffix
                 self.setName(name)
                 self.setValue(value)
                 for k in labels:
-                    if not re.match(re.compile(f"^{self.labelRegEx}$"), k):
+                    if k in self._validLabels:
+                        continue
+                    if self._labelPattern.fullmatch(k) is None:
+                        _countValidationFailure("label_name")
                         logger.error(
                             f"Label with name “{k}” does not match the Prometheus specifications. Please adjust!"
                         )
+                    else:
+                        self._validLabels.add(k)
                 self.labels = labels
 
             def __eq__(self, other):
@@ -56,13 +111,21 @@ class MetricsCollection:
                 """
                 return self.same(other) and self.value == other.value
 
+            def seriesKey(self):
+                """hashable key identifying the instance within its metric
+
+                Returns:
+                    tuple: suffix and sorted label items of the instance
+                """
+                return (self.suffix, tuple(sorted(self.labels.items())))
+
             def setName(self, name):
                 """set / change name
 
                 Args:
-                    name (str): name to be set
+                    name (str): name of the metric, the suffix of the instance is appended
                 """
-                self.name = name
+                self.name = name + self.suffix
 
             def setValue(self, value):
                 """set / change value
@@ -71,6 +134,20 @@ class MetricsCollection:
                     value (mixed / number): value to be set for Metric
                 """
                 self.value = value
+                if self.window is not None:
+                    self.window.append(value)
+
+            def setWindow(self, size):
+                """keep the last values of the instance in a rolling window
+
+                Args:
+                    size (int): number of values to keep, `None` to drop the window
+                """
+                self.window = None
+                if size is not None:
+                    self.window = RollingWindow(size)
+                    if self.value is not None:
+                        self.window.append(self.value)
 
             def same(self, other):
                 """check if metric instance equals other metric instance
@@ -93,20 +170,52 @@ class MetricsCollection:
 
         nameRegEx = "[a-zA-Z_:][a-zA-Z0-9_:]*"
 
-        def __init__(self, name, helpText=None, metricType=None):
+        def __init__(self, name, helpText=None, metricType=None, threadSafe=False):
             """initialize Metric by name
 
             Args:
                 name (str): name of metric to be used
                 helpText (str): short description about the metric identified by name
                 metricType (str): type of metric to be used (default: `gauge`)
+                threadSafe (bool): guard changes of instances by a lock of this metric and
+                                   render from snapshots (default: `False`)
             """
-            self.instances = []
+            self.threadSafe = threadSafe
+            self.lock = threading.RLock() if threadSafe else nullcontext()
+            self.generation = 0
+            self._instances = []
+            self._index = {}
+            self._postings = None
+            self._seriesVersion = 0
+            self._partitions = {}
+            self.seriesCreated = 0
+            self.seriesRemoved = 0
+            self.churn = None
             self.comments = []
+            self.windowSize = None
+            self.windowStatistics = RollingWindow.statistics
+            self.observations = {}
+            self.meters = {}
+            self.buckets = None
             self.setType(metricType)
             self.setName(name)
             self.setHelp(helpText)
 
+        @property
+        def instances(self):
+            """instances of the metric in order of creation
+
+            The list is cached until instances are added or removed and must not be
+            changed – use `addMetric` and `removeMetric` instead.
+
+            Returns:
+                list: instances of the metric
+            """
+            instances = self._instances
+            if instances is None:
+                instances = self._instances = list(self._index.values())
+            return instances
+
         def __getitem__(self, index):
             """iterate through instances
 
@@ -124,7 +233,7 @@ class MetricsCollection:
             Returns:
                 int: count of instances in this Metric
             """
-            return len(self.instances)
+            return len(self._index)
 
         def setName(self, name):
             """change name
@@ -134,6 +243,7 @@ class MetricsCollection:
             """
             name = name.strip()
             if not re.match(re.compile(f"^{self.nameRegEx}$"), name):
+                _countValidationFailure("metric_name")
                 logger.error(
                     f"“{name}” does not match the Prometheus specifications. Please adjust!"
                 )
@@ -148,6 +258,8 @@ class MetricsCollection:
             self.name = name
             for i in self.instances:
                 i.setName(name)
+            self._partitions = {}
+            self.generation += 1
 
         def setHelp(self, helpText):
             """change help information about metric
@@ -158,6 +270,7 @@ class MetricsCollection:
             if type(helpText) == str:
                 helpText = helpText.strip()
             self.helpText = helpText
+            self.generation += 1
 
         def setType(self, metricType):
             """change metric type
@@ -168,10 +281,12 @@ class MetricsCollection:
             if type(metricType) == str:
                 metricType = metricType.strip()
             if metricType not in self.validMetricTypes:
+                _countValidationFailure("metric_type")
                 logger.error(
                     f"“{metricType}” is not a valid type, which are defined by {self.validMetricTypes}"
                 )
             self.type = metricType
+            self.generation += 1
 
         def addComment(self, comment):
             """add additional comments to metrics
@@ -181,6 +296,7 @@ class MetricsCollection:
             """
             if comment not in self.comments:
                 self.comments.append(comment)
+                self.generation += 1
 
         def getComments(self):
             """return comments
@@ -199,9 +315,10 @@ class MetricsCollection:
             Returns:
                 str: popped comment
             """
+            self.generation += 1
             return self.comments.pop(commentIndex)
 
-        def addMetric(self, value, labels={}):
+        def addMetric(self, value, labels={}, suffix=""):
             """add a metric instance
 
             Only a single metric with the same label set can be contained, so
@@ -210,38 +327,576 @@ class MetricsCollection:
             Args:
                 value (mixed): value of metric instance
                 labels (mixed): labels that will identify instance
+                suffix (str): suffix of the sample name (default: `""`)
+
+            Returns:
+                MetricInstance: the added or updated instance
             """
-            m = self.MetricInstance(self.name, value, labels)
-            valueChanged = False
-            for i, e in enumerate(self.instances):
-                if e.same(m):
-                    logger.debug(
-                        f"Update value of a `{self.name}` metric from `{e.value}` to `{value}`."
+            with self.lock:
+                return self._addInstance(value, labels, suffix)
+
+        def addMetrics(self, samples):
+            """add many metric instances at once
+
+            The lock of the metric is taken once for all instances.
+
+            Args:
+                samples (iterable): tuples of value, labels and suffix
+
+            Returns:
+                list: the added or updated instances
+            """
+            with self.lock:
+                return [
+                    self._addInstance(value, labels, suffix)
+                    for value, labels, suffix in samples
+                ]
+
+        def _addInstance(self, value, labels, suffix):
+            """add a metric instance, the lock of the metric has to be held
+
+            Args:
+                value (mixed): value of metric instance
+                labels (mixed): labels that will identify instance
+                suffix (str): suffix of the sample name
+
+            Returns:
+                MetricInstance: the added or updated instance
+            """
+            m = self.MetricInstance(self.name, value, labels, suffix)
+            key = m.seriesKey()
+            e = self._index.get(key)
+            if e is not None:
+                logger.debug(
+                    f"Update value of a `{self.name}` metric from `{e.value}` to `{value}`."
+                )
+                e.setValue(value)
+                m = e
+            else:
+                if self.windowSize is not None:
+                    m.setWindow(self.windowSize)
+                self._index[key] = m
+                if self._postings is not None:
+                    self._indexSeries(key)
+                self._instances = None
+                self._seriesVersion += 1
+                self.seriesCreated += 1
+                if self.churn is not None:
+                    self.churn.record(self.name, key[1])
+            self.generation += 1
+            return m
+
+        def removeMetric(self, labels={}, suffix=""):
+            """remove a metric instance
+
+            Args:
+                labels (dict): labels that identify the instance (default: `{}`)
+                suffix (str): suffix of the sample name (default: `""`)
+
+            Returns:
+                MetricInstance: the removed instance, `None` if it did not exist
+            """
+            key = (suffix, tuple(sorted(labels.items())))
+            with self.lock:
+                removed = self._index.pop(key, None)
+                if removed is not None:
+                    if self._postings is not None:
+                        self._unindexSeries(key)
+                    self._instances = None
+                    self._seriesVersion += 1
+                    self.seriesRemoved += 1
+                    if self.churn is not None:
+                        self.churn.record(self.name, key[1])
+                    if self.meters and "window" in labels:
+                        meterKey = tuple((k, v) for k, v in key[1] if k != "window")
+                        meter = self.meters.get(meterKey)
+                        if meter is not None and removed in meter.instances:
+                            del self.meters[meterKey]
+                    self.generation += 1
+            return removed
+
+        def getInstance(self, labels={}, suffix=""):
+            """get a metric instance
+
+            Args:
+                labels (dict): labels that identify the instance (default: `{}`)
+                suffix (str): suffix of the sample name (default: `""`)
+
+            Returns:
+                MetricInstance: the instance, `None` if it does not exist
+            """
+            return self._index.get((suffix, tuple(sorted(labels.items()))))
+
+        def incMetric(self, amount=1, labels={}, suffix=""):
+            """increase the value of a metric instance
+
+            In thread safe mode, reading and writing the value is atomic. Missing
+            instances are created with `amount` as value.
+
+            Args:
+                amount (number): amount to add to the value (default: `1`)
+                labels (dict): labels that identify the instance (default: `{}`)
+                suffix (str): suffix of the sample name (default: `""`)
+
+            Returns:
+                MetricInstance: the increased instance
+            """
+            key = (suffix, tuple(sorted(labels.items())))
+            with self.lock:
+                e = self._index.get(key)
+                if e is None:
+                    return self.addMetric(amount, labels, suffix)
+                value = e.value
+                if type(value) is str:
+                    value = MetricsCollection.parseValue(value)
+                e.setValue(value + amount)
+                self.generation += 1
+            return e
+
+        def observe(self, labels={}, buckets=None):
+            """get the observations of a histogram or summary series
+
+            The instances of the series (`_bucket`, `_sum` and `_count`) are created
+            once, so observing values afterwards only touches the returned object.
+
+            Args:
+                labels (dict): labels of the series (default: `{}`)
+                buckets (list): upper bounds of histogram buckets, only used for the first
+                                series of a metric (default: `None`, so `Observations.defaultBuckets`)
+
+            Returns:
+                Observations: observations of the series, `None` if the metric is
+                              neither a histogram nor a summary
+            """
+            key = tuple(sorted(labels.items()))
+            observations = self.observations.get(key)
+            if observations is not None:
+                return observations
+            with self.lock:
+                observations = self.observations.get(key)
+                if observations is not None:
+                    return observations
+                if self.type not in ("histogram", "summary"):
+                    logger.error(
+                        f"Observations are only supported for “histogram” and “summary” metrics, but “{self.name}” is “{self.type}”."
                     )
-                    e.setValue(value)
-                    valueChanged = True
-                    break
-            if not valueChanged:
-                self.instances.append(m)
+                    return None
+                if self.type == "histogram":
+                    bounds = (
+                        sorted(float(b) for b in buckets if b != math.inf)
+                        if buckets
+                        else None
+                    )
+                    if self.buckets is None:
+                        self.buckets = bounds or list(Observations.defaultBuckets)
+                    elif bounds is not None and bounds != self.buckets:
+                        logger.warning(
+                            f"Ignoring buckets {bounds} for a new series of “{self.name}”, the histogram uses {self.buckets}."
+                        )
+                observations = Observations(
+                    self, self.buckets if self.type == "histogram" else None
+                )
+                if observations.bounds is not None:
+                    for bound in observations.bounds + [math.inf]:
+                        bucketLabels = dict(labels)
+                        bucketLabels["le"] = MetricsCollection.formatValue(bound)
+                        observations.instances.append(
+                            self.addMetric(0, bucketLabels, "_bucket")
+                        )
+                observations.instances.append(self.addMetric(0, labels, "_sum"))
+                observations.instances.append(self.addMetric(0, labels, "_count"))
+                self.observations[key] = observations
+            return observations
+
+        def meter(self, labels={}):
+            """get the meter of a series
+
+            The instances of the rates (labeled by `window`) are created once, so
+            marking events afterwards only touches the returned object. Removing one
+            of them detaches the meter, the next call creates a new one.
+
+            Args:
+                labels (dict): labels of the series, without `window` (default: `{}`)
+
+            Returns:
+                Meter: meter of the series, `None` if the metric is no gauge or the
+                       labels contain `window`
+            """
+            key = tuple(sorted(labels.items()))
+            meter = self.meters.get(key)
+            if meter is not None:
+                return meter
+            if self.type != "gauge":
+                logger.error(
+                    f"Meters are only supported for “gauge” metrics, but “{self.name}” is “{self.type}”."
+                )
+                return None
+            if "window" in labels:
+                logger.error(
+                    f"The label “window” is reserved for the rates of meters of “{self.name}”."
+                )
+                return None
+            with self.lock:
+                meter = self.meters.get(key)
+                if meter is not None:
+                    return meter
+                meter = Meter(self)
+                for window, _ in Meter.windows:
+                    rateLabels = dict(labels)
+                    rateLabels["window"] = window
+                    meter.instances.append(self.addMetric(0, rateLabels))
+                self.meters[key] = meter
+            return meter
+
+        def syncObservations(self):
+            """write pending observations and meter rates into the instances of the metric"""
+            for observations in self.observations.values():
+                observations.sync()
+            for meter in self.meters.values():
+                meter.sync()
+
+        def observed(self):
+            """number of values observed by all series of the metric
+
+            Observing does not touch the generation of the metric, so this count is
+            part of the version of the collection instead.
+
+            Returns:
+                int: number of observed values
+            """
+            return sum(o.count for o in list(self.observations.values()))
+
+        def partition(self, shards):
+            """distribute the instances onto shards
+
+            Each instance is assigned by a jump consistent hash of the metric name and
+            its labels, so the assignment of an instance does not depend on other
+            instances. The `le` and `quantile` labels of histograms and summaries are
+            ignored, so all samples of one such series end up in the same shard. The
+            partition is cached until instances are added or removed or the metric is
+            renamed.
+
+            Args:
+                shards (int): number of shards
+
+            Returns:
+                list: one list of instances per shard
+            """
+            cached = self._partitions.get(shards)
+            if cached is not None and cached[0] == self._seriesVersion:
+                return cached[1]
+            partition = [[] for _ in range(shards)]
+            for i in self.instances:
+                labels = i.labels
+                if "le" in labels or "quantile" in labels:
+                    labels = {
+                        k: v for k, v in labels.items() if k not in ("le", "quantile")
+                    }
+                key = MetricsCollection.seriesHash(self.name, labels)
+                partition[MetricsCollection.jumpHash(key, shards)].append(i)
+            self._partitions[shards] = (self._seriesVersion, partition)
+            return partition
+
+        def setWindow(self, size, statistics=None):
+            """keep rolling windows of the last values of all instances
+
+            Each statistic of the windows is rendered as additional gauge metric
+            named `<name>_window_<statistic>` – or `<name><suffix>_window_<statistic>`
+            for suffixed samples like the buckets of histograms.
+
+            Args:
+                size (int): number of values per window, `None` to drop the windows
+                statistics (list): statistics to render out of `RollingWindow.statistics`
+                                   (default: `None`, so all of them)
+            """
+            self.windowSize = size
+            self.generation += 1
+            if statistics is None:
+                statistics = RollingWindow.statistics
+            for statistic in statistics:
+                if statistic not in RollingWindow.statistics:
+                    logger.error(
+                        f"“{statistic}” is not a valid window statistic, which are defined by {RollingWindow.statistics}"
+                    )
+            self.windowStatistics = [
+                s for s in statistics if s in RollingWindow.statistics
+            ]
+            for i in self.instances:
+                i.setWindow(size)
+
+        def windowRepresentation(self, instances=None):
+            """get directory representation of the rolling window statistics
+
+            Args:
+                instances (list): instances to derive statistics for (default: `None`, so all)
+
+            Returns:
+                dict: representation of window statistic metrics
+            """
+            derived = {}
+            if self.windowSize is None:
+                return derived
+            if instances is None:
+                instances = self.instances
+            suffixes = list(dict.fromkeys(i.suffix for i in instances)) or [""]
+            for suffix in suffixes:
+                for statistic in self.windowStatistics:
+                    name = f"{self.name}{suffix}_window_{statistic}"
+                    windowInstances = []
+                    for i in instances:
+                        if (
+                            i.suffix == suffix
+                            and i.window is not None
+                            and len(i.window) > 0
+                        ):
+                            value = getattr(i.window, statistic)()
+                            windowInstances.append(Sample(name, i.labels, value))
+                    derived[name] = {
+                        "type": "gauge",
+                        "help": f"Rolling {statistic} over the last {self.windowSize} values of {self.name}{suffix}",
+                        "instances": windowInstances,
+                        "comments": [],
+                    }
+            return derived
+
+        def matchingInstances(self, labelMatchers):
+            """instances matching a set of label matchers
+
+            Args:
+                labelMatchers (dict): label names mapped to the required value – either a
+                                      string for equality or a compiled regular expression
+                                      that has to match the whole value. Missing labels
+                                      are treated like empty values.
+
+            Returns:
+                list: matching instances
+            """
+            return self.selectInstances(
+                [
+                    (label, "=~" if isinstance(expected, re.Pattern) else "=", expected)
+                    for label, expected in labelMatchers.items()
+                ]
+            )
+
+        def postings(self):
+            """inverted index of the instances
+
+            The index is built on first use and kept up to date by `addMetric` and
+            `removeMetric` afterwards. Empty label values are not indexed, since they
+            are equal to missing labels.
+
+            Returns:
+                dict: label names mapped to label values mapped to sets of series keys
+            """
+            with self.lock:
+                if self._postings is None:
+                    self._postings = {}
+                    self._positions = {}
+                    self._nextPosition = 0
+                    for key in self._index:
+                        self._indexSeries(key)
+                return self._postings
+
+        def _indexSeries(self, key):
+            """add a series to the inverted index
+
+            Args:
+                key (tuple): series key of the instance
+            """
+            for label, value in key[1]:
+                if value != "":
+                    self._postings.setdefault(label, {}).setdefault(value, set()).add(
+                        key
+                    )
+            self._positions[key] = self._nextPosition
+            self._nextPosition += 1
+
+        def _unindexSeries(self, key):
+            """remove a series from the inverted index
 
-        def representation(self):
+            Args:
+                key (tuple): series key of the instance
+            """
+            for label, value in key[1]:
+                if value != "":
+                    values = self._postings[label]
+                    keys = values[value]
+                    keys.discard(key)
+                    if not keys:
+                        del values[value]
+                        if not values:
+                            del self._postings[label]
+            del self._positions[key]
+
+        def selectInstances(self, matchers, suffix=None):
+            """instances matching PromQL-like label matchers
+
+            Positive matchers are resolved to posting lists which get intersected starting
+            with the smallest one, regular expressions are only run against the distinct
+            values of a label. Matchers that also match missing labels, like `!=` or
+            `=~".*"`, are resolved to the series they exclude instead.
+
+            Args:
+                matchers (list): tuples of label name, operator (`=`, `!=`, `=~` or `!~`)
+                                 and value – a string or a compiled regular expression for
+                                 `=~` and `!~`, which has to match the whole value
+                suffix (str): only select instances with this sample name suffix
+                              (default: `None`, so all)
+
+            Returns:
+                list: matching instances in order of creation, with pending observations
+                      written into them
+
+            Raises:
+                ValueError: on unknown operators
+            """
+            with self.lock:
+                self.syncObservations()
+                postings = self.postings()
+                include = []
+                exclude = []
+                for label, op, expected in matchers:
+                    values = postings.get(label, {})
+                    if op in ("=~", "!~"):
+                        pattern = expected
+                        if not isinstance(pattern, re.Pattern):
+                            pattern = re.compile(pattern)
+                        negate = op == "!~"
+                        if (pattern.fullmatch("") is None) == negate:
+                            # matches missing labels, so collect the series to drop
+                            exclude.extend(
+                                keys
+                                for value, keys in values.items()
+                                if (pattern.fullmatch(str(value)) is None) != negate
+                            )
+                        else:
+                            include.append(
+                                [
+                                    keys
+                                    for value, keys in values.items()
+                                    if (pattern.fullmatch(str(value)) is None) == negate
+                                ]
+                            )
+                    elif op in ("=", "!="):
+                        if expected == "" and op == "=":
+                            exclude.extend(values.values())
+                        elif expected == "":
+                            include.append(list(values.values()))
+                        elif op == "=":
+                            include.append(
+                                [values[expected]] if expected in values else []
+                            )
+                        elif expected in values:
+                            exclude.append(values[expected])
+                    else:
+                        raise ValueError(f"Unknown label matcher operator “{op}”!")
+
+                if include:
+                    include.sort(key=lambda sets: sum(len(keys) for keys in sets))
+                    selected = set().union(*include[0])
+                    for sets in include[1:]:
+                        selected = {
+                            k for k in selected if any(k in keys for keys in sets)
+                        }
+                else:
+                    selected = self._positions.keys()
+                if exclude:
+                    selected = {
+                        k for k in selected if not any(k in keys for keys in exclude)
+                    }
+                if suffix is not None:
+                    selected = [k for k in selected if k[0] == suffix]
+                return [
+                    self._index[k]
+                    for k in sorted(selected, key=self._positions.__getitem__)
+                ]
+
+        def representation(self, instances=None):
             """get directory representation for further work with metrics
 
+            Args:
+                instances (list): instances to represent (default: `None`, so all)
+
             Returns:
                 dict: representation of metrics
             """
-            return {
+            with self.lock:
+                self.syncObservations()
+                if instances is None:
+                    instances = self.instances
+                derived = self.windowRepresentation(instances)
+                if self.threadSafe:
+                    # snapshot, so writers can go on while rendering
+                    instances = [Sample(i.name, i.labels, i.value) for i in instances]
+                    comments = list(self.comments)
+                else:
+                    comments = self.comments
+            representation = {
                 self.name: {
                     "type": self.type or "",
                     "help": self.helpText or "",
-                    "instances": self.instances,
-                    "comments": self.comments,
+                    "instances": instances,
+                    "comments": comments,
                 }
             }
+            representation.update(derived)
+            return representation
 
-    def __init__(self):
-        """create set of metrics"""
+    valueRegEx = r"(?:[+-]?(?:\d+(?:\.\d+)?(?:[eE][+-]?\d+)?|Inf)|NaN)"
+    selectorRegEx = r"([a-zA-Z_:][a-zA-Z0-9_:]*)?\s*(?:\{(.*)\})?"
+    matcherRegEx = (
+        r'\s*([a-zA-Z_][a-zA-Z0-9_]*)\s*(=~|!~|!=|=)\s*"((?:[^"\\]|\\.)*)"\s*(?:,\s*|$)'
+    )
+    maxExactInteger = 2**53
+    specialValues = {
+        "NaN": math.nan,
+        "+Inf": math.inf,
+        "Inf": math.inf,
+        "-Inf": -math.inf,
+    }
+    sampleSuffixes = {
+        "_bucket": ("histogram",),
+        "_sum": ("histogram", "summary"),
+        "_count": ("histogram", "summary"),
+    }
+    _template = None
+    frameColumns = ("__name__", "__suffix__", "__type__", "__help__", "__value__")
+
+    def __init__(self, typedValues=False, threadSafe=False):
+        """create set of metrics
+
+        Args:
+            typedValues (bool): if `True`, values loaded from metrics strings are parsed once
+                                into `int` (if integral) or `float` instead of being kept as
+                                the raw string (default: `False`)
+            threadSafe (bool): if `True`, metrics can be updated and rendered from multiple
+                               threads – each metric is guarded by its own lock, so writers
+                               of different metrics do not block each other. Rendering
+                               copies all metrics into one consistent snapshot while holding
+                               the collection lock and the locks of all metrics
+                               (default: `False`)
+        """
         self.metrics = {}
+        self.typedValues = typedValues
+        self.threadSafe = threadSafe
+        self._lock = threading.RLock() if threadSafe else nullcontext()
+        self.collectors = {}
+        self.collectorWorkers = 8
+        self._collectorExecutor = None
+        self._collectorGeneration = 0
+        self._collectLock = threading.Lock()
+        self._textfileHashes = {}
+        self._gzipCache = None
+        self.wal = None
+        self.recordingRules = {}
+        self._ruleOrder = []
+        self._dependents = {}
+        self._rulesLock = threading.RLock() if threadSafe else nullcontext()
+        self.instrumentation = None
+        self.churn = None
+        self._nameIndex = None
+        self._generation = 0
+        self._shardCache = {}
 
     def ensureMetric(self, metricName, helpText=None, metricType=None):
         """ensure metric existing also if no instances are present
@@ -252,16 +907,30 @@ class MetricsCollection:
             metricType (str): type of metric to be used – see https://prometheus.io/docs/concepts/metric_types/
                               (default: None, will default to `gauge` on creation)
         """
-        if metricName not in self.metrics:
-            self.metrics[metricName] = self.Metric(
-                name=metricName, helpText=helpText, metricType=metricType
-            )
-            logger.debug(f"Created metric “{metricName}” with no instances for now.")
-        else:
-            logger.debug(f"Metric “{metricName}” already exists.")
+        with self._lock:
+            if metricName not in self.metrics:
+                self.metrics[metricName] = self.Metric(
+                    name=metricName,
+                    helpText=helpText,
+                    metricType=metricType,
+                    threadSafe=self.threadSafe,
+                )
+                self.metrics[metricName].churn = self.churn
+                self._familiesChanged()
+                logger.debug(
+                    f"Created metric “{metricName}” with no instances for now."
+                )
+            else:
+                logger.debug(f"Metric “{metricName}” already exists.")
 
     def addMetric(
-        self, metricName, value=None, labels={}, helpText=None, metricType=None
+        self,
+        metricName,
+        value=None,
+        labels={},
+        helpText=None,
+        metricType=None,
+        suffix="",
     ):
         """add a (new) metric instance
 
@@ -272,389 +941,4488 @@ class MetricsCollection:
             helpText (str): help information for the metric collection of name metricName (default: `None`)
             metricType (str): type of metric to be used – see https://prometheus.io/docs/concepts/metric_types/
                               (default: None, will default to `gauge` on creation)
+            suffix (str): suffix of the sample name, e.g. `_bucket` for histograms (default: `""`)
         """
-        if not metricName in self.metrics:
-            if metricType == None:
-                logger.info(f"No TYPE defined for new created metric “{metricName}”.")
-            if helpText == None:
-                logger.info(
-                    f"No HELP information passed for new metric “{metricName}”."
-                )
-            self.metrics[metricName] = self.Metric(
-                name=metricName, helpText=helpText, metricType=metricType
-            )
-            logger.debug(f"Added new metric “{metricName}”")
-        else:
-            if helpText != None:
-                self.setHelp(metricName, helpText)
-                logger.info(f"Changed help for metric `{metricName}`.")
-            if metricType != None:
-                self.setType(metricName, metricType)
-                logger.warning(f"Changed type for metric `{metricName}`.")
+        metric = self.metrics.get(metricName)
+        if metric is None or self._definitionChanged(metric, helpText, metricType):
+            metric = self._defineMetric(metricName, helpText, metricType)
         if value != None:
-            self.metrics[metricName].addMetric(value, labels)
+            rules = self._dependents.get(metricName)
+            with self._rulesLock if rules else nullcontext():
+                # logged under the lock of the metric, so the log keeps its order
+                with metric.lock:
+                    previous = metric.getInstance(labels, suffix) if rules else None
+                    previous = None if previous is None else previous.value
+                    instance = metric.addMetric(value, labels, suffix)
+                    current = instance.value
+                    if self.wal is not None:
+                        self.wal.append(metric, instance)
+                if rules:
+                    self._propagate(
+                        rules, metricName, labels, suffix, previous, current
+                    )
         else:
             logger.debug(
                 f"Not adding metric instance for “{metricName}” due to missing value!"
             )
 
-    def addComment(self, metricName, comment):
-        """add a comment
-
-        Args:
-            metricName (string): [description]
-            comment (string): comment to add
-        """
-        self.metrics[metricName].addComment(comment)
-
-    def renameMetrics(self, oldName, newName, force=False):
-        """rename metrics
+    def _defineMetric(self, metricName, helpText=None, metricType=None):
+        """create a metric or change its help and type under the lock of the collection
 
         Args:
-            oldName (str): old name to be renamed
-            newName (str): new name to be used
-            force (bool): [description] (default: `False`)
+            metricName (str): name of the metric
+            helpText (str): help information for the metric (default: `None`)
+            metricType (str): type of the metric (default: `None`)
 
         Returns:
-            bool: was the rename successful?
+            MetricsCollection.Metric: the metric
         """
-        if newName in self.metrics:
-            log = f"Metric “{newName}” already exists."
-            if force:
-                logger.info(f"{log} Doing a merge.")
-                oldType = self.metrics[oldName].type
-                oldHelp = self.metrics[oldName].helpText
-                self.mergeMetrics(newName, oldName)
-                if self.metrics[newName].type != oldType:
+        with self._lock:
+            if not metricName in self.metrics:
+                if metricType == None:
                     logger.info(
-                        f"Changing metric type for “{newName}” back to “{oldType}”"
+                        f"No TYPE defined for new created metric “{metricName}”."
                     )
-                    self.metrics[newName].setType(oldType)
-                if self.metrics[newName].helpText != oldHelp:
+                if helpText == None:
                     logger.info(
-                        f"Changing metric help for “{newName}” back to “{oldHelp}”"
+                        f"No HELP information passed for new metric “{metricName}”."
                     )
-                    self.metrics[newName].setHelp(oldHelp)
-                return True
+                self.metrics[metricName] = self.Metric(
+                    name=metricName,
+                    helpText=helpText,
+                    metricType=metricType,
+                    threadSafe=self.threadSafe,
+                )
+                self.metrics[metricName].churn = self.churn
+                self._familiesChanged()
+                logger.debug(f"Added new metric “{metricName}”")
+            else:
+                metric = self.metrics[metricName]
+                if self._definitionChanged(metric, helpText=helpText):
+                    self.setHelp(metricName, helpText)
+                    logger.info(f"Changed help for metric `{metricName}`.")
+                if self._definitionChanged(metric, metricType=metricType):
+                    self.setType(metricName, metricType)
+                    logger.warning(f"Changed type for metric `{metricName}`.")
+            return self.metrics[metricName]
 
-            logger.error(f"{log} No force so no change here.")
-            return False
+    @staticmethod
+    def _definitionChanged(metric, helpText=None, metricType=None):
+        """check if a help text or type differs from the one of a metric
 
-        logger.debug(f"Renaming “{oldName}” to “{newName}”.")
-        self.metrics[oldName].setName(newName)
-        self.metrics[newName] = self.metrics[oldName]
-        self.metrics.pop(oldName)
-        return True
+        Args:
+            metric (MetricsCollection.Metric): metric to compare with
+            helpText (str): help text to compare, `None` to ignore it (default: `None`)
+            metricType (str): type to compare, `None` to ignore it (default: `None`)
 
-    def mergeMetrics(self, mainName, mergeName):
-        """merge metrics
+        Returns:
+            bool: `True` if the metric has to be changed
+        """
+        if type(helpText) == str:
+            helpText = helpText.strip()
+        if type(metricType) == str:
+            metricType = metricType.strip()
+        return (helpText != None and helpText != metric.helpText) or (
+            metricType != None and metricType != metric.type
+        )
 
-        `TYPE`, `HELP` and metric name of `mainName` metrics stay valid and
-        `mergeName` metrics will be integrated into `mainName`.
-        Integration will override / update metrics with the same labels by mergeName ones!
+    def incMetric(self, metricName, amount=1, labels={}, suffix=""):
+        """increase the value of a metric instance
+
+        The metric has to exist already, e.g. by `ensureMetric`. In thread safe mode,
+        the increase is atomic.
 
         Args:
-            mainName (str): metrics name to merge `mergeName` into
-            mergeName (str): metrics name to get metrics to merge into `mainName`
+            metricName (str): name of metric to increase an instance of
+            amount (number): amount to add to the value (default: `1`)
+            labels (dict): labels that identify the instance (default: `{}`)
+            suffix (str): suffix of the sample name (default: `""`)
         """
-        if mainName not in self.metrics:
-            logger.warning(
-                f"“{mainName}” metrics do not exist – will rename “{mergeName}” to that name."
-            )
-            self.renameMetrics(mergeName, mainName)
-        else:
-            logger.debug(f"Merging “{mergeName}” metrics into “{mainName}”.")
-            oldHelp = self.metrics[mergeName].helpText
-            if oldHelp != None:
-                logger.info(f"Help “{oldHelp}” for merged metrics will be abandonned.")
-            oldType = self.metrics[mergeName].type
-            newType = self.metrics[mainName].type
-            if oldType != newType:
-                logger.warning(
-                    f"Type “{oldType}” differs from type “{newType}” where last one is type of destination metric."
+        metric = self.metrics[metricName]
+        rules = self._dependents.get(metricName)
+        with self._rulesLock if rules else nullcontext():
+            with metric.lock:
+                previous = metric.getInstance(labels, suffix) if rules else None
+                previous = None if previous is None else previous.value
+                instance = metric.incMetric(amount, labels, suffix)
+                current = instance.value
+                if self.wal is not None:
+                    self.wal.append(metric, instance)
+            if rules:
+                self._propagate(rules, metricName, labels, suffix, previous, current)
+
+    def removeMetric(self, metricName, labels={}, suffix=""):
+        """remove a metric instance
+
+        Args:
+            metricName (str): name of metric to remove an instance from
+            labels (dict): labels that identify the instance (default: `{}`)
+            suffix (str): suffix of the sample name (default: `""`)
+
+        Returns:
+            bool: `True` if an instance was removed
+        """
+        metric = self.metrics.get(metricName)
+        rules = self._dependents.get(metricName)
+        with self._rulesLock if rules else nullcontext():
+            with nullcontext() if metric is None else metric.lock:
+                removed = (
+                    None if metric is None else metric.removeMetric(labels, suffix)
                 )
-            merge = self.metrics.pop(mergeName)
-            for i in merge.instances:
-                self.addMetric(mainName, i.value, i.labels)
+                if removed is not None and self.wal is not None:
+                    self.wal.remove(metric, removed)
+            if removed is None:
+                logger.debug(
+                    f"No instance of “{metricName}” with labels {labels} to remove."
+                )
+                return False
+            if rules:
+                self._propagate(rules, metricName, labels, suffix, removed.value, None)
+        return True
 
-    def setHelp(self, metricName, helpText):
-        """change help for metric
+    def removeMetrics(self, metricName):
+        """remove a metric with all its instances
 
         Args:
-            metricName (str): name of metric to set the help information
-            helpText (str): help information about what the metric is to say
+            metricName (str): name of metric to remove
+
+        Returns:
+            bool: `True` if the metric existed
         """
-        self.ensureMetric(metricName)
-        self.metrics[metricName].setHelp(helpText)
+        with self._lock:
+            metric = self.metrics.pop(metricName, None)
+            if metric is None:
+                logger.debug(f"No metric “{metricName}” to remove.")
+                return False
+            self._familiesChanged()
+        if self.wal is not None:
+            for instance in metric.instances:
+                self.wal.remove(metric, instance)
+        self._evaluateDependents(metricName)
+        return True
 
-    def setType(self, metricName, metricType=None):
-        """change metric type
+    def enableInstrumentation(self, prefix="metrics_collection_"):
+        """expose the costs of the collection as metrics of its own
+
+        Time spent per phase of `load`, duration and size of renderings, hits of the
+        rendering caches, the number of metrics and series and the module wide number
+        of validation failures are rendered next to the metrics of the collection, like
+        results of a collector. Cached renderings keep the values of the time they were
+        rendered.
 
         Args:
-            metricName (str): name of metric to set type for
-            metricType (str): type to be set for metric (default: `"gauge"`)
+            prefix (str): prefix of the metric names (default: `"metrics_collection_"`)
+
+        Returns:
+            MetricsInstrumentation: the instrumentation
         """
-        self.ensureMetric(metricName)
-        self.metrics[metricName].setType(metricType)
+        if self.instrumentation is None or self.instrumentation.prefix != prefix:
+            self.instrumentation = MetricsInstrumentation(prefix)
+        return self.instrumentation
 
-    def prepare(self):
-        """Helper function to transform list of metric objects of class above into usable object
+    def disableInstrumentation(self):
+        """stop exposing the costs of the collection"""
+        self.instrumentation = None
+
+    def _measure(self, phase):
+        """measure a phase of `load` if instrumentation is enabled
+
+        Args:
+            phase (str): name of the phase
 
         Returns:
-            dict: dictionary to be pushed into template of this module to be rendered
+            contextmanager: context measuring the phase
         """
-        finalized = {}
-        for m in self.metrics.values():
-            finalized.update(m.representation())
-        return finalized
+        if self.instrumentation is None:
+            return nullcontext()
+        return self.instrumentation.measure(phase)
 
-    def load(self, metricsString, dismissComments=True):
-        """load (additional) metrics
+    def enableChurnTracking(self, prefix="metrics_collection_", topValues=10):
+        """expose the series created and removed per metric between renderings
 
-        Load data from given metrics string to merge with current collection or to manipulate, ...
-        By default, comments will be dismissed – otherwise they will probably be relocated to the nearest metrics since this
-        module only supports comments connected to metrics not floating around in the final metrics string.
+        Every metric counts the series created and removed in plain integers, the
+        churn since the previous rendering is the difference of those counters – no
+        label sets are compared. While tracking is enabled, the label values of every
+        created or removed series are also counted in a `SpaceSaving` sketch, so the
+        most unstable label values are exposed within bounded memory.
 
         Args:
-            metricsString (str): metrics string to load
-            dismissComments (bool): set `True` if comments (other than `# HELP` and `# TYPE`, which are mandatory) should be dismissed
+            prefix (str): prefix of the metric names (default: `"metrics_collection_"`)
+            topValues (int): number of most churning label values to expose (default: `10`)
+
+        Returns:
+            MetricsChurn: the churn tracking
         """
-        # will work with comment assigning to metrics by distance in file, so first remove all blank lines
-        self._worklist = [l.strip() for l in metricsString.splitlines()]
+        with self._lock:
+            if self.churn is None or self.churn.prefix != prefix:
+                self.churn = MetricsChurn(prefix, topValues)
+                self.churn.snapshot(self.metrics.values())
+            for m in self.metrics.values():
+                m.churn = self.churn
+        return self.churn
+
+    def disableChurnTracking(self):
+        """stop exposing the series churn"""
+        with self._lock:
+            self.churn = None
+            for m in self.metrics.values():
+                m.churn = None
+
+    def addRecordingRule(self, rule):
+        """add a recording rule deriving a metric from other metrics of the collection
+
+        The derived metric is evaluated once right away. Afterwards, changes of input
+        instances by `addMetric`, `incMetric` and `removeMetric` are passed to the
+        rules depending on them, which update only the affected derived instances –
+        derived metrics can be inputs of further rules. Values set directly on metrics
+        or instances and observations of histograms and summaries are not tracked, see
+        `evaluateRecordingRules` for those.
+
+        Args:
+            rule (RecordingRule): rule to add
+
+        Returns:
+            RecordingRule: the added rule
+
+        Raises:
+            ValueError: if a rule for the derived metric exists already or the rule
+                        would make derived metrics depend on themselves
+        """
+        with self._rulesLock:
+            if rule.name in self.recordingRules:
+                raise ValueError(f"Recording rule for “{rule.name}” exists already!")
+            # the rule must not be reachable from its own derived metric
+            pending = [rule.name]
+            reachable = set(pending)
+            while pending:
+                name = pending.pop()
+                if name in rule.inputs:
+                    raise ValueError(
+                        f"Recording rule for “{rule.name}” would depend on itself via “{name}”!"
+                    )
+                for dependent in self._dependents.get(name, ()):
+                    if dependent.name not in reachable:
+                        reachable.add(dependent.name)
+                        pending.append(dependent.name)
+            self.recordingRules[rule.name] = rule
+            for name in rule.inputs:
+                self._dependents.setdefault(name, []).append(rule)
+            self._ruleOrder = self._sortRecordingRules()
+            self.ensureMetric(
+                rule.name, helpText=rule.helpText, metricType=rule.metricType
+            )
+            rule.evaluate(self)
+        return rule
+
+    def removeRecordingRule(self, name):
+        """remove a recording rule together with its derived metric
+
+        Args:
+            name (str): name of the derived metric
+
+        Returns:
+            bool: `True` if the rule existed
+        """
+        with self._rulesLock:
+            rule = self.recordingRules.pop(name, None)
+            if rule is None:
+                logger.debug(f"No recording rule for “{name}” to remove.")
+                return False
+            for inputName in rule.inputs:
+                self._dependents[inputName].remove(rule)
+                if not self._dependents[inputName]:
+                    del self._dependents[inputName]
+            self._ruleOrder = self._sortRecordingRules()
+            self.removeMetrics(name)
+        return True
+
+    def evaluateRecordingRules(self, dirtyOnly=False):
+        """evaluate recording rules completely, inputs before the rules depending on them
+
+        Args:
+            dirtyOnly (bool): only evaluate rules with changed inputs that are not
+                              updated incrementally (default: `False`)
+        """
+        with self._rulesLock:
+            for rule in self._ruleOrder:
+                if rule.dirty or not dirtyOnly:
+                    rule.evaluate(self)
+
+    def _sortRecordingRules(self):
+        """sort the recording rules topologically
+
+        Returns:
+            list: rules, each after the rules deriving its inputs
+        """
+        order = []
+        visited = set()
+
+        def visit(rule):
+            if rule.name in visited:
+                return
+            visited.add(rule.name)
+            for name in rule.inputs:
+                if name in self.recordingRules:
+                    visit(self.recordingRules[name])
+            order.append(rule)
+
+        for rule in self.recordingRules.values():
+            visit(rule)
+        return order
+
+    def _evaluateDependents(self, *metricNames):
+        """evaluate the rules depending on metrics that were replaced as a whole
+
+        Removed, renamed and merged metrics change all their instances at once, so
+        the depending rules are evaluated completely instead of per instance.
+
+        Args:
+            *metricNames (str): names of the replaced metrics
+        """
+        if not any(name in self._dependents for name in metricNames):
+            return
+        with self._rulesLock:
+            rules = [
+                rule for name in metricNames for rule in self._dependents.get(name, ())
+            ]
+            for rule in self._ruleOrder:
+                if rule in rules:
+                    rule.evaluate(self)
+
+    def _propagate(self, rules, metricName, labels, suffix, previous, current):
+        """pass the change of an instance to the rules depending on its metric
+
+        Args:
+            rules (list): rules depending on the metric
+            metricName (str): name of the changed metric
+            labels (dict): labels of the changed instance
+            suffix (str): suffix of the changed instance
+            previous (mixed): value before the change, `None` if the instance was added
+            current (mixed): value after the change, `None` if the instance was removed
+        """
+        previous = RecordingRule.number(previous)
+        current = RecordingRule.number(current)
+        for rule in list(rules):
+            rule.update(self, metricName, labels, suffix, previous, current)
+
+    def enableWal(self, path, **kwargs):
+        """keep the state of the collection in a write-ahead log
+
+        The state stored at `path` is restored into the collection first, afterwards
+        all values set by `addMetric` and `incMetric` and instances removed by
+        `removeMetric` and `removeMetrics` are logged. Renames, merges and changes of
+        `TYPE` or `HELP` compact the log, so they are kept, too. Observations of
+        histograms and summaries and values set directly on metrics or instances are
+        not logged.
+
+        Args:
+            path (str): base path of the log files
+            **kwargs: further arguments for `MetricsWal`
+
+        Returns:
+            MetricsWal: the attached write-ahead log
+        """
+        wal = MetricsWal(path, **kwargs)
+        wal.restore(self)
+        self.wal = wal
+        return wal
+
+    def disableWal(self):
+        """flush and close the write-ahead log"""
+        if self.wal is not None:
+            self.wal.close()
+            self.wal = None
+
+    def _compactWal(self):
+        """compact the write-ahead log after renames, merges and changed definitions
+
+        Names, types and help texts are only logged with the definitions of series,
+        so a fresh snapshot is the only way to keep them across a restart.
+        """
+        if self.wal is not None:
+            self.wal.compact()
+
+    def addComment(self, metricName, comment):
+        """add a comment
+
+        Args:
+            metricName (string): [description]
+            comment (string): comment to add
+        """
+        self.metrics[metricName].addComment(comment)
+
+    def renameMetrics(self, oldName, newName, force=False):
+        """rename metrics
+
+        Args:
+            oldName (str): old name to be renamed
+            newName (str): new name to be used
+            force (bool): [description] (default: `False`)
+
+        Returns:
+            bool: was the rename successful?
+        """
+        with self._rulesLock:
+            with self._lock:
+                renamed = self._renameMetrics(oldName, newName, force)
+            if renamed:
+                self._evaluateDependents(oldName, newName)
+        if renamed:
+            self._compactWal()
+        return renamed
+
+    def _renameMetrics(self, oldName, newName, force=False):
+        """rename metrics while holding the locks of the collection
+
+        Args:
+            oldName (str): old name to be renamed
+            newName (str): new name to be used
+            force (bool): merge into an existing metric of the new name (default: `False`)
+
+        Returns:
+            bool: was the rename successful?
+        """
+        if newName in self.metrics:
+            log = f"Metric “{newName}” already exists."
+            if force:
+                logger.info(f"{log} Doing a merge.")
+                oldType = self.metrics[oldName].type
+                oldHelp = self.metrics[oldName].helpText
+                self._mergeMetrics(newName, oldName)
+                if self.metrics[newName].type != oldType:
+                    logger.info(
+                        f"Changing metric type for “{newName}” back to “{oldType}”"
+                    )
+                    self.metrics[newName].setType(oldType)
+                if self.metrics[newName].helpText != oldHelp:
+                    logger.info(
+                        f"Changing metric help for “{newName}” back to “{oldHelp}”"
+                    )
+                    self.metrics[newName].setHelp(oldHelp)
+                return True
+
+            logger.error(f"{log} No force so no change here.")
+            return False
+
+        logger.debug(f"Renaming “{oldName}” to “{newName}”.")
+        self.metrics[oldName].setName(newName)
+        self.metrics[newName] = self.metrics[oldName]
+        self.metrics.pop(oldName)
+        self._familiesChanged()
+        return True
+
+    def mergeMetrics(self, mainName, mergeName, aggregate=False):
+        """merge metrics
+
+        `TYPE`, `HELP` and metric name of `mainName` metrics stay valid and
+        `mergeName` metrics will be integrated into `mainName`.
+        Integration will override / update metrics with the same labels by mergeName ones –
+        unless `aggregate` is set, see `mergeCollection`.
+
+        Args:
+            mainName (str): metrics name to merge `mergeName` into
+            mergeName (str): metrics name to get metrics to merge into `mainName`
+            aggregate (bool): add up instances with the same labels according to the
+                              type of `mainName` (default: `False`)
+        """
+        with self._rulesLock:
+            with self._lock:
+                self._mergeMetrics(mainName, mergeName, aggregate)
+            self._evaluateDependents(mergeName, mainName)
+        self._compactWal()
+
+    def _mergeMetrics(self, mainName, mergeName, aggregate=False):
+        """merge metrics while holding the locks of the collection
+
+        Args:
+            mainName (str): metrics name to merge `mergeName` into
+            mergeName (str): metrics name to get metrics to merge into `mainName`
+            aggregate (bool): add up instances with the same labels (default: `False`)
+        """
+        if mainName not in self.metrics:
+            logger.warning(
+                f"“{mainName}” metrics do not exist – will rename “{mergeName}” to that name."
+            )
+            self._renameMetrics(mergeName, mainName)
+        else:
+            logger.debug(f"Merging “{mergeName}” metrics into “{mainName}”.")
+            oldHelp = self.metrics[mergeName].helpText
+            if oldHelp != None:
+                logger.info(f"Help “{oldHelp}” for merged metrics will be abandonned.")
+            oldType = self.metrics[mergeName].type
+            newType = self.metrics[mainName].type
+            if oldType != newType:
+                logger.warning(
+                    f"Type “{oldType}” differs from type “{newType}” where last one is type of destination metric."
+                )
+            merge = self.metrics.pop(mergeName)
+            self._familiesChanged()
+            self._mergeInstances(
+                mainName,
+                [(i.labels, i.suffix, i.value) for i in merge.instances],
+                aggregate,
+            )
+
+    def mergeCollection(self, other, extraLabels=None, aggregate=False):
+        """merge all instances of another collection into this one
+
+        Metrics not existing yet are created with `TYPE` and `HELP` of the other
+        collection, existing ones keep theirs. Instances with the same labels get
+        overridden. Labels of the other collection that clash with `extraLabels` are
+        kept as `exported_<label>`, like Prometheus does for target labels.
+
+        With `aggregate`, e.g. to combine the collections of multiple workers, instances
+        with the same labels are added up instead where the type of the metric allows
+        it: counters, all samples of histograms – as long as the workers share their
+        buckets – and `_sum` and `_count` of summaries. Quantiles of summaries cannot be
+        combined, so they are only taken over for series this collection does not have
+        yet and skipped otherwise. Gauges and untyped metrics are still overridden.
+
+        Args:
+            other (MetricsCollection): collection to merge
+            extraLabels (dict): labels to add to every merged instance (default: `None`)
+            aggregate (bool): add up instances with the same labels (default: `False`)
+        """
+        for m in other.families():
+            with m.lock:
+                m.syncObservations()
+                instances = [(i.labels, i.suffix, i.value) for i in m.instances]
+            if m.name not in self.metrics:
+                self.ensureMetric(m.name, helpText=m.helpText, metricType=m.type)
+            if extraLabels:
+                instances = [
+                    (self.exportLabels(labels, extraLabels), suffix, value)
+                    for labels, suffix, value in instances
+                ]
+            self._mergeInstances(m.name, instances, aggregate)
+
+    @staticmethod
+    def exportLabels(labels, extraLabels):
+        """add labels, keeping clashing ones as `exported_<label>`
+
+        Args:
+            labels (dict): labels of an instance
+            extraLabels (dict): labels to add
+
+        Returns:
+            dict: new labels
+        """
+        exported = {
+            (f"exported_{k}" if k in extraLabels else k): v for k, v in labels.items()
+        }
+        exported.update(extraLabels)
+        return exported
+
+    def _mergeInstances(self, metricName, instances, aggregate=False):
+        """merge instances into a metric
+
+        The merged values are summed up per series first and added in bulk with the
+        current values of the metric, under its lock – or the lock of the recording
+        rules, if rules depend on the metric. Quantiles of summaries are only merged
+        into series the metric does not have yet.
+
+        Args:
+            metricName (str): name of the existing metric to merge into
+            instances (list): tuples of labels, suffix and value
+            aggregate (bool): add up values by the type of the metric (default: `False`)
+        """
+        metric = self.metrics[metricName]
+        metricType = metric.type if aggregate else None
+        if metricType in ("counter", "histogram"):
+            additive = ("", "_bucket", "_sum", "_count")
+        elif metricType == "summary":
+            additive = ("_sum", "_count")
+        else:
+            # nothing to add up, later instances just override earlier ones
+            self._addSamples(
+                metricName,
+                [(value, labels, suffix) for labels, suffix, value in instances],
+            )
+            return
+        merged = {}
+        for labels, suffix, value in instances:
+            key = (suffix, tuple(sorted(labels.items())))
+            if suffix in additive:
+                if type(value) is str:
+                    value = MetricsCollection.parseValue(value)
+                if key in merged:
+                    value += merged[key][0]
+            merged[key] = (value, labels, suffix)
+        skipped = 0
+        rules = self._dependents.get(metricName)
+        with self._rulesLock if rules else metric.lock:
+            samples = []
+            for value, labels, suffix in merged.values():
+                current = metric.getInstance(labels, suffix)
+                if current is None:
+                    pass
+                elif suffix in additive:
+                    current = current.value
+                    if type(current) is str:
+                        current = MetricsCollection.parseValue(current)
+                    value += current
+                elif metricType == "summary":
+                    skipped += 1
+                    continue
+                samples.append((value, labels, suffix))
+            self._addSamples(metricName, samples)
+        if skipped:
+            logger.warning(
+                f"Skipped {skipped} quantiles of summary “{metricName}”, they cannot be aggregated."
+            )
+
+    def setHelp(self, metricName, helpText):
+        """change help for metric
+
+        Args:
+            metricName (str): name of metric to set the help information
+            helpText (str): help information about what the metric is to say
+        """
+        with self._lock:
+            self.ensureMetric(metricName)
+            metric = self.metrics[metricName]
+            previous = metric.helpText
+            metric.setHelp(helpText)
+        if metric.helpText != previous:
+            self._compactWal()
+
+    def setType(self, metricName, metricType=None):
+        """change metric type
+
+        Args:
+            metricName (str): name of metric to set type for
+            metricType (str): type to be set for metric (default: `"gauge"`)
+        """
+        with self._lock:
+            self.ensureMetric(metricName)
+            metric = self.metrics[metricName]
+            previous = metric.type
+            metric.setType(metricType)
+        if metric.type != previous:
+            self._compactWal()
+
+    def setWindow(self, metricName, size, statistics=None):
+        """keep rolling windows of the last values of a metric
+
+        Args:
+            metricName (str): name of metric to keep rolling windows for
+            size (int): number of values per window, `None` to drop the windows
+            statistics (list): statistics to render out of `RollingWindow.statistics`
+                               (default: `None`, so all of them)
+        """
+        with self._lock:
+            self.ensureMetric(metricName)
+            self.metrics[metricName].setWindow(size, statistics)
+
+    def _familiesChanged(self):
+        """invalidate caches after metrics were added, renamed or removed"""
+        self._nameIndex = None
+        self._generation += 1
+
+    def version(self):
+        """state of the collection to validate cached renderings
+
+        The version changes with every change done through the methods of the
+        collection and its metrics. Values set directly on metric instances are
+        not recognized.
+
+        Returns:
+            tuple: comparable version of the collection
+        """
+        families = self.families()
+        version = (self._generation, self._collectorGeneration) + tuple(
+            (m.generation, m.observed()) for m in families
+        )
+        if any(m.meters for m in families):
+            # rates of meters decay without any change
+            version += (Meter.tickCount(),)
+        return version
+
+    def families(self):
+        """snapshot of the metrics in the collection
+
+        Returns:
+            list: metric objects in order of the collection
+        """
+        with self._lock:
+            return list(self.metrics.values())
+
+    def nameIndex(self):
+        """sorted index of metric names for prefix lookups
+
+        The index is rebuilt lazily after metrics were added, renamed or removed.
+
+        Returns:
+            list: sorted metric names
+        """
+        with self._lock:
+            if self._nameIndex is None:
+                self._namePositions = {name: i for i, name in enumerate(self.metrics)}
+                self._nameIndex = sorted(self._namePositions)
+            return self._nameIndex
+
+    def selectNames(self, include=None, exclude=None):
+        """select metric names by prefixes
+
+        Included names are looked up by bisecting the name index, so the cost depends
+        on the number of matching metrics, not on the size of the collection.
+
+        Args:
+            include (str|list): name prefix(es) to select (default: `None`, so all metrics)
+            exclude (str|list): name prefix(es) to skip (default: `None`)
+
+        Returns:
+            list: selected metric names in order of the collection
+        """
+        if include is None:
+            with self._lock:
+                names = list(self.metrics)
+        else:
+            if isinstance(include, str):
+                include = [include]
+            index = self.nameIndex()
+            selected = set()
+            for prefix in include:
+                for pos in range(bisect_left(index, prefix), len(index)):
+                    if not index[pos].startswith(prefix):
+                        break
+                    selected.add(index[pos])
+            names = sorted(selected, key=self._namePositions.__getitem__)
+        if exclude:
+            if isinstance(exclude, str):
+                exclude = [exclude]
+            exclude = tuple(exclude)
+            names = [name for name in names if not name.startswith(exclude)]
+        return names
+
+    @staticmethod
+    def parseSelector(selector):
+        """parse a PromQL-like series selector
+
+        Selectors look like `http_requests_total{job="api",code=~"5.."}` – the metric name
+        and the label matchers are both optional.
+
+        Args:
+            selector (str): selector to parse
+
+        Returns:
+            tuple: metric name (`None` if not given) and list of matchers as tuples of label
+                   name, operator and value
+
+        Raises:
+            ValueError: if the selector is malformed
+        """
+        match = re.fullmatch(MetricsCollection.selectorRegEx, selector.strip())
+        if match is None:
+            raise ValueError(f"Invalid series selector “{selector}”!")
+        name, body = match.groups()
+        if name is None and body is None:
+            raise ValueError("A series selector needs a metric name or label matchers!")
+        matchers = []
+        if body is not None and body.strip():
+            position = 0
+            for m in re.finditer(MetricsCollection.matcherRegEx, body):
+                if m.start() != position:
+                    break
+                label, op, value = m.groups()
+                value = re.sub(
+                    r"\\(.)", lambda e: "\n" if e.group(1) == "n" else e.group(1), value
+                )
+                if op in ("=~", "!~"):
+                    try:
+                        value = re.compile(value)
+                    except re.error as e:
+                        raise ValueError(
+                            f"Invalid regular expression “{value}” in selector: {e}"
+                        )
+                matchers.append((label, op, value))
+                position = m.end()
+            if position != len(body):
+                raise ValueError(f"Invalid series selector “{selector}”!")
+        return name, matchers
+
+    @staticmethod
+    def matchValue(value, op, expected):
+        """check a single value against a label matcher
+
+        Args:
+            value (str): value to check
+            op (str): operator, one of `=`, `!=`, `=~` and `!~`
+            expected (mixed): value to compare with – a string or a compiled regular
+                              expression for `=~` and `!~`, which has to match the whole value
+
+        Returns:
+            bool: does the value match?
+
+        Raises:
+            ValueError: on unknown operators
+        """
+        if op in ("=~", "!~"):
+            if not isinstance(expected, re.Pattern):
+                expected = re.compile(expected)
+            return (expected.fullmatch(str(value)) is None) == (op == "!~")
+        if op in ("=", "!="):
+            return (value == expected) != (op == "!=")
+        raise ValueError(f"Unknown label matcher operator “{op}”!")
+
+    def select(self, selector):
+        """select instances by a PromQL-like series selector
+
+        The instances are looked up in the inverted index of each metric, see
+        `Metric.selectInstances`. A name of a histogram or summary sample like
+        `<name>_bucket` selects only those samples of the metric `<name>`. Matchers on
+        `__name__` are compared with the sample names, so e.g.
+        `{__name__="<name>_bucket"}` selects the buckets of a histogram, too.
+
+        Args:
+            selector (str): selector like `http_requests_total{job="api",code=~"5.."}`
+
+        Returns:
+            list: matching instances
+
+        Raises:
+            ValueError: if the selector is malformed
+        """
+        name, matchers = MetricsCollection.parseSelector(selector)
+        nameMatchers = [m for m in matchers if m[0] == "__name__"]
+        matchers = [m for m in matchers if m[0] != "__name__"]
+        with self._lock:
+            if name is None:
+                targets = [(m, None) for m in self.metrics.values()]
+            elif name in self.metrics:
+                targets = [(self.metrics[name], None)]
+            else:
+                targets = []
+                for suffix, types in self.sampleSuffixes.items():
+                    family = self.metrics.get(name[: -len(suffix)])
+                    if name.endswith(suffix) and family is not None:
+                        if family.type in types:
+                            targets.append((family, suffix))
+        selected = []
+        for metric, suffix in targets:
+            if nameMatchers and suffix is None:
+                # match every sample name of the metric on its own
+                candidates = [""] + [
+                    s
+                    for s, types in self.sampleSuffixes.items()
+                    if metric.type in types
+                ]
+            else:
+                candidates = [suffix]
+            for candidate in candidates:
+                sampleName = metric.name + (candidate or "")
+                if all(
+                    MetricsCollection.matchValue(sampleName, op, value)
+                    for _, op, value in nameMatchers
+                ):
+                    selected.extend(metric.selectInstances(matchers, candidate))
+        return selected
+
+    def histogramQuantile(self, q, family, by=None):
+        """estimate quantiles from the buckets of a histogram
+
+        Like `histogram_quantile` of PromQL, the `_bucket` instances are grouped by their
+        labels except `le` and the quantile is interpolated linearly within the bucket it
+        falls into. If `by` is given, the buckets of all series with the same values of
+        those labels are summed up first, like `sum by (…, le)` does. Every distinct
+        bound is parsed once and the bounds of each group are sorted once for all
+        quantiles.
+
+        Args:
+            q (float|list): quantile(s) to estimate, between 0 and 1
+            family (str): name of the histogram metric
+            by (list): labels to group by (default: `None`, so all labels except `le`)
+
+        Returns:
+            MetricsCollection: gauge `<family>_quantile` with a `quantile` label next to
+                               the labels of each group
+        """
+        quantiles = [q] if isinstance(q, (int, float)) else list(q)
+        name = f"{family}_quantile"
+        result = MetricsCollection(typedValues=True)
+        result.ensureMetric(
+            name,
+            helpText=f"quantiles estimated from histogram {family}",
+            metricType="gauge",
+        )
+        metric = self.metrics.get(family)
+        if metric is None:
+            logger.warning(f"Histogram “{family}” does not exist.")
+            return result
+        with metric.lock:
+            metric.syncObservations()
+            buckets = [
+                (i.labels, i.value) for i in metric.instances if i.suffix == "_bucket"
+            ]
+
+        bounds = {}
+        groups = {}
+        for labels, value in buckets:
+            le = labels.get("le")
+            bound = bounds.get(le)
+            if bound is None:
+                try:
+                    bound = bounds[le] = float(MetricsCollection.parseValue(le))
+                except (TypeError, ValueError):
+                    logger.warning(
+                        f"Ignoring bucket of “{family}” with invalid bound “{le}”."
+                    )
+                    continue
+            if by is None:
+                key = tuple(sorted((k, v) for k, v in labels.items() if k != "le"))
+            else:
+                key = tuple((k, labels.get(k, "")) for k in by if k != "le")
+            if type(value) is str:
+                value = MetricsCollection.parseValue(value)
+            counts = groups.setdefault(key, {})
+            counts[bound] = counts.get(bound, 0) + value
+
+        for key, counts in groups.items():
+            upperBounds = sorted(counts)
+            cumulative = []
+            highest = 0
+            for bound in upperBounds:
+                # counts have to be monotonic, e.g. with buckets scraped at different times
+                highest = max(highest, counts[bound])
+                cumulative.append(highest)
+            labels = {k: v for k, v in key if v != ""}
+            for q in quantiles:
+                result.addMetric(
+                    name,
+                    MetricsCollection.bucketQuantile(q, upperBounds, cumulative),
+                    dict(labels, quantile=MetricsCollection.formatValue(q)),
+                )
+        return result
+
+    @staticmethod
+    def bucketQuantile(q, upperBounds, counts):
+        """interpolate a quantile from cumulative bucket counts
+
+        Follows the estimation of Prometheus: quantiles falling into the `+Inf` bucket
+        yield the highest finite bound, the lowest bucket starts at 0 if its bound is
+        positive.
+
+        Args:
+            q (float): quantile to estimate, between 0 and 1
+            upperBounds (list): sorted upper bounds of the buckets, ending with `+Inf`
+            counts (list): cumulative counts of the buckets
+
+        Returns:
+            float: estimated quantile, `NaN` if it cannot be estimated
+        """
+        if math.isnan(q):
+            return math.nan
+        if q < 0:
+            return -math.inf
+        if q > 1:
+            return math.inf
+        if len(upperBounds) < 2 or upperBounds[-1] != math.inf or counts[-1] == 0:
+            return math.nan
+        rank = q * counts[-1]
+        b = bisect_left(counts, rank, hi=len(counts) - 1)
+        if b == len(upperBounds) - 1:
+            return upperBounds[-2]
+        if b == 0 and upperBounds[0] <= 0:
+            return upperBounds[0]
+        start = 0.0
+        count = counts[b]
+        if b > 0:
+            start = upperBounds[b - 1]
+            count -= counts[b - 1]
+            rank -= counts[b - 1]
+        if count == 0:
+            return start
+        return start + (upperBounds[b] - start) * (rank / count)
+
+    def observe(
+        self, metricName, labels={}, metricType="histogram", buckets=None, helpText=None
+    ):
+        """get the observations of a histogram or summary series
+
+        Args:
+            metricName (str): name of the histogram or summary metric
+            labels (dict): labels of the series (default: `{}`)
+            metricType (str): `histogram` or `summary`, used if the metric does not exist
+                              yet (default: `"histogram"`)
+            buckets (list): upper bounds of histogram buckets (default: `None`, so
+                            `Observations.defaultBuckets`)
+            helpText (str): help information, used if the metric does not exist yet
+                            (default: `None`)
+
+        Returns:
+            Observations: observations of the series, `None` if the metric is neither
+                          a histogram nor a summary
+        """
+        self.ensureMetric(metricName, helpText=helpText, metricType=metricType)
+        return self.metrics[metricName].observe(labels, buckets)
+
+    def meter(self, metricName, labels={}, helpText=None):
+        """get the meter of a series, rendering rates of events per second
+
+        Args:
+            metricName (str): name of the gauge metric
+            labels (dict): labels of the series (default: `{}`)
+            helpText (str): help information, used if the metric does not exist yet
+                            (default: `None`)
+
+        Returns:
+            Meter: meter of the series, `None` if the metric is no gauge or the labels
+                   contain `window`
+        """
+        self.ensureMetric(metricName, helpText=helpText, metricType="gauge")
+        return self.metrics[metricName].meter(labels)
+
+    def timed(
+        self, metricName, labels={}, metricType="histogram", buckets=None, helpText=None
+    ):
+        """decorator observing the duration of a function in seconds
+
+        The series is resolved once on decoration. Both regular and `async`
+        functions are supported. Functions are left untouched if the metric is
+        neither a histogram nor a summary.
+
+        Args:
+            metricName (str): name of the histogram or summary metric
+            labels (dict): labels of the series (default: `{}`)
+            metricType (str): `histogram` or `summary` (default: `"histogram"`)
+            buckets (list): upper bounds of histogram buckets (default: `None`)
+            helpText (str): help information (default: `None`)
+
+        Returns:
+            function: decorator
+        """
+        observations = self.observe(metricName, labels, metricType, buckets, helpText)
+
+        def decorator(func):
+            if observations is None:
+                return func
+            if inspect.iscoroutinefunction(func):
+
+                @functools.wraps(func)
+                async def asyncWrapper(*args, **kwargs):
+                    start = time.perf_counter_ns()
+                    try:
+                        return await func(*args, **kwargs)
+                    finally:
+                        observations.observe((time.perf_counter_ns() - start) / 1e9)
+
+                return asyncWrapper
+
+            @functools.wraps(func)
+            def wrapper(*args, **kwargs):
+                start = time.perf_counter_ns()
+                try:
+                    return func(*args, **kwargs)
+                finally:
+                    observations.observe((time.perf_counter_ns() - start) / 1e9)
+
+            return wrapper
+
+        return decorator
+
+    def time(
+        self, metricName, labels={}, metricType="histogram", buckets=None, helpText=None
+    ):
+        """context manager observing the duration of its block in seconds
+
+        Args:
+            metricName (str): name of the histogram or summary metric
+            labels (dict): labels of the series (default: `{}`)
+            metricType (str): `histogram` or `summary` (default: `"histogram"`)
+            buckets (list): upper bounds of histogram buckets (default: `None`)
+            helpText (str): help information (default: `None`)
+
+        Returns:
+            Observations.Timer: context manager, a no-op one if the metric is neither a
+                                histogram nor a summary
+        """
+        observations = self.observe(metricName, labels, metricType, buckets, helpText)
+        return nullcontext() if observations is None else observations.time()
+
+    def prepare(self, names=None, labelMatchers=None):
+        """Helper function to transform list of metric objects of class above into usable object
+
+        Args:
+            names (list): names of metrics to prepare (default: `None`, so all)
+            labelMatchers (dict): only prepare instances matching the label matchers,
+                                  see `Metric.matchingInstances` (default: `None`)
+
+        Returns:
+            dict: dictionary to be pushed into template of this module to be rendered
+        """
+        finalized = {}
+        with self._snapshot() as families:
+            if names is not None:
+                families = [self.metrics[name] for name in names]
+            for m in families:
+                if labelMatchers:
+                    finalized.update(
+                        m.representation(m.matchingInstances(labelMatchers))
+                    )
+                else:
+                    finalized.update(m.representation())
+        return finalized
+
+    @contextmanager
+    def _snapshot(self):
+        """hold the collection lock and the locks of all metrics
+
+        Rendering copies the metrics while holding all locks, so the copies are one
+        consistent state of the collection. Without thread safety, nothing is locked.
+
+        Yields:
+            list: metric objects in order of the collection
+        """
+        with self._lock, ExitStack() as stack:
+            families = list(self.metrics.values())
+            if self.threadSafe:
+                for m in families:
+                    stack.enter_context(m.lock)
+            yield families
+
+    def load(
+        self, metricsString, dismissComments=True, relabeler=None, groupSamples=True
+    ):
+        """load (additional) metrics
+
+        Load data from given metrics string to merge with current collection or to manipulate, ...
+        By default, comments will be dismissed – otherwise they will probably be relocated to the nearest metrics since this
+        module only supports comments connected to metrics not floating around in the final metrics string.
+
+        If a relabeler is given, every series is relabeled right after parsing its line and dropped series are never
+        added to the collection. Metric families are then only created for series that survive relabeling.
+
+        Samples `<name>_bucket`, `<name>_sum` and `<name>_count` of histograms and summaries are kept as suffixed
+        instances of the metric `<name>`. Earlier versions created a separate untyped metric per sample name, which
+        `groupSamples=False` restores for code looking them up as `metrics["<name>_bucket"]`.
+
+        Args:
+            metricsString (str): metrics string to load
+            dismissComments (bool): set `True` if comments (other than `# HELP` and `# TYPE`, which are mandatory) should be dismissed
+            relabeler (MetricsRelabeler): relabel rules to apply while loading (default: `None`)
+            groupSamples (bool): keep samples of histograms and summaries in their metric (default: `True`)
+        """
+        # will work with comment assigning to metrics by distance in file, so first remove all blank lines
+        self._worklist = [l.strip() for l in metricsString.splitlines()]
         # working variable for initialisation of metrics
         self._createMetrics = {}
         # working variable to store lines where which metric names were found
         self._metricLines = {}
         # working variable to store line indices which already were processed
         self._lineRange = list(range(len(self._worklist)))
-        self._processedLines = [i for i in self._lineRange if self._worklist[i] == ""]
+        self._processedLines = {i for i in self._lineRange if self._worklist[i] == ""}
+        # working variable for the relabel rules to apply
+        self._relabeler = relabeler
+        self._groupSamples = groupSamples
         # find types
-        self._findTypes()
+        with self._measure("types"):
+            self._findTypes()
         # find help notes
-        self._findHelps()
-        # create the metric collections
-        for metricName in self._createMetrics:
-            mt = None
-            mh = None
-            if "type" in self._createMetrics[metricName].keys():
-                mt = self._createMetrics[metricName]["type"]
-            if "help" in self._createMetrics[metricName].keys():
-                mh = self._createMetrics[metricName]["help"]
-            self.addMetric(
-                metricName=metricName,
-                helpText=mh,
-                metricType=mt,
+        with self._measure("helps"):
+            self._findHelps()
+        # create the metric collections – relabeled families are created by their first kept series
+        with self._measure("families"):
+            for metricName in self._createMetrics if relabeler is None else ():
+                mt = None
+                mh = None
+                if "type" in self._createMetrics[metricName].keys():
+                    mt = self._createMetrics[metricName]["type"]
+                if "help" in self._createMetrics[metricName].keys():
+                    mh = self._createMetrics[metricName]["help"]
+                self.addMetric(
+                    metricName=metricName,
+                    helpText=mh,
+                    metricType=mt,
+                )
+        # find actual metric instances
+        with self._measure("instances"):
+            self._findMetricInstances()
+        # find comments
+        with self._measure("comments"):
+            self._findComments(dismissComments=dismissComments)
+
+        # add metric instances
+        # check if any string is left over and warn about it
+        self._checkForLeftovers()
+        # clean create metrics variables
+        del self._createMetrics
+        del self._metricLines
+        del self._processedLines
+        del self._lineRange
+        del self._worklist
+        del self._relabeler
+        del self._groupSamples
+        # print(self)
+
+    def _findTypes(self):
+        """find types in metrics string
+
+        helper method for `load` function which collects metric names and types in `self._worklist`
+        """
+        try:
+            self._worklist
+        except AttributeError:
+            logger.error("Method “_findTypes” is not meant to be called manually.")
+            return
+
+        regex = r"^#\s*TYPE\s+([^\s]+)\s+([^\s]+)\s*$"
+        for lineIndex in [i for i in self._lineRange if i not in self._processedLines]:
+            line = self._worklist[lineIndex]
+            typeRow = re.fullmatch(regex, line)
+            if typeRow != None:
+                self._processedLines.add(lineIndex)
+                groups = typeRow.groups()
+                # note down line as metric relevant line
+                if groups[0] not in self._metricLines:
+                    self._metricLines[groups[0]] = []
+                self._metricLines[groups[0]].append(lineIndex)
+                # store type of metric
+                if groups[0] not in self._createMetrics:
+                    self._createMetrics[groups[0]] = {}
+                if "type" in self._createMetrics[groups[0]]:
+                    logger.error(
+                        f"Type for metric with name {groups[0]} defined multiple times.\n"
+                        f"Only first occurence (“{self._createMetrics[groups[0]]['type']}”) in given metric definition will be applied."
+                    )
+                else:
+                    self._createMetrics[groups[0]]["type"] = groups[1]
+
+    def _findHelps(self):
+        """find help notices in metrics string
+
+        helper method for `load` function which collects help notices in `self._worklist` and adds them to corresponding names and types
+        """
+        try:
+            self._worklist
+        except AttributeError:
+            logger.error("Method “_findHelps” is not meant to be called manually.")
+            return
+
+        regex = r"^#\s*HELP\s+([^\s]+)\s+(.*)$"
+        for lineIndex in [i for i in self._lineRange if i not in self._processedLines]:
+            line = self._worklist[lineIndex]
+            helpRow = re.fullmatch(regex, line)
+            if helpRow != None:
+                self._processedLines.add(lineIndex)
+                groups = helpRow.groups()
+                # note down line as metric relevant line
+                if groups[0] not in self._metricLines:
+                    self._metricLines[groups[0]] = []
+                self._metricLines[groups[0]].append(lineIndex)
+                # store help of metric
+                if groups[0] not in self._createMetrics:
+                    self._createMetrics[groups[0]] = {}
+                if "help" in self._createMetrics[groups[0]]:
+                    logger.error(
+                        f"Help for metric with name {groups[0]} defined multiple times.\n"
+                        f"Only first occurence (“{self._createMetrics[groups[0]]['help']}”) in given metric definition will be applied."
+                    )
+                else:
+                    self._createMetrics[groups[0]]["help"] = (
+                        MetricsCollection.decodeOneliner(groups[1])
+                    )
+
+    def _findComments(self, dismissComments=True):
+        """find comments and sort them to nearest metrics names
+
+        Args:
+            dismissComments (bool): should comments just be dropped? Yes => `True`, No => `False`
+        """
+        try:
+            self._worklist
+        except AttributeError:
+            logger.error("Method “_findComments” is not meant to be called manually.")
+            return
+
+        commentLineIndex = [
+            i
+            for i in self._lineRange
+            if i not in self._processedLines and self._worklist[i].startswith("#")
+        ]
+        self._processedLines.update(commentLineIndex)
+
+        if not dismissComments:
+            start = {}
+            end = {}
+            for metricName in self._metricLines.keys():
+                start[metricName] = min(self._metricLines[metricName])
+                end[metricName] = max(self._metricLines[metricName])
+
+            for cl in commentLineIndex:
+                sd = {}
+                ed = {}
+                for metricName in self._metricLines.keys():
+                    sd[metricName] = abs(start[metricName] - cl)
+                    ed[metricName] = abs(end[metricName] - cl)
+                ls = min(sd.values())
+                le = min(ed.values())
+                if ls <= le:
+                    name = [k for k, v in sd.items() if v == ls][0]
+                else:
+                    name = [k for k, v in ed.items() if v == le][0]
+
+                if name in self.metrics:
+                    self.addComment(name, self._worklist[cl].lstrip("#").strip())
+
+    def _findMetricInstances(self):
+        """find actual metric instances"""
+        try:
+            self._worklist
+        except AttributeError:
+            logger.error(
+                "Method “_findMetricInstances” is not meant to be called manually."
+            )
+            return
+
+        lineRegex = re.compile(
+            r"^("
+            + self.Metric.nameRegEx
+            + r")\s*(\{(.*)\})?\s+("
+            + self.valueRegEx
+            + r")$"
+        )
+        commaSplitRegex = re.compile(r""",(?=(?:[^"']*["'][^"']*["'])*[^"']*$)""")
+        unquoteRegex = re.compile(r"""((^"(.*)"$)|(^'(.*)'$))""")
+        for lineIndex in [i for i in self._lineRange if i not in self._processedLines]:
+            line = self._worklist[lineIndex]
+            metricLine = lineRegex.fullmatch(line)
+            if metricLine != None:
+                self._processedLines.add(lineIndex)
+                groups = metricLine.groups()
+                # samples of histograms and summaries belong to the declared metric
+                family, suffix = self._findFamily(groups[0])
+                # note down line as metric relevant line
+                if family not in self._metricLines:
+                    self._metricLines[family] = []
+                self._metricLines[family].append(lineIndex)
+
+                # retrieve labels
+                labels = {}
+                if groups[2] != None:
+                    labelHelp = commaSplitRegex.split(groups[2])
+                    for l in labelHelp:
+                        l = l.split("=", 1)
+                        labels[l[0]] = unquoteRegex.sub(r"\3\5", l[1])
+
+                # add actual metric
+                if family not in self._createMetrics:
+                    self._createMetrics[family] = {}
+                    logger.info(
+                        f"It seems there is a metric “{family}” without any TYPE or HELP defined in imported metrics."
+                    )
+
+                name = family
+                if self._relabeler is not None:
+                    # relabel rules see the sample name, like in Prometheus
+                    relabeled = self._relabeler.relabel(groups[0], labels)
+                    if relabeled is None:
+                        continue
+                    name, labels = relabeled
+                    if suffix and name.endswith(suffix):
+                        name = name[: -len(suffix)]
+                    else:
+                        suffix = ""
+                    if name not in self.metrics:
+                        definition = self._createMetrics.get(family, {})
+                        self.addMetric(
+                            metricName=name,
+                            helpText=definition.get("help"),
+                            metricType=definition.get("type"),
+                        )
+
+                value = groups[3]
+                if self.typedValues:
+                    value = MetricsCollection.parseValue(value)
+                self.addMetric(name, value=value, labels=labels, suffix=suffix)
+
+    def _findFamily(self, sampleName):
+        """find the metric a sample belongs to
+
+        Samples named `<name>_bucket`, `<name>_sum` or `<name>_count` belong to the
+        metric `<name>` if that is declared as histogram – or as summary for the last
+        two – and are added as suffixed instances of it.
+
+        Args:
+            sampleName (str): name of the sample
+
+        Returns:
+            tuple: name of the metric and suffix of the sample
+        """
+        if (
+            not self._groupSamples
+            or sampleName in self._createMetrics
+            or sampleName in self.metrics
+        ):
+            return sampleName, ""
+        for suffix, types in self.sampleSuffixes.items():
+            if sampleName.endswith(suffix):
+                family = sampleName[: -len(suffix)]
+                if family in self._createMetrics:
+                    metricType = self._createMetrics[family].get("type")
+                elif family in self.metrics:
+                    metricType = self.metrics[family].type
+                else:
+                    continue
+                if metricType in types:
+                    return family, suffix
+        return sampleName, ""
+
+    def _checkForLeftovers(self):
+        """check if the Metric string holds unknown, unallowed additional lines of code and warn about occurences"""
+        try:
+            self._worklist
+        except AttributeError:
+            logger.error(
+                "Method “_checkForLeftovers” is not meant to be called manually."
+            )
+            return
+
+    def decodeOneliner(singleLine):
+        """decode single line
+
+        Args:
+            singleLine (string): one single line – in Prometheus metrics, `\\` has
+                                 to be encoded as `\\\\` and newlines as `\\n`.
+
+        Returns:
+            string: decoded text, possibly multiline
+        """
+        if "\n" in singleLine:
+            logger.error("Single line has to be given to be able to decode anything!")
+        else:
+            singleLine = singleLine.replace("\\n", "\n").replace("\\\\", "\\")
+        return singleLine
+
+    @staticmethod
+    def seriesHash(metricName, labels):
+        """stable 64 bit hash of a series
+
+        Args:
+            metricName (str): name of the metric
+            labels (dict): labels of the series
+
+        Returns:
+            int: hash of name and label set, independent of label order
+        """
+        key = "\0".join([metricName] + [f"{k}={v}" for k, v in sorted(labels.items())])
+        return int.from_bytes(
+            hashlib.blake2b(key.encode(), digest_size=8).digest(), "little"
+        )
+
+    @staticmethod
+    def jumpHash(key, buckets):
+        """jump consistent hash
+
+        Maps a 64 bit key onto one of `buckets` buckets, so that only `1/n` of the
+        keys move when the number of buckets changes from `n-1` to `n`
+        (see https://arxiv.org/abs/1406.2294).
+
+        Args:
+            key (int): 64 bit key
+            buckets (int): number of buckets
+
+        Returns:
+            int: bucket in range `0` to `buckets - 1`
+        """
+        b, j = -1, 0
+        while j < buckets:
+            b = j
+            key = (key * 2862933555777941757 + 1) & 0xFFFFFFFFFFFFFFFF
+            j = int((b + 1) * ((1 << 31) / ((key >> 33) + 1)))
+        return b
+
+    @staticmethod
+    def parseValue(valueString):
+        """parse a sample value from a metrics string
+
+        Integral values are returned as `int`, all others as `float` – the special
+        values `NaN`, `+Inf` and `-Inf` are supported as defined by the exposition format.
+        Integral floats beyond the exactly representable range (±2⁵³) are kept as `float`,
+        so e.g. `1e300` is not rendered as a 301-digit integer.
+
+        Args:
+            valueString (str): value as found in a metrics string
+
+        Returns:
+            int|float: parsed value
+        """
+        try:
+            return int(valueString)
+        except ValueError:
+            pass
+        if valueString in MetricsCollection.specialValues:
+            return MetricsCollection.specialValues[valueString]
+        value = float(valueString)
+        if value.is_integer() and abs(value) <= MetricsCollection.maxExactInteger:
+            return int(value)
+        return value
+
+    @staticmethod
+    def formatValue(value):
+        """format a sample value for the metrics string
+
+        Floats are rendered by their shortest round-tripping representation, special
+        floats as `NaN`, `+Inf` and `-Inf`. Strings are expected to be already
+        formatted and are returned untouched.
+
+        Args:
+            value (mixed): value to be formatted
+
+        Returns:
+            str: formatted value
+        """
+        valueType = type(value)
+        if valueType is str:
+            return value
+        if valueType is float:
+            if value != value:
+                return "NaN"
+            if value == math.inf:
+                return "+Inf"
+            if value == -math.inf:
+                return "-Inf"
+            return repr(value)
+        if valueType is bool:
+            return "1" if value else "0"
+        return str(value)
+
+    @classmethod
+    def template(cls):
+        """get the (cached) template to render metrics
+
+        Returns:
+            jinja2.Template: template for metrics strings
+        """
+        if cls._template is None:
+            file_loader = FileSystemLoader(
+                os.path.join(os.path.dirname(os.path.abspath(__file__)), "tpl")
+            )
+            env = Environment(loader=file_loader)
+            env.filters["metricValue"] = cls.formatValue
+            cls._template = env.get_template("metrics.j2")
+        return cls._template
+
+    def toFrame(self, names=None):
+        """convert instances into a pandas DataFrame
+
+        The frame has one row per instance. Metric name, sample suffix, type, help and
+        value are held by the columns `__name__`, `__suffix__`, `__type__`, `__help__`
+        and `__value__` – prefixed like reserved Prometheus labels, so they cannot clash
+        with the label columns that follow, one per label name. Except for the values,
+        all columns are categorical, missing labels are `NaN`.
+
+        Requires pandas, which is part of the `csv` extra.
+
+        Args:
+            names (list): names of metrics to convert (default: `None`, so all)
+
+        Returns:
+            pandas.DataFrame: instances of the collection
+        """
+        import pandas as pd
+
+        if names is None:
+            metrics = self.families()
+        else:
+            metrics = [self.metrics[name] for name in names]
+        metricNames, suffixes, types, helps, values, labelSets = [], [], [], [], [], []
+        for m in metrics:
+            with m.lock:
+                m.syncObservations()
+                instances = m.instances
+                metricNames.extend([m.name] * len(instances))
+                types.extend([m.type or ""] * len(instances))
+                helps.extend([m.helpText or ""] * len(instances))
+                for i in instances:
+                    suffixes.append(i.suffix)
+                    labelSets.append(i.labels)
+                    value = i.value
+                    if type(value) is str:
+                        value = MetricsCollection.parseValue(value)
+                    values.append(value)
+
+        columns = {}
+        for column, data in zip(
+            MetricsCollection.frameColumns[:4], (metricNames, suffixes, types, helps)
+        ):
+            columns[column] = pd.Categorical(data)
+        columns["__value__"] = pd.Series(values, dtype="float64")
+        frame = pd.DataFrame(columns)
+        labels = pd.DataFrame.from_records(labelSets, nrows=len(labelSets))
+        for label in labels.columns:
+            frame[label] = labels[label].astype("category")
+        return frame
+
+    def fromFrame(self, frame):
+        """add instances from a pandas DataFrame
+
+        The frame is expected in the layout of `toFrame`. Only the columns `__name__`
+        and `__value__` are mandatory, all columns not named like the ones from
+        `MetricsCollection.frameColumns` are used as labels – empty or missing label
+        values are skipped, integral floats like `1.0` of numeric label columns become
+        `"1"`. Type and help are taken from the first row of each metric and only applied
+        if they are not empty. Integral values are added as `int`.
+
+        Label values are converted once per distinct value of a column and the rows are
+        grouped by metric by pandas. The instances of each metric are added under a
+        single lock, only metrics used by recording rules are updated row by row.
+
+        Args:
+            frame (pandas.DataFrame): instances to add
+
+        Raises:
+            ValueError: if the mandatory columns are missing
+        """
+        import pandas as pd
+
+        for column in ("__name__", "__value__"):
+            if column not in frame.columns:
+                raise ValueError(f"DataFrame has no column “{column}”!")
+        rows = len(frame)
+        values = [
+            (
+                int(value)
+                if type(value) is float
+                and value.is_integer()
+                and abs(value) <= MetricsCollection.maxExactInteger
+                else value
+            )
+            for value in frame["__value__"].tolist()
+        ]
+        suffixes, types, helps = (
+            (
+                [v if isinstance(v, str) else "" for v in frame[column].tolist()]
+                if column in frame.columns
+                else [""] * rows
+            )
+            for column in ("__suffix__", "__type__", "__help__")
+        )
+        labelSets = [{} for _ in range(rows)]
+        for label in frame.columns:
+            if label in MetricsCollection.frameColumns:
+                continue
+            codes, uniques = pd.factorize(frame[label], use_na_sentinel=True)
+            strings = [MetricsCollection.labelValue(v) for v in uniques]
+            for row in (codes >= 0).nonzero()[0].tolist():
+                value = strings[codes[row]]
+                if value:
+                    labelSets[row][label] = value
+
+        groups = frame.groupby("__name__", sort=False, observed=True).indices
+        for metricName, positions in groups.items():
+            positions = positions.tolist()
+            first = positions[0]
+            metricType, helpText = types[first], helps[first]
+            if metricName not in self.metrics:
+                self.ensureMetric(metricName, helpText or None, metricType or None)
+            else:
+                metric = self.metrics[metricName]
+                if metricType and metricType != metric.type:
+                    self.setType(metricName, metricType)
+                if helpText and helpText != metric.helpText:
+                    self.setHelp(metricName, helpText)
+            self._addSamples(
+                metricName,
+                [(values[row], labelSets[row], suffixes[row]) for row in positions],
+            )
+
+    @staticmethod
+    def labelValue(value):
+        """format a present value of a DataFrame column as label value
+
+        Args:
+            value (mixed): value of a label column
+
+        Returns:
+            str: label value
+        """
+        if type(value) is str:
+            return value
+        if isinstance(value, float) and value.is_integer():
+            return str(int(value))
+        return str(value)
+
+    def _addSamples(self, metricName, samples):
+        """add many instances to an existing metric
+
+        Args:
+            metricName (str): name of the metric
+            samples (list): tuples of value, labels and suffix
+        """
+        if self._dependents.get(metricName):
+            for value, labels, suffix in samples:
+                self.addMetric(metricName, value, labels, suffix=suffix)
+            return
+        metric = self.metrics[metricName]
+        with metric.lock:
+            instances = metric.addMetrics(samples)
+            if self.wal is not None:
+                for instance in instances:
+                    self.wal.append(metric, instance)
+
+    def registerCollector(self, callback, name=None, timeout=5.0, minInterval=0):
+        """register a callback collecting metrics on render
+
+        The callback gets an empty `MetricsCollection` to fill whenever the collection
+        is rendered. Independent collectors run concurrently in a thread pool of
+        `collectorWorkers` threads.
+
+        Args:
+            callback (callable): function taking a `MetricsCollection` to add metrics to
+            name (str): name of the collector (default: `None`, so name of the callback)
+            timeout (float): seconds to wait for the collector on render – if exceeded,
+                             its last result is rendered instead (default: `5.0`)
+            minInterval (float): seconds to reuse the last result before collecting again
+                                 (default: `0`, so collect on every render)
+
+        Returns:
+            Collector: registered collector
+        """
+        if name is None:
+            name = getattr(callback, "__name__", repr(callback))
+        if name in self.collectors:
+            logger.warning(f"Replacing already registered collector “{name}”.")
+        collector = Collector(
+            callback,
+            name,
+            timeout=timeout,
+            minInterval=minInterval,
+            typedValues=self.typedValues,
+        )
+        self.collectors[name] = collector
+        return collector
+
+    def unregisterCollector(self, name):
+        """remove a registered collector
+
+        Args:
+            name (str): name of the collector
+        """
+        self.collectors.pop(name)
+        self._collectorGeneration += 1
+        if not self.collectors and self._collectorExecutor is not None:
+            self._collectorExecutor.shutdown(wait=False)
+            self._collectorExecutor = None
+
+    def collect(self, churn=True):
+        """run due collectors concurrently and gather their results
+
+        Recording rules with changed inputs that are not updated incrementally get
+        evaluated first. With instrumentation or churn tracking enabled, their metrics
+        are gathered last.
+
+        Args:
+            churn (bool): gather the churn metrics, which ends the churn interval –
+                          cached renderings only do so if the output is regenerated
+                          (default: `True`)
+
+        Returns:
+            list: `MetricsCollection` results of the collectors
+        """
+        if self.recordingRules:
+            self.evaluateRecordingRules(dirtyOnly=True)
+        collected = self._collect()
+        if self.instrumentation is not None:
+            collected.append(self.instrumentation.collection(self))
+        if churn and self.churn is not None:
+            collected.append(self.churn.collection(self))
+        return collected
+
+    def _collectChurn(self, collected):
+        """gather the churn metrics for a regenerated cached rendering
+
+        Args:
+            collected (list): results of `collect(churn=False)` to append to
+
+        Returns:
+            int: churn interval the rendering belongs to, `None` without churn tracking
+        """
+        churn = self.churn
+        if churn is None:
+            return None
+        collected.append(churn.collection(self))
+        return churn.intervals
+
+    def _churnInterval(self):
+        """current churn interval to validate cached renderings
+
+        Returns:
+            int: number of ended churn intervals, `None` without churn tracking
+        """
+        churn = self.churn
+        return None if churn is None else churn.intervals
+
+    def _collect(self):
+        """run due collectors concurrently and gather their results
+
+        Returns:
+            list: `MetricsCollection` results of the collectors
+        """
+        if not self.collectors:
+            return []
+        started = time.monotonic()
+        with self._collectLock:
+            if self._collectorExecutor is None:
+                self._collectorExecutor = ThreadPoolExecutor(
+                    max_workers=self.collectorWorkers,
+                    thread_name_prefix="MetricsCollector",
+                )
+            pending = [
+                c
+                for c in self.collectors.values()
+                if c.submit(self._collectorExecutor, started)
+            ]
+        for collector in pending:
+            if collector.wait(started):
+                self._collectorGeneration += 1
+        return [c.result for c in self.collectors.values() if c.result is not None]
+
+    @staticmethod
+    def _mergeRepresentation(metrics, other):
+        """merge the prepared representation of another collection
+
+        Args:
+            metrics (dict): prepared representation to merge into
+            other (dict): prepared representation to merge
+        """
+        for name, representation in other.items():
+            if name in metrics:
+                representation = dict(
+                    representation,
+                    instances=list(metrics[name]["instances"])
+                    + list(representation["instances"]),
+                )
+            metrics[name] = representation
+
+    def render(self, include=None, exclude=None, labelMatchers=None):
+        """render (a selection of) the metrics
+
+        Metrics and instances not selected are skipped without copying the collection,
+        e.g. to expose different subsets of one collection on multiple endpoints.
+
+        Args:
+            include (str|list): name prefix(es) of metrics to render (default: `None`, so all)
+            exclude (str|list): name prefix(es) of metrics to skip (default: `None`)
+            labelMatchers (dict): only render instances matching the label matchers,
+                                  see `Metric.matchingInstances` (default: `None`)
+
+        Returns:
+            str: prometheus metrics data
+        """
+        started = time.perf_counter()
+        metrics = self._prepareRender(self.collect(), include, exclude, labelMatchers)
+        output = "".join(self._stream(metrics))
+        if self.instrumentation is not None:
+            self.instrumentation.observeRender(
+                time.perf_counter() - started, len(output.encode())
+            )
+        return output
+
+    def _prepareRender(self, collected, include=None, exclude=None, labelMatchers=None):
+        """prepare the selected metrics and collector results for rendering
+
+        Args:
+            collected (list): results of the collectors
+            include (str|list): name prefix(es) of metrics to render (default: `None`)
+            exclude (str|list): name prefix(es) of metrics to skip (default: `None`)
+            labelMatchers (dict): label matchers for instances (default: `None`)
+
+        Returns:
+            dict: dictionary to be pushed into the template
+        """
+        filtered = include is not None or exclude
+        names = self.selectNames(include, exclude) if filtered else None
+        metrics = self.prepare(names, labelMatchers)
+        for c in collected:
+            names = c.selectNames(include, exclude) if filtered else None
+            self._mergeRepresentation(metrics, c.prepare(names, labelMatchers))
+        return metrics
+
+    def _stream(self, metrics):
+        """render prepared metrics chunk by chunk
+
+        The chunks join to the rendered template stripped of surrounding whitespace
+        plus a final newline.
+
+        Args:
+            metrics (dict): prepared metrics
+
+        Yields:
+            str: chunks of prometheus metrics data
+        """
+        started = False
+        pending = ""
+        for chunk in self.template().generate(metrics=metrics):
+            if not started:
+                chunk = chunk.lstrip()
+                if not chunk:
+                    continue
+                started = True
+            content = chunk.rstrip()
+            if content:
+                yield pending + content
+                pending = chunk[len(content) :]
+            else:
+                pending += chunk
+        yield "\n"
+
+    def renderGzip(self, compressLevel=6):
+        """render the metrics gzip compressed
+
+        The rendering is compressed chunk by chunk while the template is rendered, so
+        large outputs are never held uncompressed. The compressed data is cached until
+        the collection changes, so repeated scrapes of an unchanged collection just
+        return the cached bytes. With churn tracking, any other rendering meanwhile
+        invalidates the cache, since it ends the churn interval of the cached data.
+
+        Args:
+            compressLevel (int): gzip compression level from `1` to `9` (default: `6`)
+
+        Returns:
+            bytes: gzip compressed prometheus metrics data
+        """
+        started = time.perf_counter()
+        collected = self.collect(churn=False)
+        version = self.version()
+        key = (version, compressLevel, self._churnInterval())
+        cached = self._gzipCache
+        hit = cached is not None and cached[0] == key
+        if self.instrumentation is not None:
+            self.instrumentation.observeCache("gzip", hit)
+        if hit:
+            return cached[1]
+        key = (version, compressLevel, self._collectChurn(collected))
+        compressor = zlib.compressobj(compressLevel, zlib.DEFLATED, 31)
+        compressed = []
+        size = 0
+        for chunk in self._stream(self._prepareRender(collected)):
+            chunk = chunk.encode()
+            size += len(chunk)
+            compressed.append(compressor.compress(chunk))
+        compressed.append(compressor.flush())
+        data = b"".join(compressed)
+        self._gzipCache = (key, data)
+        if self.instrumentation is not None:
+            self.instrumentation.observeRender(
+                time.perf_counter() - started, size, len(data)
+            )
+        return data
+
+    def renderShard(self, shard, shards):
+        """render one shard of the metrics
+
+        Series are distributed onto the shards by `Metric.partition`. The rendering
+        of each shard is cached until the collection changes, so e.g. multiple
+        endpoints like `/metrics?shard=k` can be served from one collection. Like for
+        `renderGzip`, other renderings invalidate the cache with churn tracking.
+
+        Args:
+            shard (int): shard to render, in range `0` to `shards - 1`
+            shards (int): total number of shards
+
+        Raises:
+            ValueError: if the shard is out of range
+
+        Returns:
+            str: prometheus metrics data of the shard
+        """
+        if not 0 <= shard < shards:
+            raise ValueError(f"Shard {shard} does not exist for {shards} shards!")
+        started = time.perf_counter()
+        collected = self.collect(churn=False)
+        version = self.version()
+        cached = self._shardCache.get((shard, shards))
+        hit = cached is not None and cached[0] == (version, self._churnInterval())
+        if self.instrumentation is not None:
+            self.instrumentation.observeCache("shard", hit)
+        if hit:
+            return cached[1]
+        version = (version, self._collectChurn(collected))
+        metrics = {}
+        with self._snapshot() as families:
+            for m in families:
+                metrics.update(m.representation(m.partition(shards)[shard]))
+        for c in collected:
+            representation = {}
+            for m in c.families():
+                representation.update(m.representation(m.partition(shards)[shard]))
+            self._mergeRepresentation(metrics, representation)
+        output = "".join(self._stream(metrics))
+        self._shardCache[(shard, shards)] = (version, output)
+        if self.instrumentation is not None:
+            self.instrumentation.observeRender(
+                time.perf_counter() - started, len(output.encode())
+            )
+        return output
+
+    def writeTextfile(self, path):
+        """write the rendered metrics atomically into a file
+
+        The content is written into a hidden temporary file in the same directory,
+        which then replaces the target file – readers like the textfile collector of
+        node_exporter thus never see partially written files. If the content did not
+        change since the last write, the file is left untouched.
+
+        Args:
+            path (str): file to write, e.g. `/var/lib/node_exporter/textfile/app.prom`
+
+        Returns:
+            bool: `True` if the file was written, `False` if it was up to date
+        """
+        path = os.path.abspath(path)
+        data = self.render().encode()
+        digest = hashlib.blake2b(data, digest_size=16).digest()
+        known = self._textfileHashes.get(path)
+        if not os.path.exists(path):
+            known = None
+        elif known is None:
+            with open(path, "rb") as f:
+                known = hashlib.blake2b(f.read(), digest_size=16).digest()
+        if known == digest:
+            logger.debug(f"Metrics file “{path}” is up to date.")
+            self._textfileHashes[path] = digest
+            return False
+
+        self.writeAtomically(path, data)
+        self._textfileHashes[path] = digest
+        logger.debug(f"Wrote metrics file “{path}”.")
+        return True
+
+    @staticmethod
+    def writeAtomically(path, data, sync=False):
+        """replace a file atomically by new content
+
+        Args:
+            path (str): file to write
+            data (bytes): content to write
+            sync (bool): flush the content to disk before replacing (default: `False`)
+        """
+        fd, tmpPath = tempfile.mkstemp(
+            dir=os.path.dirname(path), prefix=".", suffix=".tmp"
+        )
+        try:
+            with os.fdopen(fd, "wb") as f:
+                f.write(data)
+                if sync:
+                    f.flush()
+                    os.fsync(f.fileno())
+            os.chmod(tmpPath, 0o644)
+            os.replace(tmpPath, path)
+        except BaseException:
+            os.unlink(tmpPath)
+            raise
+
+    @staticmethod
+    def writeTextfiles(collections):
+        """write multiple collections into separate files
+
+        Args:
+            collections (dict): file paths mapped to the `MetricsCollection` to write there
+
+        Returns:
+            dict: file paths mapped to `True` if written, `False` if up to date
+        """
+        return {
+            path: collection.writeTextfile(path)
+            for path, collection in collections.items()
+        }
+
+    def view(self, prefix="", labels=None, labelMap=None, relabeler=None):
+        """lightweight view of the collection with renamed metrics or extra labels
+
+        Args:
+            prefix (str): prefix for all metric names (default: `""`)
+            labels (dict): constant labels to add to all instances (default: `None`)
+            labelMap (dict): label names to rename (default: `None`)
+            relabeler (MetricsRelabeler): relabel rules to apply (default: `None`)
+
+        Returns:
+            MetricsView: the view
+        """
+        return MetricsView(self, prefix, labels, labelMap, relabeler)
+
+    def __str__(self):
+        """string representation
+
+        The string representation of a metrics collection is meant to be fetched by
+        Prometheus or to be pushed to a Prometheus Push Gateway.
+
+        Returns:
+            str: prometheus metrics data
+        """
+        return self.render()
+
+
+class MetricsRelabeler:
+    """Prometheus-style relabel rules
+
+    Rules are given as dictionaries using the keys of a Prometheus `relabel_configs` entry:
+    `action` (`replace`, `keep`, `drop`, `labelmap`, `labeldrop` or `labelkeep`; default `replace`),
+    `source_labels`, `separator` (default `;`), `regex` (default `(.*)`), `target_label` and
+    `replacement` (default `$1`). The metric name is available as pseudo label `__name__`.
+
+    All regular expressions are compiled once, so the rules can be applied series by series
+    while parsing, e.g. by `MetricsCollection.load`. Regular expressions have to match whole
+    values and replacements are expanded like Prometheus does: `$1`, `${1}`, `$name` and
+    `${name}` refer to groups, references to missing groups expand to an empty string and
+    `$$` is a literal `$`.
+    """
+
+    actions = ("replace", "keep", "drop", "labelmap", "labeldrop", "labelkeep")
+    referenceRegEx = r"\$(?:(\$)|\{([a-zA-Z0-9_]+)\}|([a-zA-Z0-9_]+))"
+
+    def __init__(self, rules):
+        """initialize the relabeler
+
+        Args:
+            rules (list): list of relabel rules as dictionaries
+
+        Raises:
+            ValueError: if a rule has an unknown action or a `replace` rule has no target label
+        """
+        self.rules = [MetricsRelabeler.compileRule(rule) for rule in rules]
+
+    @staticmethod
+    def compileRule(rule):
+        """compile a single relabel rule
+
+        Args:
+            rule (dict): relabel rule
+
+        Returns:
+            tuple: action, source labels, separator, compiled regex, target label and replacement
+                   parts, see `compileReplacement`
+
+        Raises:
+            ValueError: if the rule has an unknown action or a `replace` rule has no target label
+        """
+        action = rule.get("action", "replace")
+        if action not in MetricsRelabeler.actions:
+            raise ValueError(f"Unknown relabel action “{action}”!")
+        target = rule.get("target_label")
+        if action == "replace" and not target:
+            raise ValueError("A “replace” relabel rule needs a “target_label”!")
+        # Prometheus anchors the regex on both ends, so it is always matched in full
+        regex = re.compile(f"(?:{rule.get('regex', '(.*)')})")
+        return (
+            action,
+            tuple(rule.get("source_labels", ())),
+            rule.get("separator", ";"),
+            regex,
+            target,
+            MetricsRelabeler.compileReplacement(rule.get("replacement", "$1")),
+        )
+
+    @staticmethod
+    def compileReplacement(replacement):
+        """split a replacement into literal text and group references
+
+        Args:
+            replacement (str): replacement with `$` references
+
+        Returns:
+            tuple: literal strings and references as tuples of the group number or name
+        """
+        parts = []
+        pos = 0
+        for m in re.finditer(MetricsRelabeler.referenceRegEx, replacement):
+            parts.append(replacement[pos : m.start()])
+            if m.group(1):
+                parts.append("$")
+            else:
+                name = m.group(2) or m.group(3)
+                parts.append((int(name) if name.isdigit() else name,))
+            pos = m.end()
+        parts.append(replacement[pos:])
+        return tuple(part for part in parts if part != "")
+
+    @staticmethod
+    def expand(match, replacement):
+        """expand a compiled replacement by the groups of a match
+
+        Args:
+            match (re.Match): match of the regex of a rule
+            replacement (tuple): replacement parts, see `compileReplacement`
+
+        Returns:
+            str: expanded replacement
+        """
+        expanded = []
+        for part in replacement:
+            if type(part) is str:
+                expanded.append(part)
+                continue
+            try:
+                value = match.group(part[0])
+            except IndexError:
+                value = None
+            if value:
+                expanded.append(value)
+        return "".join(expanded)
+
+    def relabel(self, metricName, labels):
+        """apply all rules to a series
+
+        Args:
+            metricName (str): name of the series
+            labels (dict): labels of the series – will not be modified
+
+        Returns:
+            tuple: new metric name and labels, `None` if the series got dropped
+        """
+        labels = dict(labels)
+        labels["__name__"] = metricName
+        for action, sources, separator, regex, target, replacement in self.rules:
+            if action in ("replace", "keep", "drop"):
+                match = regex.fullmatch(
+                    separator.join(labels.get(s, "") for s in sources)
+                )
+                if action == "keep":
+                    if match is None:
+                        return None
+                elif action == "drop":
+                    if match is not None:
+                        return None
+                elif match is not None:
+                    value = self.expand(match, replacement)
+                    if value:
+                        labels[target] = value
+                    else:
+                        labels.pop(target, None)
+            elif action == "labelmap":
+                for name, value in list(labels.items()):
+                    match = regex.fullmatch(name)
+                    if match is not None:
+                        labels[self.expand(match, replacement)] = value
+            else:
+                keep = action == "labelkeep"
+                labels = {
+                    name: value
+                    for name, value in labels.items()
+                    if name == "__name__" or (regex.fullmatch(name) is not None) == keep
+                }
+        metricName = labels.pop("__name__", "")
+        if not metricName:
+            logger.warning(
+                "Relabeling removed the metric name of a series, dropping it."
+            )
+            return None
+        return metricName, labels
+
+
+class RollingWindow:
+    """Fixed-size window over the last values of a series
+
+    The values are kept in a ring buffer, so appending is O(1). Sum and mean are
+    kept incrementally, minimum and maximum by monotonic deques.
+    """
+
+    statistics = ("min", "max", "mean", "sum")
+
+    def __init__(self, size):
+        """initialize the window
+
+        Args:
+            size (int): number of values to keep
+
+        Raises:
+            ValueError: if size is lower than 1
+        """
+        if size < 1:
+            raise ValueError("A rolling window has to hold at least one value!")
+        self.size = size
+        self.values = array("d", bytes(8 * size))
+        self.count = 0
+        self.total = 0.0
+        self._min = deque()
+        self._max = deque()
+
+    def __len__(self):
+        """count values in window
+
+        Returns:
+            int: number of values currently in the window
+        """
+        return min(self.count, self.size)
+
+    def append(self, value):
+        """append a value, dropping the oldest one if the window is full
+
+        Args:
+            value (number|str): value to append
+        """
+        if type(value) is str:
+            value = MetricsCollection.parseValue(value)
+        value = float(value)
+        seq = self.count
+        pos = seq % self.size
+        if seq >= self.size:
+            self.total -= self.values[pos]
+        self.values[pos] = value
+        self.total += value
+        self.count = seq + 1
+        if pos == self.size - 1:
+            # avoid accumulating floating point errors once per round
+            self.total = math.fsum(self.values)
+
+        expired = seq - self.size
+        while self._min and self._min[-1][1] >= value:
+            self._min.pop()
+        self._min.append((seq, value))
+        if self._min[0][0] <= expired:
+            self._min.popleft()
+        while self._max and self._max[-1][1] <= value:
+            self._max.pop()
+        self._max.append((seq, value))
+        if self._max[0][0] <= expired:
+            self._max.popleft()
+
+    def min(self):
+        """minimum of the window
+
+        Returns:
+            float: minimum value, `None` if window is empty
+        """
+        return self._min[0][1] if self._min else None
+
+    def max(self):
+        """maximum of the window
+
+        Returns:
+            float: maximum value, `None` if window is empty
+        """
+        return self._max[0][1] if self._max else None
+
+    def sum(self):
+        """sum of the window
+
+        Returns:
+            float: sum of values, `None` if window is empty
+        """
+        return self.total if self.count else None
+
+    def mean(self):
+        """arithmetic mean of the window
+
+        Returns:
+            float: mean value, `None` if window is empty
+        """
+        return self.total / len(self) if self.count else None
+
+
+class MetricsDirectory:
+    """Metrics of all exposition files in a directory
+
+    Every call to `refresh` re-parses only files whose modification time or size
+    changed and whose content hash differs. The series contributed by each file are
+    tracked, so changed and deleted files are applied to the combined collection
+    incrementally. If multiple files contain the same series, `HELP` or `TYPE`, the
+    file with the last name in order wins – also after files changed or got deleted.
+    """
+
+    def __init__(self, path, pattern="*.prom", typedValues=False):
+        """initialize the directory
+
+        Args:
+            path (str): directory holding the exposition files
+            pattern (str): glob pattern of files to load (default: `"*.prom"`)
+            typedValues (bool): parse values into numbers, see `MetricsCollection`
+                                (default: `False`)
+        """
+        self.path = path
+        self.pattern = pattern
+        self.typedValues = typedValues
+        self.collection = MetricsCollection(typedValues=typedValues)
+        self.files = {}
+        self.contributions = {}
+        self._contributors = {}
+        self._families = {}
+
+    def refresh(self):
+        """apply changed, new and deleted files to the collection
+
+        Returns:
+            bool: `True` if any file changed
+        """
+        changed = False
+        seen = set()
+        for entry in sorted(os.scandir(self.path), key=lambda e: e.name):
+            if not entry.is_file() or not fnmatch.fnmatch(entry.name, self.pattern):
+                continue
+            seen.add(entry.name)
+            stat = entry.stat()
+            known = self.files.get(entry.name)
+            if (
+                known is not None
+                and known[0] == stat.st_mtime_ns
+                and known[1] == stat.st_size
+            ):
+                continue
+            with open(entry.path, "rb") as f:
+                data = f.read()
+            digest = hashlib.blake2b(data, digest_size=16).digest()
+            self.files[entry.name] = (stat.st_mtime_ns, stat.st_size, digest)
+            if known is not None and known[2] == digest:
+                continue
+            logger.debug(f"Loading changed metrics file “{entry.name}”.")
+            self._apply(entry.name, data.decode())
+            changed = True
+        for name in [name for name in self.files if name not in seen]:
+            logger.debug(f"Removing metrics of deleted file “{name}”.")
+            del self.files[name]
+            self._apply(name, None)
+            changed = True
+        return changed
+
+    def _apply(self, fileName, content):
+        """replace the contribution of a file
+
+        Args:
+            fileName (str): name of the file
+            content (str): new content of the file, `None` if deleted
+        """
+        old = self.contributions.pop(fileName, {})
+        new = {}
+        if content is not None:
+            loaded = MetricsCollection(typedValues=self.typedValues)
+            loaded.load(content)
+            for metric in loaded.families():
+                new[metric.name] = {i.seriesKey(): i.value for i in metric.instances}
+                self._families.setdefault(metric.name, {})[fileName] = (
+                    metric.helpText,
+                    metric.type,
+                )
+                self.collection.ensureMetric(metric.name)
+                self._applyMetadata(metric.name)
+            self.contributions[fileName] = new
+
+        for metricName, series in new.items():
+            target = self.collection.metrics[metricName]
+            for key, value in series.items():
+                contributors = self._contributors.setdefault((metricName, key), set())
+                contributors.add(fileName)
+                if max(contributors) == fileName:
+                    target.addMetric(value, dict(key[1]), key[0])
+
+        for metricName, series in old.items():
+            kept = new.get(metricName, {})
+            for key in series:
+                if key in kept:
+                    continue
+                contributors = self._contributors[(metricName, key)]
+                contributors.discard(fileName)
+                target = self.collection.metrics[metricName]
+                if not contributors:
+                    del self._contributors[(metricName, key)]
+                    target.removeMetric(dict(key[1]), key[0])
+                elif fileName > max(contributors):
+                    # the value of the remaining file loaded last applies again
+                    owner = max(contributors)
+                    value = self.contributions[owner][metricName][key]
+                    target.addMetric(value, dict(key[1]), key[0])
+            if metricName not in new:
+                files = self._families[metricName]
+                del files[fileName]
+                if files:
+                    self._applyMetadata(metricName)
+                else:
+                    del self._families[metricName]
+                    self.collection.removeMetrics(metricName)
+
+    def _applyMetadata(self, metricName):
+        """set `HELP` and `TYPE` of a metric from the files declaring them
+
+        Like for series, the declaration of the file loaded last wins.
+
+        Args:
+            metricName (str): name of the metric
+        """
+        files = self._families[metricName]
+        target = self.collection.metrics[metricName]
+        helpText = metricType = None
+        for fileName in sorted(files):
+            fileHelp, fileType = files[fileName]
+            if fileHelp is not None:
+                helpText = fileHelp
+            if fileType is not None:
+                metricType = fileType
+        if helpText != target.helpText:
+            target.setHelp(helpText)
+        if metricType != target.type:
+            target.setType(metricType)
+
+    def __str__(self):
+        """string representation
+
+        Returns:
+            str: prometheus metrics data of all files
+        """
+        return str(self.collection)
+
+
+class MetricsView:
+    """Renamed or relabeled view of a metrics collection
+
+    The view holds no instances on its own. It renders the current state of the
+    collection and applies the name prefix, label renames, constant labels and relabel
+    rules while rendering, family by family – so exposing one collection for multiple
+    tenants or namespaces does not copy it.
+    """
+
+    class _Families:
+        """prepared metrics transformed lazily while the template iterates them"""
+
+        def __init__(self, view, metrics):
+            """initialize the families
+
+            Args:
+                view (MetricsView): view to apply
+                metrics (dict): prepared metrics of the collection
+            """
+            self.view = view
+            self.metrics = metrics
+
+        def items(self):
+            """iterate the transformed families
+
+            Yields:
+                tuple: prefixed metric name and prepared metric with transformed instances
+            """
+            for name, details in self.metrics.items():
+                instances = self.view.transform(details["instances"])
+                yield self.view.prefix + name, dict(details, instances=instances)
+
+    def __init__(
+        self, collection, prefix="", labels=None, labelMap=None, relabeler=None
+    ):
+        """initialize the view
+
+        Args:
+            collection (MetricsCollection): collection to view
+            prefix (str): prefix for all metric names (default: `""`)
+            labels (dict): constant labels to add to all instances – labels of instances
+                           clashing with them are kept as `exported_<label>` (default: `None`)
+            labelMap (dict): label names to rename, applied before adding the constant
+                             labels (default: `None`)
+            relabeler (MetricsRelabeler): relabel rules applied last, they see the
+                                          prefixed sample names but must not change
+                                          them, since HELP and TYPE are rendered per
+                                          family (default: `None`)
+
+        Raises:
+            ValueError: if a relabel rule targets the `__name__` label
+        """
+        if relabeler is not None and any(
+            rule[4] == "__name__" for rule in relabeler.rules
+        ):
+            raise ValueError(
+                "Relabel rules of a view must not target “__name__”, use the prefix of the view instead!"
+            )
+        self.collection = collection
+        self.prefix = prefix
+        self.labels = dict(labels or {})
+        self.labelMap = dict(labelMap or {})
+        self.relabeler = relabeler
+
+    def transform(self, instances):
+        """apply the view to instances
+
+        Args:
+            instances (list): instances or samples of the collection
+
+        Returns:
+            list: transformed samples – the instances themselves if the view changes
+                  nothing
+        """
+        if not (self.prefix or self.labels or self.labelMap or self.relabeler):
+            return instances
+        samples = []
+        for i in instances:
+            name = self.prefix + i.name
+            labels = i.labels
+            if self.labelMap:
+                labels = {self.labelMap.get(k, k): v for k, v in labels.items()}
+            if self.labels:
+                labels = {
+                    (f"exported_{k}" if k in self.labels else k): v
+                    for k, v in labels.items()
+                }
+                labels.update(self.labels)
+            if self.relabeler is not None:
+                relabeled = self.relabeler.relabel(name, labels)
+                if relabeled is None:
+                    continue
+                if relabeled[0] != name:
+                    logger.warning(
+                        f"Relabeling renamed “{name}” to “{relabeled[0]}” in a view, keeping the name."
+                    )
+                labels = relabeled[1]
+            samples.append(Sample(name, labels, i.value))
+        return samples
+
+    def render(self, include=None, exclude=None, labelMatchers=None):
+        """render (a selection of) the metrics of the collection through the view
+
+        Args:
+            include (str|list): name prefix(es) of metrics to render, without the prefix
+                                of the view (default: `None`, so all)
+            exclude (str|list): name prefix(es) of metrics to skip (default: `None`)
+            labelMatchers (dict): only render instances matching the label matchers,
+                                  applied before the view (default: `None`)
+
+        Returns:
+            str: prometheus metrics data
+        """
+        collection = self.collection
+        metrics = collection._prepareRender(
+            collection.collect(), include, exclude, labelMatchers
+        )
+        return "".join(collection._stream(self._Families(self, metrics)))
+
+    def __str__(self):
+        """string representation
+
+        Returns:
+            str: prometheus metrics data of the view
+        """
+        return self.render()
+
+
+class MetricsWal:
+    """Append-only write-ahead log for the state of a `MetricsCollection`
+
+    Records are appended to `<path>.wal` in a compact binary format: a series is
+    defined once per log file, each value afterwards takes 13 bytes. Records are
+    buffered and written with a single `fsync` per batch, so records of the last
+    batch can be lost on a crash. Once the log exceeds `maxBytes`, it is compacted
+    into `<path>.snapshot` – in background for thread safe collections.
+    """
+
+    DEFINE = 0
+    VALUE = 1
+    REMOVE = 2
+
+    _define = struct.Struct("<BII")
+    _value = struct.Struct("<BId")
+    _remove = struct.Struct("<BI")
+
+    def __init__(self, path, syncInterval=1.0, syncBytes=65536, maxBytes=64 << 20):
+        """initialize write-ahead log
+
+        Args:
+            path (str): base path of the log files
+            syncInterval (float): seconds after which buffered records are written and
+                                  synced on the next append (default: `1.0`)
+            syncBytes (int): size of buffered records that triggers writing and syncing
+                             (default: `65536`)
+            maxBytes (int): size of the log that triggers compaction (default: 64 MiB)
+        """
+        self.path = path
+        self.walPath = f"{path}.wal"
+        self.oldPath = f"{path}.wal.old"
+        self.snapshotPath = f"{path}.snapshot"
+        self.syncInterval = syncInterval
+        self.syncBytes = syncBytes
+        self.maxBytes = maxBytes
+        self.collection = None
+        self._ids = {}
+        self._nextId = 0
+        self._buffer = bytearray()
+        self._written = 0
+        self._lastSync = time.monotonic()
+        self._lock = threading.Lock()
+        self._file = None
+        self._compaction = None
+
+    @classmethod
+    def encodeDefinition(cls, seriesId, metric, instance):
+        """encode the definition record of a series
+
+        Args:
+            seriesId (int): id of the series within the log file
+            metric (MetricsCollection.Metric): metric of the series
+            instance (MetricInstance): instance of the series
+
+        Returns:
+            bytes: definition record
+        """
+        payload = json.dumps(
+            {
+                "n": metric.name,
+                "s": instance.suffix,
+                "l": instance.labels,
+                "t": metric.type,
+                "h": metric.helpText,
+            },
+            separators=(",", ":"),
+        ).encode()
+        return cls._define.pack(cls.DEFINE, seriesId, len(payload)) + payload
+
+    @staticmethod
+    def numeric(value):
+        """value of an instance as float for the log
+
+        Args:
+            value (mixed): value of an instance
+
+        Returns:
+            float: value, `None` if not numeric
+        """
+        if type(value) is str:
+            try:
+                value = MetricsCollection.parseValue(value)
+            except ValueError:
+                return None
+        try:
+            return float(value)
+        except (TypeError, ValueError):
+            return None
+
+    def append(self, metric, instance):
+        """log the current value of an instance
+
+        Args:
+            metric (MetricsCollection.Metric): metric of the instance
+            instance (MetricInstance): instance to log
+        """
+        value = self.numeric(instance.value)
+        if value is None:
+            logger.warning(
+                f"Value `{instance.value}` of “{instance.name}” is not numeric and not logged."
+            )
+            return
+        with self._lock:
+            seriesId = self._seriesId(metric, instance)
+            self._buffer += self._value.pack(self.VALUE, seriesId, value)
+            compact = self._maybeSync()
+        if compact:
+            self.compact(wait=not self.collection.threadSafe)
+
+    def remove(self, metric, instance):
+        """log the removal of an instance
+
+        Series not defined in the current log file yet, e.g. restored from the
+        snapshot, are defined first – so the removal is replayed on top of the
+        snapshot, too.
+
+        Args:
+            metric (MetricsCollection.Metric): metric of the instance
+            instance (MetricInstance): removed instance
+        """
+        with self._lock:
+            seriesId = self._seriesId(metric, instance)
+            del self._ids[(metric.name, instance.seriesKey())]
+            self._buffer += self._remove.pack(self.REMOVE, seriesId)
+            compact = self._maybeSync()
+        if compact:
+            self.compact(wait=not self.collection.threadSafe)
+
+    def _seriesId(self, metric, instance):
+        """id of a series in the current log file, defining it if necessary
+
+        Ids are never reused within a log file, also not for removed series.
+        `self._lock` has to be held.
+
+        Args:
+            metric (MetricsCollection.Metric): metric of the instance
+            instance (MetricInstance): instance of the series
+
+        Returns:
+            int: id of the series
+        """
+        key = (metric.name, instance.seriesKey())
+        seriesId = self._ids.get(key)
+        if seriesId is None:
+            seriesId = self._ids[key] = self._nextId
+            self._nextId += 1
+            self._buffer += self.encodeDefinition(seriesId, metric, instance)
+        return seriesId
+
+    def _maybeSync(self):
+        """write buffered records if the batch is full or old enough
+
+        `self._lock` has to be held.
+
+        Returns:
+            bool: `True` if the log has to be compacted
+        """
+        if (
+            len(self._buffer) >= self.syncBytes
+            or time.monotonic() - self._lastSync >= self.syncInterval
+        ):
+            self._sync()
+            if self._written >= self.maxBytes and self._compaction is None:
+                self._compaction = True
+                return True
+        return False
+
+    def _sync(self):
+        """write and sync buffered records, `self._lock` has to be held"""
+        if self._buffer:
+            self._file.write(self._buffer)
+            self._written += len(self._buffer)
+            self._buffer = bytearray()
+            self._file.flush()
+            os.fsync(self._file.fileno())
+        self._lastSync = time.monotonic()
+
+    def flush(self):
+        """write and sync all buffered records"""
+        with self._lock:
+            self._sync()
+
+    def close(self):
+        """flush the log and wait for a running compaction"""
+        compaction = self._compaction
+        if isinstance(compaction, threading.Thread):
+            compaction.join()
+        with self._lock:
+            self._sync()
+            self._file.close()
+
+    @classmethod
+    def replay(cls, path, collection):
+        """apply a log or snapshot file to a collection
+
+        Args:
+            path (str): file to replay
+            collection (MetricsCollection): collection to restore into
+
+        Returns:
+            int: number of records replayed
+        """
+        if not os.path.exists(path):
+            return 0
+        with open(path, "rb") as f:
+            data = f.read()
+        series = {}
+        latest = {}
+        records = 0
+        pos = 0
+        size = len(data)
+        valueUnpack = cls._value.unpack_from
+        while pos < size:
+            kind = data[pos]
+            if kind == cls.VALUE:
+                if pos + 13 > size:
+                    break
+                _, seriesId, value = valueUnpack(data, pos)
+                latest[seriesId] = value
+                pos += 13
+            elif kind == cls.DEFINE:
+                if pos + 9 > size:
+                    break
+                _, seriesId, length = cls._define.unpack_from(data, pos)
+                if pos + 9 + length > size:
+                    break
+                definition = json.loads(data[pos + 9 : pos + 9 + length])
+                pos += 9 + length
+                collection.ensureMetric(
+                    definition["n"],
+                    helpText=definition["h"],
+                    metricType=definition["t"],
+                )
+                series[seriesId] = (
+                    collection.metrics[definition["n"]],
+                    definition["l"],
+                    definition["s"],
+                )
+            elif kind == cls.REMOVE:
+                if pos + 5 > size:
+                    break
+                _, seriesId = cls._remove.unpack_from(data, pos)
+                pos += 5
+                metric, labels, suffix = series.pop(seriesId)
+                if seriesId in latest:
+                    metric.addMetric(latest.pop(seriesId), labels, suffix)
+                metric.removeMetric(labels, suffix)
+            else:
+                logger.error(f"Unknown record at byte {pos} of “{path}”.")
+                break
+            records += 1
+        if pos < size:
+            logger.warning(f"Ignoring incomplete records at the end of “{path}”.")
+        for seriesId, value in latest.items():
+            metric, labels, suffix = series[seriesId]
+            if value.is_integer() and abs(value) <= MetricsCollection.maxExactInteger:
+                value = int(value)
+            metric.addMetric(value, labels, suffix)
+        return records
+
+    def restore(self, collection):
+        """restore the logged state into a collection and start logging
+
+        Snapshot, a log left over by an interrupted compaction and the log are
+        replayed, then the state is compacted into a fresh snapshot.
+
+        Args:
+            collection (MetricsCollection): collection to restore into
+        """
+        self.collection = collection
+        self._ids = {}
+        self._nextId = 0
+        records = 0
+        for path in (self.snapshotPath, self.oldPath, self.walPath):
+            records += self.replay(path, collection)
+        logger.debug(f"Restored {records} records from “{self.path}”.")
+        MetricsCollection.writeAtomically(self.snapshotPath, self.snapshot(), sync=True)
+        for path in (self.oldPath, self.walPath):
+            if os.path.exists(path):
+                os.remove(path)
+        self._file = open(self.walPath, "ab")
+
+    def snapshot(self):
+        """encode the current state of the collection
+
+        Returns:
+            bytes: snapshot in the format of the log
+        """
+        data = bytearray()
+        seriesId = 0
+        for metric in self.collection.families():
+            with metric.lock:
+                instances = [(i, i.value) for i in metric.instances]
+            for instance, value in instances:
+                value = self.numeric(value)
+                if value is None:
+                    continue
+                data += self.encodeDefinition(seriesId, metric, instance)
+                data += self._value.pack(self.VALUE, seriesId, value)
+                seriesId += 1
+        return bytes(data)
+
+    def compact(self, wait=True):
+        """replace log records by a snapshot of the collection
+
+        The log is rotated first, so all records logged while the snapshot is taken
+        end up in the new log. Replaying them on top of the snapshot is idempotent.
+
+        Args:
+            wait (bool): compact synchronously, otherwise in a background thread
+                         (default: `True`)
+        """
+        compaction = self._compaction
+        if isinstance(compaction, threading.Thread):
+            compaction.join()
+        with self._lock:
+            self._compaction = True
+            self._sync()
+            self._file.close()
+            if os.path.exists(self.walPath):
+                os.replace(self.walPath, self.oldPath)
+            self._file = open(self.walPath, "ab")
+            self._ids = {}
+            self._nextId = 0
+            self._written = 0
+        if wait:
+            self._compact()
+        else:
+            self._compaction = threading.Thread(
+                target=self._compact, name="MetricsWalCompaction", daemon=True
+            )
+            self._compaction.start()
+
+    def _compact(self):
+        """write the snapshot and drop the rotated log"""
+        try:
+            MetricsCollection.writeAtomically(
+                self.snapshotPath, self.snapshot(), sync=True
+            )
+            os.remove(self.oldPath)
+            logger.debug(f"Compacted write-ahead log “{self.path}”.")
+        finally:
+            self._compaction = None
+
+
+class Collector:
+    """Callback collecting metrics when a collection is rendered
+
+    Results are kept, so they can be reused within `minInterval` or if a later
+    run exceeds the timeout. A collector never runs twice at the same time.
+    """
+
+    def __init__(self, callback, name, timeout=5.0, minInterval=0, typedValues=False):
+        """initialize collector
+
+        Args:
+            callback (callable): function taking a `MetricsCollection` to add metrics to
+            name (str): name of the collector
+            timeout (float): seconds to wait for a run (default: `5.0`)
+            minInterval (float): seconds to reuse the last result (default: `0`)
+            typedValues (bool): `typedValues` of the collections passed to the callback
+                                (default: `False`)
+        """
+        self.callback = callback
+        self.name = name
+        self.timeout = timeout
+        self.minInterval = minInterval
+        self.typedValues = typedValues
+        self.result = None
+        self.collectedAt = None
+        self.future = None
+
+    def run(self):
+        """run the callback on a fresh collection
+
+        Returns:
+            MetricsCollection: collected metrics
+        """
+        collection = MetricsCollection(typedValues=self.typedValues)
+        self.callback(collection)
+        return collection
+
+    def submit(self, executor, now):
+        """submit a run if the last result is outdated
+
+        Args:
+            executor (concurrent.futures.Executor): executor to run the callback
+            now (float): current `time.monotonic()`
+
+        Returns:
+            bool: `True` if a run is pending and has to be waited for
+        """
+        if (
+            self.future is None
+            and self.collectedAt is not None
+            and now - self.collectedAt < self.minInterval
+        ):
+            return False
+        if self.future is None:
+            self.future = executor.submit(self.run)
+        return True
+
+    def wait(self, started):
+        """wait for the pending run until the timeout is reached
+
+        Args:
+            started (float): `time.monotonic()` the render started
+
+        Returns:
+            bool: `True` if a new result is available
+        """
+        future = self.future
+        try:
+            result = future.result(
+                timeout=max(0, self.timeout - (time.monotonic() - started))
+            )
+        except TimeoutError:
+            logger.warning(
+                f"Collector “{self.name}” did not finish within {self.timeout} seconds, using last result."
+            )
+            return False
+        except Exception as e:
+            logger.error(f"Collector “{self.name}” failed: {e}")
+            self.future = None
+            return False
+        self.result = result
+        self.collectedAt = time.monotonic()
+        self.future = None
+        return True
+
+
+class Observations:
+    """Observed values of one histogram or summary series
+
+    Observing a value only counts it into the matching bucket and adds it to sum
+    and count under a lock held for a few operations – the lock of the metric is
+    not taken, the count is part of the version of the collection instead. The
+    cumulative values are written into the instances of the metric when it is
+    rendered.
+    """
+
+    defaultBuckets = (
+        0.005,
+        0.01,
+        0.025,
+        0.05,
+        0.1,
+        0.25,
+        0.5,
+        1.0,
+        2.5,
+        5.0,
+        10.0,
+    )
+
+    class Timer:
+        """context manager observing the duration of its block in seconds"""
+
+        def __init__(self, observations):
+            """initialize timer
+
+            Args:
+                observations (Observations): observations to record the duration in
+            """
+            self.observations = observations
+            self.start = None
+
+        def __enter__(self):
+            self.start = time.perf_counter_ns()
+            return self
+
+        def __exit__(self, *exc):
+            self.observations.observe((time.perf_counter_ns() - self.start) / 1e9)
+            return False
+
+    def __init__(self, metric, bounds=None):
+        """initialize observations
+
+        Args:
+            metric (MetricsCollection.Metric): metric holding the instances of the series
+            bounds (list): sorted upper bounds of histogram buckets without `+Inf`,
+                           `None` for summaries (default: `None`)
+        """
+        self.metric = metric
+        self.bounds = list(bounds) if bounds is not None else None
+        self.counts = [0] * (len(self.bounds) + 1) if bounds is not None else None
+        self.sum = 0.0
+        self.count = 0
+        self.instances = []
+        self.lock = threading.Lock()
+        self.synced = 0
+
+    def observe(self, value):
+        """observe a value
+
+        Args:
+            value (number): value to observe
+        """
+        if self.bounds is not None:
+            idx = bisect_left(self.bounds, value)
+            with self.lock:
+                self.counts[idx] += 1
+                self.sum += value
+                self.count += 1
+        else:
+            with self.lock:
+                self.sum += value
+                self.count += 1
+
+    def time(self):
+        """context manager observing the duration of its block
+
+        Returns:
+            Observations.Timer: context manager
+        """
+        return self.Timer(self)
+
+    def sync(self):
+        """write the cumulative values into the instances of the series"""
+        if self.synced == self.count:
+            return
+        with self.lock:
+            counts = list(self.counts) if self.counts is not None else []
+            total = self.sum
+            count = self.count
+        cumulative = 0
+        for instance, bucketCount in zip(self.instances, counts):
+            cumulative += bucketCount
+            instance.setValue(cumulative)
+        self.instances[-2].setValue(total)
+        self.instances[-1].setValue(count)
+        self.synced = count
+
+
+class Meter:
+    """Exponentially weighted moving rates of events of one series
+
+    Marking events only adds to an integer under a lock held for a single operation.
+    The 1, 5 and 15 minute rates are decayed lazily: when the meter gets rendered,
+    every full tick of `tickInterval` seconds passed since the last update is applied
+    at once, spreading the events counted in between evenly over those ticks. Ticks
+    are counted on the monotonic clock for all meters alike, see `tickCount`, so the
+    rates only change when the version of their collection does. The rates are written
+    into one gauge instance per window.
+    """
+
+    tickInterval = 5.0
+    windows = (("1m", 60.0), ("5m", 300.0), ("15m", 900.0))
+
+    def __init__(self, metric):
+        """initialize meter
+
+        Args:
+            metric (MetricsCollection.Metric): metric holding the instances of the series
+        """
+        self.metric = metric
+        self.uncounted = 0
+        self.count = 0
+        self.rates = [0.0] * len(self.windows)
+        self.decays = [math.exp(-self.tickInterval / w) for _, w in self.windows]
+        self.initialized = False
+        self.lastTick = self.tickCount()
+        self.instances = []
+        self.lock = threading.Lock()
+
+    @classmethod
+    def tickCount(cls, now=None):
+        """number of the current tick
+
+        Args:
+            now (float): monotonic time (default: `None`, so `time.monotonic()`)
+
+        Returns:
+            int: ticks passed on the monotonic clock
+        """
+        if now is None:
+            now = time.monotonic()
+        return int(now // cls.tickInterval)
+
+    def mark(self, n=1):
+        """mark events
+
+        Args:
+            n (int): number of events (default: `1`)
+        """
+        with self.lock:
+            self.uncounted += n
+
+    def tick(self, now=None):
+        """apply the ticks passed since the last update to the rates
+
+        Args:
+            now (float): monotonic time (default: `None`, so `time.monotonic()`)
+
+        Returns:
+            list: rates per second of the windows
+        """
+        tick = self.tickCount(now)
+        with self.lock:
+            ticks = tick - self.lastTick
+            if ticks < 1:
+                return list(self.rates)
+            self.lastTick = tick
+            count = self.uncounted
+            self.uncounted = 0
+            self.count += count
+            rate = count / (ticks * self.tickInterval)
+            if self.initialized:
+                for idx, decay in enumerate(self.decays):
+                    remaining = decay**ticks
+                    self.rates[idx] = self.rates[idx] * remaining + rate * (
+                        1 - remaining
+                    )
+            else:
+                self.rates = [rate] * len(self.windows)
+                self.initialized = True
+            return list(self.rates)
+
+    def sync(self, now=None):
+        """write the rates into the instances of the series
+
+        Args:
+            now (float): monotonic time (default: `None`, so `time.monotonic()`)
+        """
+        for instance, rate in zip(self.instances, self.tick(now)):
+            if instance.value != rate:
+                instance.setValue(rate)
+
+
+class MetricsScraper:
+    """Concurrent scraper of Prometheus exporters
+
+    All targets are fetched by asyncio with a bounded number of concurrent requests
+    and a timeout per target. Connections are kept alive and reused by later requests
+    to the same host – also across scrapes, as long as the same event loop is used.
+    Each payload is loaded as soon as it arrived and merged into one collection with
+    `job` and `instance` labels, next to the `up` and `scrape_duration_seconds` series
+    of every target. Series a target stopped exposing or of a failed target are removed
+    from the collection, like Prometheus marks them stale.
+
+    The HTTP/1.1 client supports `Content-Length`, chunked and `gzip` encoded bodies,
+    skips informational `1xx` responses and follows up to `maxRedirects` redirects.
+    """
+
+    maxRedirects = 10
+    redirectStatus = (301, 302, 303, 307, 308)
+
+    def __init__(
+        self,
+        targets,
+        job="scrape",
+        concurrency=16,
+        timeout=10.0,
+        relabeler=None,
+        typedValues=False,
+    ):
+        """initialize the scraper
+
+        Args:
+            targets (list): URLs of the exporters, e.g. `http://localhost:9100/metrics`
+            job (str): value of the `job` label (default: `"scrape"`)
+            concurrency (int): maximum number of concurrent requests (default: `16`)
+            timeout (float): seconds a single target may take (default: `10.0`)
+            relabeler (MetricsRelabeler): relabel rules applied while loading the
+                                          payloads (default: `None`)
+            typedValues (bool): parse the scraped values, see `MetricsCollection`
+                                (default: `False`)
+        """
+        self.targets = list(targets)
+        self.job = job
+        self.concurrency = concurrency
+        self.timeout = timeout
+        self.relabeler = relabeler
+        self.typedValues = typedValues
+        self._connections = {}
+        self._loop = None
+        self._series = {}
+
+    async def scrape(self, collection=None):
+        """scrape all targets once
+
+        Args:
+            collection (MetricsCollection): collection to merge the scraped metrics into
+                                            (default: `None`, so a new one)
+
+        Returns:
+            MetricsCollection: the scraped metrics
+        """
+        loop = asyncio.get_running_loop()
+        if self._loop is not loop:
+            # streams are bound to their event loop
+            self._connections = {}
+            self._loop = loop
+        if collection is None:
+            collection = MetricsCollection(typedValues=self.typedValues)
+        collection.ensureMetric(
+            "up",
+            helpText="1 if the target was scraped successfully, 0 otherwise",
+            metricType="gauge",
+        )
+        collection.ensureMetric(
+            "scrape_duration_seconds",
+            helpText="duration of the scrape of the target in seconds",
+            metricType="gauge",
+        )
+        semaphore = asyncio.Semaphore(self.concurrency)
+        await asyncio.gather(
+            *(self._scrapeTarget(url, collection, semaphore) for url in self.targets)
+        )
+        return collection
+
+    async def close(self):
+        """close all connections kept alive"""
+        connections, self._connections = self._connections, {}
+        for idle in connections.values():
+            for _, writer in idle:
+                writer.close()
+                try:
+                    await writer.wait_closed()
+                except (ConnectionError, OSError):
+                    pass
+
+    async def _scrapeTarget(self, url, collection, semaphore):
+        """scrape a single target and merge its metrics
+
+        Args:
+            url (str): URL of the target
+            collection (MetricsCollection): collection to merge into
+            semaphore (asyncio.Semaphore): limits the concurrent requests
+        """
+        target = urlsplit(url)
+        labels = {"job": self.job, "instance": target.netloc}
+        async with semaphore:
+            started = time.perf_counter()
+            try:
+                payload = await asyncio.wait_for(self._fetch(target), self.timeout)
+                scraped = MetricsCollection(typedValues=self.typedValues)
+                scraped.load(payload.decode("utf-8"), relabeler=self.relabeler)
+                up = 1
+            except asyncio.TimeoutError:
+                logger.warning(f"Scraping “{url}” timed out after {self.timeout}s.")
+                up = 0
+            except (
+                OSError,
+                ValueError,
+                EOFError,
+                asyncio.IncompleteReadError,
+                zlib.error,
+            ) as e:
+                logger.warning(f"Scraping “{url}” failed: {e}")
+                up = 0
+            duration = time.perf_counter() - started
+        current = set()
+        if up:
+            collection.mergeCollection(scraped, labels)
+            for m in scraped.families():
+                for i in m.instances:
+                    exported = MetricsCollection.exportLabels(i.labels, labels)
+                    current.add((m.name, i.suffix, tuple(sorted(exported.items()))))
+        for metricName, suffix, key in self._series.get(url, set()) - current:
+            collection.removeMetric(metricName, dict(key), suffix)
+        self._series[url] = current
+        collection.addMetric("up", up, labels)
+        collection.addMetric("scrape_duration_seconds", duration, labels)
+
+    async def _fetch(self, target):
+        """fetch the body of a target, following redirects
+
+        Args:
+            target (urllib.parse.SplitResult): URL of the target
+
+        Returns:
+            bytes: (decompressed) body of the response
+
+        Raises:
+            ValueError: if the server did not answer with status 200 or by invalid HTTP
+            OSError: if the connection failed
+        """
+        for _ in range(self.maxRedirects + 1):
+            status, headers, body = await self._request(target)
+            if status not in self.redirectStatus or "location" not in headers:
+                break
+            target = urlsplit(urljoin(target.geturl(), headers["location"]))
+        else:
+            raise ValueError(f"more than {self.maxRedirects} redirects")
+        if status != 200:
+            raise ValueError(f"HTTP status {status}")
+        if headers.get("content-encoding") == "gzip":
+            body = zlib.decompress(body, 31)
+        return body
+
+    async def _request(self, target):
+        """send a GET request, on a kept alive connection if possible
+
+        A kept alive connection can have been closed by the server meanwhile, so the
+        request is retried once on a new connection if a reused one fails.
+
+        Args:
+            target (urllib.parse.SplitResult): URL to request
+
+        Returns:
+            tuple: status code, headers with lowercase names and body of the response
+
+        Raises:
+            ValueError: on invalid responses
+            OSError: if the connection failed
+        """
+        secure = target.scheme == "https"
+        host = target.hostname
+        port = target.port or (443 if secure else 80)
+        key = (host, port, secure)
+        path = target.path or "/"
+        if target.query:
+            path = f"{path}?{target.query}"
+        request = (
+            f"GET {path} HTTP/1.1\r\n"
+            f"Host: {target.netloc}\r\n"
+            "Accept: text/plain;version=0.0.4\r\n"
+            "Accept-Encoding: gzip\r\n"
+            "Connection: keep-alive\r\n\r\n"
+        ).encode("ascii")
+        while True:
+            idle = self._connections.get(key)
+            reused = bool(idle)
+            if reused:
+                reader, writer = idle.pop()
+            else:
+                reader, writer = await asyncio.open_connection(host, port, ssl=secure)
+            try:
+                writer.write(request)
+                await writer.drain()
+                status, headers, body, keepAlive = await self._readResponse(reader)
+            except (OSError, EOFError, asyncio.IncompleteReadError):
+                writer.close()
+                if reused:
+                    continue
+                raise
+            except BaseException:
+                # e.g. cancelled by the timeout, the connection is in an unknown state
+                writer.close()
+                raise
+            if keepAlive:
+                self._connections.setdefault(key, []).append((reader, writer))
+            else:
+                writer.close()
+            return status, headers, body
+
+    @staticmethod
+    async def _readResponse(reader):
+        """read a HTTP/1.1 response
+
+        Args:
+            reader (asyncio.StreamReader): stream to read from
+
+        Returns:
+            tuple: status code, headers with lowercase names, body and whether the
+                   connection can be reused
+
+        Raises:
+            ValueError: on invalid responses
+            EOFError: if the connection got closed before a response was sent
+        """
+        while True:
+            statusLine = await reader.readline()
+            if not statusLine:
+                raise EOFError("connection closed by the server")
+            parts = statusLine.decode("latin-1").split(None, 2)
+            if (
+                len(parts) < 2
+                or not parts[0].startswith("HTTP/1.")
+                or not parts[1].isdigit()
+            ):
+                raise ValueError(f"invalid status line {statusLine!r}")
+            status = int(parts[1])
+            headers = {}
+            while True:
+                line = await reader.readline()
+                if line in (b"\r\n", b"\n", b""):
+                    break
+                name, _, value = line.decode("latin-1").partition(":")
+                headers[name.strip().lower()] = value.strip()
+            if status == 101:
+                raise ValueError("unexpected switch of the protocol")
+            # informational responses like `100 Continue` precede the final one
+            if not 100 <= status < 200:
+                break
+        keepAlive = (
+            headers.get("connection", "").lower() != "close" and parts[0] != "HTTP/1.0"
+        )
+        if headers.get("transfer-encoding", "").lower() == "chunked":
+            chunks = []
+            while True:
+                size = int((await reader.readline()).split(b";")[0], 16)
+                if size == 0:
+                    # skip trailers
+                    while (await reader.readline()) not in (b"\r\n", b"\n", b""):
+                        pass
+                    break
+                chunks.append(await reader.readexactly(size))
+                await reader.readexactly(2)
+            body = b"".join(chunks)
+        elif "content-length" in headers:
+            body = await reader.readexactly(int(headers["content-length"]))
+        else:
+            body = await reader.read()
+            keepAlive = False
+        return status, headers, body, keepAlive
+
+
+class MetricsRateTracker:
+    """Per-second rates of counters across consecutive loads
+
+    Successive collections – e.g. scrapes of the same exporter – are fed into
+    `update`, which returns a collection of gauges holding the per-second rate of
+    every counter series since the previous update.
+    """
+
+    def __init__(self, suffix="_per_second"):
+        """initialize the rate tracker
+
+        Args:
+            suffix (str): suffix for the rate gauges, replacing the `_total` suffix of
+                          the counters (default: `"_per_second"`)
+        """
+        self.suffix = suffix
+        self.previous = {}
+        self.timestamp = None
+
+    def rateName(self, metricName):
+        """name of the rate gauge for a counter
+
+        Args:
+            metricName (str): name of the counter metric
+
+        Returns:
+            str: name of the rate gauge
+        """
+        if metricName.endswith("_total"):
+            metricName = metricName[: -len("_total")]
+        return metricName + self.suffix
+
+    def update(self, collection, timestamp=None):
+        """feed the next collection and compute rates
+
+        Rates are computed for every counter series also present in the previous
+        update. A value lower than the previous one is treated as counter reset, so
+        the whole current value is taken as increase.
+
+        Args:
+            collection (MetricsCollection): current state of the counters
+            timestamp (float): time of the collection in seconds (default: `time.time()`)
+
+        Returns:
+            MetricsCollection: gauges with the per-second rates – empty on first update
+        """
+        if timestamp is None:
+            timestamp = time.time()
+        rates = MetricsCollection()
+        elapsed = None
+        if self.timestamp is not None:
+            elapsed = timestamp - self.timestamp
+            if elapsed <= 0:
+                logger.error(
+                    f"Timestamp {timestamp} is not after last update at {self.timestamp}, no rates computed."
+                )
+                return rates
+        current = {}
+        for metric in collection.metrics.values():
+            if metric.type != "counter":
+                continue
+            rateName = self.rateName(metric.name)
+            for instance in metric.instances:
+                value = instance.value
+                if type(value) is str:
+                    value = MetricsCollection.parseValue(value)
+                key = (metric.name, instance.seriesKey())
+                current[key] = value
+                previous = self.previous.get(key)
+                if elapsed is None or previous is None:
+                    continue
+                increase = value - previous
+                if increase < 0:
+                    logger.debug(
+                        f"Counter reset detected for `{metric.name}` series {instance.labels}."
+                    )
+                    increase = value
+                if rateName not in rates.metrics:
+                    rates.ensureMetric(
+                        rateName,
+                        helpText=f"Per-second rate of {metric.name}",
+                        metricType="gauge",
+                    )
+                rates.metrics[rateName].addMetric(increase / elapsed, instance.labels)
+        self.previous = current
+        self.timestamp = timestamp
+        return rates
+
+
+class RecordingRule:
+    """Metric derived from other metrics of a collection
+
+    The derived instances are computed by a function of the input metrics. Since the
+    function is opaque, a change of an input only marks the rule as dirty and it gets
+    evaluated completely before the next rendering. `SumRecordingRule` and
+    `RatioRecordingRule` update only the affected derived instances instead.
+    """
+
+    def __init__(self, name, inputs, function=None, helpText=None, metricType="gauge"):
+        """initialize the rule
+
+        Args:
+            name (str): name of the derived metric
+            inputs (list): names of the input metrics
+            function (callable): called with the input `Metric` objects – `None` for
+                                 missing ones – returning `(labels, value)` pairs of the
+                                 derived instances (default: `None`)
+            helpText (str): help information of the derived metric (default: `None`)
+            metricType (str): type of the derived metric (default: `"gauge"`)
+        """
+        self.name = name
+        self.inputs = tuple(inputs)
+        self.function = function
+        self.helpText = helpText
+        self.metricType = metricType
+        self.dirty = True
+
+    @staticmethod
+    def number(value):
+        """numeric value of an instance
+
+        Non-numeric strings are logged and treated like a missing instance, so they do
+        not break the update of the input that was already stored.
+
+        Args:
+            value (mixed): value as stored in the instance
+
+        Returns:
+            int|float: parsed value, `None` for `None` and non-numeric strings
+        """
+        if type(value) is str:
+            try:
+                return MetricsCollection.parseValue(value)
+            except ValueError:
+                logger.warning(f"Recording rules ignore non-numeric value “{value}”.")
+                return None
+        return value
+
+    def update(self, collection, inputName, labels, suffix, previous, current):
+        """react on a changed input instance
+
+        Args:
+            collection (MetricsCollection): collection of the rule
+            inputName (str): name of the changed input metric
+            labels (dict): labels of the changed instance
+            suffix (str): suffix of the changed instance
+            previous (number): value before the change, `None` if the instance was added
+            current (number): value after the change, `None` if the instance was removed
+        """
+        self.dirty = True
+
+    def evaluate(self, collection):
+        """compute all derived instances
+
+        Args:
+            collection (MetricsCollection): collection of the rule
+        """
+        self.dirty = False
+        if self.function is None:
+            return
+        inputs = [collection.metrics.get(name) for name in self.inputs]
+        self.replace(collection, self.function(*inputs))
+
+    def replace(self, collection, results):
+        """replace the derived instances
+
+        Args:
+            collection (MetricsCollection): collection of the rule
+            results (iterable): `(labels, value)` pairs of the derived instances
+        """
+        derived = {
+            tuple(sorted(labels.items())): (labels, value) for labels, value in results
+        }
+        metric = collection.metrics.get(self.name)
+        if metric is not None:
+            for instance in list(metric.instances):
+                if tuple(sorted(instance.labels.items())) not in derived:
+                    collection.removeMetric(self.name, instance.labels, instance.suffix)
+        for labels, value in derived.values():
+            collection.addMetric(self.name, value, labels)
+
+    @staticmethod
+    def plainInstances(metric):
+        """instances of a metric without sample suffix
+
+        Args:
+            metric (Metric): metric to get the instances of, may be `None`
+
+        Returns:
+            list: tuples of labels and numeric value
+        """
+        if metric is None:
+            return []
+        with metric.lock:
+            instances = [
+                (i.labels, RecordingRule.number(i.value))
+                for i in metric.instances
+                if i.suffix == ""
+            ]
+        return [(labels, value) for labels, value in instances if value is not None]
+
+
+class SumRecordingRule(RecordingRule):
+    """Sum of a metric by labels, like `sum by (…)` of PromQL
+
+    Sums and member counts are kept per group, so a changed input instance just
+    applies its difference to the sum of its group.
+    """
+
+    def __init__(self, name, source, by=None, helpText=None, metricType="gauge"):
+        """initialize the rule
+
+        Args:
+            name (str): name of the derived metric
+            source (str): name of the metric to sum up
+            by (list): labels to keep, each combination of their values is summed up
+                       separately (default: `None`, so a single sum)
+            helpText (str): help information of the derived metric (default: `None`)
+            metricType (str): type of the derived metric (default: `"gauge"`)
+        """
+        super().__init__(name, [source], helpText=helpText, metricType=metricType)
+        self.by = tuple(by or ())
+        self.sums = {}
+        self.members = {}
+
+    def groupKey(self, labels):
+        """group of an input instance
+
+        Args:
+            labels (dict): labels of the input instance
+
+        Returns:
+            tuple: values of the grouping labels
+        """
+        return tuple(labels.get(label, "") for label in self.by)
+
+    def groupLabels(self, key):
+        """labels of a derived instance
+
+        Args:
+            key (tuple): values of the grouping labels
+
+        Returns:
+            dict: non-empty grouping labels
+        """
+        return {label: value for label, value in zip(self.by, key) if value != ""}
+
+    def update(self, collection, inputName, labels, suffix, previous, current):
+        """apply the difference of a changed input instance to the sum of its group
+
+        Args:
+            collection (MetricsCollection): collection of the rule
+            inputName (str): name of the changed input metric
+            labels (dict): labels of the changed instance
+            suffix (str): suffix of the changed instance, suffixed ones are ignored
+            previous (number): value before the change, `None` if the instance was added
+            current (number): value after the change, `None` if the instance was removed
+        """
+        if suffix:
+            return
+        key = self.groupKey(labels)
+        members = (
+            self.members.get(key, 0) + (current is not None) - (previous is not None)
+        )
+        if members == 0:
+            self.members.pop(key, None)
+            self.sums.pop(key, None)
+            collection.removeMetric(self.name, self.groupLabels(key))
+            return
+        self.members[key] = members
+        self.sums[key] = self.sums.get(key, 0) + (current or 0) - (previous or 0)
+        collection.addMetric(self.name, self.sums[key], self.groupLabels(key))
+
+    def evaluate(self, collection):
+        """compute all sums from scratch
+
+        Args:
+            collection (MetricsCollection): collection of the rule
+        """
+        self.dirty = False
+        self.sums = {}
+        self.members = {}
+        for labels, value in self.plainInstances(
+            collection.metrics.get(self.inputs[0])
+        ):
+            key = self.groupKey(labels)
+            self.sums[key] = self.sums.get(key, 0) + value
+            self.members[key] = self.members.get(key, 0) + 1
+        self.replace(
+            collection,
+            ((self.groupLabels(key), value) for key, value in self.sums.items()),
+        )
+
+
+class RatioRecordingRule(RecordingRule):
+    """Ratio of two metrics with matching labels, like `a / b` of PromQL
+
+    A changed input instance only recomputes the ratio with the same labels.
+    """
+
+    def __init__(self, name, numerator, denominator, helpText=None):
+        """initialize the rule
+
+        Args:
+            name (str): name of the derived metric
+            numerator (str): name of the dividend metric
+            denominator (str): name of the divisor metric
+            helpText (str): help information of the derived metric (default: `None`)
+        """
+        super().__init__(name, [numerator, denominator], helpText=helpText)
+
+    @staticmethod
+    def divide(numerator, denominator):
+        """divide like Prometheus, which yields `±Inf` or `NaN` on division by zero
+
+        Args:
+            numerator (number): dividend
+            denominator (number): divisor
+
+        Returns:
+            float: quotient
+        """
+        if denominator == 0:
+            if numerator == 0 or math.isnan(numerator):
+                return math.nan
+            return math.copysign(math.inf, numerator)
+        return numerator / denominator
+
+    def ratio(self, collection, labels):
+        """current ratio for a label set
+
+        Args:
+            collection (MetricsCollection): collection of the rule
+            labels (dict): labels of the ratio
+
+        Returns:
+            float: the ratio, `None` if an input instance is missing or non-numeric
+        """
+        values = []
+        for name in self.inputs:
+            metric = collection.metrics.get(name)
+            instance = None if metric is None else metric.getInstance(labels)
+            value = None if instance is None else self.number(instance.value)
+            if value is None:
+                return None
+            values.append(value)
+        return self.divide(*values)
+
+    def update(self, collection, inputName, labels, suffix, previous, current):
+        """recompute the ratio with the labels of a changed input instance
+
+        Args:
+            collection (MetricsCollection): collection of the rule
+            inputName (str): name of the changed input metric
+            labels (dict): labels of the changed instance
+            suffix (str): suffix of the changed instance, suffixed ones are ignored
+            previous (number): value before the change, `None` if the instance was added
+            current (number): value after the change, `None` if the instance was removed
+        """
+        if suffix:
+            return
+        ratio = self.ratio(collection, labels)
+        if ratio is None:
+            collection.removeMetric(self.name, labels)
+        else:
+            collection.addMetric(self.name, ratio, labels)
+
+    def evaluate(self, collection):
+        """compute all ratios
+
+        Args:
+            collection (MetricsCollection): collection of the rule
+        """
+        self.dirty = False
+        results = []
+        for labels, _ in self.plainInstances(collection.metrics.get(self.inputs[0])):
+            ratio = self.ratio(collection, labels)
+            if ratio is not None:
+                results.append((labels, ratio))
+        self.replace(collection, results)
+
+
+class HyperLogLog:
+    """Estimator of distinct counts in constant memory
+
+    Values are hashed by a 64 bit BLAKE2b of their string representation – unlike the
+    builtin `hash`, which is salted per process for strings, estimates are reproducible
+    across processes. The relative error is about `1.04 / sqrt(2 ** precision)`.
+    """
+
+    def __init__(self, precision=12):
+        """initialize the estimator
+
+        Args:
+            precision (int): number of index bits, from 4 to 16 – uses `2 ** precision`
+                             bytes (default: `12`)
+
+        Raises:
+            ValueError: if the precision is out of range
+        """
+        if not 4 <= precision <= 16:
+            raise ValueError(
+                "The precision of a HyperLogLog has to be between 4 and 16!"
             )
-        # find actual metric instances
-        self._findMetricInstances()
-        # find comments
-        self._findComments(dismissComments=dismissComments)
+        self.precision = precision
+        self.registers = bytearray(1 << precision)
+        self._shift = 64 - precision
+        self._mask = (1 << self._shift) - 1
 
-        # add metric instances
-        # check if any string is left over and warn about it
-        self._checkForLeftovers()
-        # clean create metrics variables
-        del self._createMetrics
-        del self._metricLines
-        del self._processedLines
-        del self._lineRange
-        del self._worklist
-        # print(self)
+    def add(self, value):
+        """add a value
 
-    def _findTypes(self):
-        """find types in metrics string
+        Args:
+            value (mixed): value to count, `bytes` or anything convertible by `str`
+        """
+        data = value if isinstance(value, bytes) else str(value).encode()
+        x = int.from_bytes(hashlib.blake2b(data, digest_size=8).digest(), "little")
+        index = x >> self._shift
+        rank = self._shift - (x & self._mask).bit_length() + 1
+        if rank > self.registers[index]:
+            self.registers[index] = rank
 
-        helper method for `load` function which collects metric names and types in `self._worklist`
+    def __len__(self):
+        """estimate the number of distinct values
+
+        Returns:
+            int: estimated distinct count
         """
-        try:
-            self._worklist
-        except AttributeError:
-            logger.error("Method “_findTypes” is not meant to be called manually.")
-            return
+        m = len(self.registers)
+        estimate = (
+            0.7213
+            / (1 + 1.079 / m)
+            * m
+            * m
+            / math.fsum(2.0**-r for r in self.registers)
+        )
+        zeros = self.registers.count(0)
+        if zeros and estimate <= 2.5 * m:
+            # linear counting is more exact for small cardinalities
+            estimate = m * math.log(m / zeros)
+        return round(estimate)
 
-        regex = r"^#\s*TYPE\s+([^\s]+)\s+([^\s]+)\s*$"
-        for lineIndex in [i for i in self._lineRange if i not in self._processedLines]:
-            line = self._worklist[lineIndex]
-            typeRow = re.fullmatch(regex, line)
-            if typeRow != None:
-                self._processedLines.append(lineIndex)
-                groups = typeRow.groups()
-                # note down line as metric relevant line
-                if groups[0] not in self._metricLines:
-                    self._metricLines[groups[0]] = []
-                self._metricLines[groups[0]].append(lineIndex)
-                # store type of metric
-                if groups[0] not in self._createMetrics:
-                    self._createMetrics[groups[0]] = {}
-                if "type" in self._createMetrics[groups[0]]:
-                    logger.error(
-                        f"Type for metric with name {groups[0]} defined multiple times.\n"
-                        f"Only first occurence (“{self._createMetrics[groups[0]]['type']}”) in given metric definition will be applied."
-                    )
-                else:
-                    self._createMetrics[groups[0]]["type"] = groups[1]
 
-    def _findHelps(self):
-        """find help notices in metrics string
+class SpaceSaving:
+    """Top-k sketch of the most frequent values in bounded memory
 
-        helper method for `load` function which collects help notices in `self._worklist` and adds them to corresponding names and types
+    At most `capacity` values are counted. A new value replaces the least frequent
+    one and inherits its count, which is kept as possible overestimation. The least
+    frequent value is found by a heap of lower bounds of the counts, which are only
+    raised to the current count when they reach the top, so counting a known value
+    stays `O(1)` and evicting takes amortised `O(log capacity)`.
+    """
+
+    def __init__(self, capacity=32):
+        """initialize the sketch
+
+        Args:
+            capacity (int): number of values to count (default: `32`)
         """
-        try:
-            self._worklist
-        except AttributeError:
-            logger.error("Method “_findHelps” is not meant to be called manually.")
-            return
+        self.capacity = capacity
+        self.counts = {}
+        self.errors = {}
+        self._heap = []
+        self._sequence = itertools.count()
 
-        regex = r"^#\s*HELP\s+([^\s]+)\s+(.*)$"
-        for lineIndex in [i for i in self._lineRange if i not in self._processedLines]:
-            line = self._worklist[lineIndex]
-            helpRow = re.fullmatch(regex, line)
-            if helpRow != None:
-                self._processedLines.append(lineIndex)
-                groups = helpRow.groups()
-                # note down line as metric relevant line
-                if groups[0] not in self._metricLines:
-                    self._metricLines[groups[0]] = []
-                self._metricLines[groups[0]].append(lineIndex)
-                # store help of metric
-                if groups[0] not in self._createMetrics:
-                    self._createMetrics[groups[0]] = {}
-                if "help" in self._createMetrics[groups[0]]:
-                    logger.error(
-                        f"Help for metric with name {groups[0]} defined multiple times.\n"
-                        f"Only first occurence (“{self._createMetrics[groups[0]]['help']}”) in given metric definition will be applied."
-                    )
-                else:
-                    self._createMetrics[groups[0]]["help"] = (
-                        MetricsCollection.decodeOneliner(groups[1])
-                    )
+    def add(self, value, count=1):
+        """count a value
 
-    def _findComments(self, dismissComments=True):
-        """find comments and sort them to nearest metrics names
+        Args:
+            value (hashable): value to count
+            count (int): occurrences to add (default: `1`)
+        """
+        counts = self.counts
+        if value in counts:
+            counts[value] += count
+        elif len(counts) < self.capacity:
+            counts[value] = count
+            self.errors[value] = 0
+            heapq.heappush(self._heap, (count, next(self._sequence), value))
+        else:
+            evicted = self._lowest()
+            lowest = counts.pop(evicted)
+            del self.errors[evicted]
+            counts[value] = lowest + count
+            self.errors[value] = lowest
+            heapq.heapreplace(self._heap, (counts[value], next(self._sequence), value))
+
+    def _lowest(self):
+        """find the least frequent value, which is moved to the top of the heap
+
+        Returns:
+            hashable: the least frequent value
+        """
+        heap = self._heap
+        while True:
+            count, _, value = heap[0]
+            current = self.counts[value]
+            if current == count:
+                return value
+            # counted further since the entry was pushed
+            heapq.heapreplace(heap, (current, next(self._sequence), value))
+
+    def top(self, n=None):
+        """most frequent values
 
         Args:
-            dismissComments (bool): should comments just be dropped? Yes => `True`, No => `False`
+            n (int): number of values to return (default: `None`, so all counted ones)
+
+        Returns:
+            list: tuples of value, estimated count and possible overestimation, most
+                  frequent first
         """
-        try:
-            self._worklist
-        except AttributeError:
-            logger.error("Method “_findComments” is not meant to be called manually.")
-            return
+        ranked = sorted(self.counts.items(), key=lambda item: item[1], reverse=True)
+        return [(value, count, self.errors[value]) for value, count in ranked[:n]]
 
-        commentLineIndex = [
-            i
-            for i in self._lineRange
-            if i not in self._processedLines and self._worklist[i].startswith("#")
-        ]
-        self._processedLines += commentLineIndex
 
-        if not dismissComments:
-            start = {}
-            end = {}
-            for metricName in self._metricLines.keys():
-                start[metricName] = min(self._metricLines[metricName])
-                end[metricName] = max(self._metricLines[metricName])
+class MetricsCardinality:
+    """Cardinality analysis of metrics
 
-            for cl in commentLineIndex:
-                sd = {}
-                ed = {}
-                for metricName in self._metricLines.keys():
-                    sd[metricName] = abs(start[metricName] - cl)
-                    ed[metricName] = abs(end[metricName] - cl)
-                ls = min(sd.values())
-                le = min(ed.values())
-                if ls <= le:
-                    name = [k for k, v in sd.items() if v == ls][0]
-                else:
-                    name = [k for k, v in ed.items() if v == le][0]
+    Series are streamed from collections or exposition files without materialising
+    them. Per metric, the series are counted, the distinct values of each label are
+    estimated by a `HyperLogLog` and the most frequent values of each label are kept by
+    a `SpaceSaving` sketch – so the label driving the cardinality of an exploding
+    metric shows up by its distinct count.
+    """
 
-                self.addComment(name, self._worklist[cl].lstrip("#").strip())
+    labelRegEx = r'([a-zA-Z_][a-zA-Z0-9_]*)\s*=\s*"((?:[^"\\]|\\.)*)"'
+    escapeRegEx = r"\\(.)"
 
-    def _findMetricInstances(self):
-        """find actual metric instances"""
-        try:
-            self._worklist
-        except AttributeError:
-            logger.error(
-                "Method “_findMetricInstances” is not meant to be called manually."
-            )
-            return
+    def __init__(self, precision=12, topValues=5):
+        """initialize the analysis
 
-        lineRegex = (
-            r"^("
-            + self.Metric.nameRegEx
-            + r")\s*(\{(.*)\})?\s+(-?\d+(?:\.\d+)?(?:[eE][+-]?\d+)?)$"
-        )
-        commaSplitRegex = r""",(?=(?:[^"']*["'][^"']*["'])*[^"']*$)"""
-        unquoteRegex = r"""((^"(.*)"$)|(^'(.*)'$))"""
-        for lineIndex in [i for i in self._lineRange if i not in self._processedLines]:
-            line = self._worklist[lineIndex]
-            metricLine = re.fullmatch(lineRegex, line)
-            if metricLine != None:
-                self._processedLines.append(lineIndex)
-                groups = metricLine.groups()
-                # note down line as metric relevant line
-                if groups[0] not in self._metricLines:
-                    self._metricLines[groups[0]] = []
-                self._metricLines[groups[0]].append(lineIndex)
+        Args:
+            precision (int): precision of the distinct count estimators (default: `12`)
+            topValues (int): number of most frequent values to report per label (default: `5`)
+        """
+        self.precision = precision
+        self.topValues = topValues
+        self.series = {}
+        self.labels = {}
 
-                # retrieve labels
-                labels = {}
-                if groups[2] != None:
-                    labelHelp = re.split(commaSplitRegex, groups[2])
-                    for l in labelHelp:
-                        l = l.split("=", 1)
-                        labels[l[0]] = re.sub(unquoteRegex, r"\3\5", l[1])
+    def addSeries(self, metricName, labels):
+        """count a series
 
-                # add actual metric
-                if groups[0] not in self._createMetrics:
-                    self._createMetrics[groups[0]] = {}
-                    logger.info(
-                        f"It seems there is a metric “{groups[0]}” without any TYPE or HELP defined in imported metrics."
+        Args:
+            metricName (str): name of the metric
+            labels (dict): labels of the series
+        """
+        self.series[metricName] = self.series.get(metricName, 0) + 1
+        sketches = self.labels.get(metricName)
+        if sketches is None:
+            sketches = self.labels[metricName] = {}
+        for label, value in labels.items():
+            sketch = sketches.get(label)
+            if sketch is None:
+                sketch = sketches[label] = (
+                    HyperLogLog(self.precision),
+                    SpaceSaving(self.topValues * 8),
+                )
+            sketch[0].add(value)
+            sketch[1].add(value)
+
+    @staticmethod
+    def _unescape(match):
+        """unescape `\\\\`, `\\"` and `\\n` of a label value
+
+        Args:
+            match (re.Match): match of `escapeRegEx`
+
+        Returns:
+            str: the unescaped character
+        """
+        return "\n" if match.group(1) == "n" else match.group(1)
+
+    def addCollection(self, collection):
+        """count all series of a collection
+
+        Samples of histograms and summaries are counted as series of their metric.
+
+        Args:
+            collection (MetricsCollection): collection to analyse
+        """
+        for m in collection.families():
+            with m.lock:
+                instances = list(m.instances)
+            for i in instances:
+                self.addSeries(m.name, i.labels)
+
+    def addFile(self, source):
+        """count all series of an exposition file line by line
+
+        Samples named `<name>_bucket`, `<name>_sum` or `<name>_count` are counted as
+        series of `<name>` if that is declared as histogram or summary before. Other
+        metadata and comments are skipped.
+
+        Args:
+            source (str|file): path of the file or an open text file
+        """
+        if isinstance(source, str):
+            with open(source, encoding="utf-8") as f:
+                return self.addFile(f)
+        types = {}
+        labelRegEx = re.compile(self.labelRegEx)
+        escapeRegEx = re.compile(self.escapeRegEx)
+        for line in source:
+            if line.startswith("#"):
+                parts = line.split(None, 3)
+                if len(parts) == 4 and parts[1] == "TYPE":
+                    metricType = parts[3].strip()
+                    if metricType in ("histogram", "summary"):
+                        types[parts[2]] = metricType
+                continue
+            brace = line.find("{")
+            if brace == -1:
+                name = line.split(None, 1)[0] if line.strip() else None
+                labels = {}
+            else:
+                name = line[:brace].strip()
+                labels = {
+                    label: (
+                        escapeRegEx.sub(self._unescape, value)
+                        if "\\" in value
+                        else value
                     )
+                    for label, value in labelRegEx.findall(line, brace, line.rfind("}"))
+                }
+            if not name:
+                continue
+            if types and name not in types:
+                for suffix, allowed in MetricsCollection.sampleSuffixes.items():
+                    if (
+                        name.endswith(suffix)
+                        and types.get(name[: -len(suffix)]) in allowed
+                    ):
+                        name = name[: -len(suffix)]
+                        break
+            self.addSeries(name, labels)
 
-                self.addMetric(groups[0], value=groups[3], labels=labels)
+    def report(self):
+        """summarise the analysis
 
-    def _checkForLeftovers(self):
-        """check if the Metric string holds unknown, unallowed additional lines of code and warn about occurences"""
+        Returns:
+            list: one dictionary per metric with its `name`, number of `series` and
+                  `labels` – each with its estimated number of `distinct` values and the
+                  `top` values as tuples of value, estimated count and possible
+                  overestimation. Metrics are sorted by series, labels by distinct values,
+                  both descending.
+        """
+        report = []
+        for name, series in self.series.items():
+            labels = [
+                {
+                    "name": label,
+                    "distinct": min(len(distinct), series),
+                    "top": top.top(self.topValues),
+                }
+                for label, (distinct, top) in self.labels[name].items()
+            ]
+            labels.sort(key=lambda label: label["distinct"], reverse=True)
+            report.append({"name": name, "series": series, "labels": labels})
+        report.sort(key=lambda metric: metric["series"], reverse=True)
+        return report
+
+
+class MetricsInstrumentation:
+    """Costs of a metrics collection, see `MetricsCollection.enableInstrumentation`
+
+    Recording is just adding up numbers under a lock, the metrics are only built when
+    the collection gets rendered.
+    """
+
+    def __init__(self, prefix="metrics_collection_"):
+        """initialize the instrumentation
+
+        Args:
+            prefix (str): prefix of the metric names (default: `"metrics_collection_"`)
+        """
+        self.prefix = prefix
+        self.lock = threading.Lock()
+        self.loadSeconds = {}
+        self.renders = 0
+        self.renderSeconds = 0.0
+        self.renderBytes = 0
+        self.renderGzipBytes = 0
+        self.lastRender = (0.0, 0)
+        self.lastGzipBytes = 0
+        self.cacheRequests = {}
+
+    @contextmanager
+    def measure(self, phase):
+        """measure the duration of a phase of `load`
+
+        Args:
+            phase (str): name of the phase
+        """
+        started = time.perf_counter()
         try:
-            self._worklist
-        except AttributeError:
-            logger.error(
-                "Method “_checkForLeftovers” is not meant to be called manually."
+            yield
+        finally:
+            elapsed = time.perf_counter() - started
+            with self.lock:
+                self.loadSeconds[phase] = self.loadSeconds.get(phase, 0.0) + elapsed
+
+    def observeRender(self, seconds, size, compressedSize=None):
+        """record a rendering
+
+        Args:
+            seconds (float): duration of the rendering
+            size (int): bytes of the UTF-8 encoded output
+            compressedSize (int): bytes of the gzip compressed output, if compressed
+                                  (default: `None`)
+        """
+        with self.lock:
+            self.renders += 1
+            self.renderSeconds += seconds
+            self.renderBytes += size
+            self.lastRender = (seconds, size)
+            if compressedSize is not None:
+                self.renderGzipBytes += compressedSize
+                self.lastGzipBytes = compressedSize
+
+    def observeCache(self, cache, hit):
+        """record a request of a rendering cache
+
+        Args:
+            cache (str): name of the cache
+            hit (bool): was the request answered by the cache?
+        """
+        key = (cache, "hit" if hit else "miss")
+        with self.lock:
+            self.cacheRequests[key] = self.cacheRequests.get(key, 0) + 1
+
+    def collection(self, collection):
+        """build the metrics
+
+        Args:
+            collection (MetricsCollection): instrumented collection
+
+        Returns:
+            MetricsCollection: metrics of the instrumentation
+        """
+        families = collection.families()
+        series = sum(len(m) for m in families)
+        with self.lock:
+            loadSeconds = dict(self.loadSeconds)
+            renders = (
+                self.renders,
+                self.renderSeconds,
+                self.renderBytes,
+            ) + self.lastRender
+            gzipBytes = (self.renderGzipBytes, self.lastGzipBytes)
+            cacheRequests = dict(self.cacheRequests)
+        with _validationLock:
+            failures = dict(validationFailures)
+        p = self.prefix
+        mc = MetricsCollection()
+        mc.ensureMetric(f"{p}families", "number of metrics", "gauge")
+        mc.addMetric(f"{p}families", len(families))
+        mc.ensureMetric(f"{p}series", "number of metric instances", "gauge")
+        mc.addMetric(f"{p}series", series)
+        mc.ensureMetric(
+            f"{p}load_seconds_total", "time spent loading metrics by phase", "counter"
+        )
+        for phase, seconds in loadSeconds.items():
+            mc.addMetric(f"{p}load_seconds_total", seconds, {"phase": phase})
+        for name, helpText, metricType, value in (
+            ("renders_total", "number of renderings", "counter", renders[0]),
+            ("render_seconds_total", "time spent rendering", "counter", renders[1]),
+            (
+                "render_bytes_total",
+                "size of rendered output before compression",
+                "counter",
+                renders[2],
+            ),
+            (
+                "last_render_seconds",
+                "duration of the last rendering",
+                "gauge",
+                renders[3],
+            ),
+            ("last_render_bytes", "size of the last rendering", "gauge", renders[4]),
+            (
+                "render_gzip_bytes_total",
+                "size of gzip compressed output",
+                "counter",
+                gzipBytes[0],
+            ),
+            (
+                "last_render_gzip_bytes",
+                "size of the last gzip compressed rendering",
+                "gauge",
+                gzipBytes[1],
+            ),
+        ):
+            mc.addMetric(f"{p}{name}", value, helpText=helpText, metricType=metricType)
+        mc.ensureMetric(
+            f"{p}validation_failures_total",
+            "names and types not matching the Prometheus specifications in this process",
+            "counter",
+        )
+        for kind, count in failures.items():
+            mc.addMetric(f"{p}validation_failures_total", count, {"kind": kind})
+        mc.ensureMetric(
+            f"{p}cache_requests_total", "requests of rendering caches", "counter"
+        )
+        mc.ensureMetric(
+            f"{p}cache_hit_ratio",
+            "share of cache requests answered by the cache",
+            "gauge",
+        )
+        for cache in sorted({cache for cache, _ in cacheRequests}):
+            hits = cacheRequests.get((cache, "hit"), 0)
+            misses = cacheRequests.get((cache, "miss"), 0)
+            mc.addMetric(
+                f"{p}cache_requests_total", hits, {"cache": cache, "result": "hit"}
             )
-            return
+            mc.addMetric(
+                f"{p}cache_requests_total", misses, {"cache": cache, "result": "miss"}
+            )
+            mc.addMetric(
+                f"{p}cache_hit_ratio", hits / (hits + misses), {"cache": cache}
+            )
+        return mc
 
-    def decodeOneliner(singleLine):
-        """decode single line
+
+class MetricsChurn:
+    """Series churn of a metrics collection, see `MetricsCollection.enableChurnTracking`
+
+    The churn per metric is derived from the counters of created and removed series
+    of the metrics, the label values of churning series are counted in a `SpaceSaving`
+    sketch.
+    """
+
+    def __init__(self, prefix="metrics_collection_", topValues=10):
+        """initialize the churn tracking
 
         Args:
-            singleLine (string): one single line – in Prometheus metrics, `\\` has
-                                 to be encoded as `\\\\` and newlines as `\\n`.
+            prefix (str): prefix of the metric names (default: `"metrics_collection_"`)
+            topValues (int): number of most churning label values to expose (default: `10`)
+        """
+        self.prefix = prefix
+        self.topValues = topValues
+        self.lock = threading.Lock()
+        self.labelValues = SpaceSaving(topValues * 8)
+        self.previous = {}
+        self.intervals = 0
+
+    def record(self, metricName, labels):
+        """count the label values of a created or removed series
+
+        Args:
+            metricName (str): name of the metric
+            labels (tuple): sorted label pairs of the series
+        """
+        with self.lock:
+            for label, value in labels:
+                self.labelValues.add((metricName, label, value))
+
+    def snapshot(self, families):
+        """remember the counters of the metrics as base of the next churn
+
+        Args:
+            families (iterable): metric objects
 
         Returns:
-            string: decoded text, possibly multiline
+            dict: metric objects mapped to created and removed series since the
+                  previous snapshot
         """
-        if "\n" in singleLine:
-            logger.error("Single line has to be given to be able to decode anything!")
-        else:
-            singleLine = singleLine.replace("\\n", "\n").replace("\\\\", "\\")
-        return singleLine
+        current = {m: (m.seriesCreated, m.seriesRemoved) for m in families}
+        with self.lock:
+            previous, self.previous = self.previous, current
+            self.intervals += 1
+        churn = {}
+        for m, (created, removed) in current.items():
+            before = previous.get(m, (0, 0))
+            churn[m] = (created - before[0], removed - before[1])
+        return churn
 
-    def __str__(self):
-        """string representation
+    def collection(self, collection):
+        """build the metrics and start the next churn interval
 
-        The string representation of a metrics collection is meant to be fetched by
-        Prometheus or to be pushed to a Prometheus Push Gateway.
+        Args:
+            collection (MetricsCollection): tracked collection
 
         Returns:
-            str: prometheus metrics data
+            MetricsCollection: metrics of the churn tracking
         """
-        file_loader = FileSystemLoader(
-            os.path.join(os.path.dirname(os.path.abspath(__file__)), "tpl")
+        families = collection.families()
+        churn = self.snapshot(families)
+        with self.lock:
+            top = self.labelValues.top(self.topValues)
+        p = self.prefix
+        mc = MetricsCollection()
+        for name, helpText in (
+            ("series_created_total", "series created per metric"),
+            ("series_removed_total", "series removed per metric"),
+        ):
+            mc.ensureMetric(f"{p}{name}", helpText, "counter")
+        for name, helpText in (
+            (
+                "series_created",
+                "series created per metric since the previous rendering",
+            ),
+            (
+                "series_removed",
+                "series removed per metric since the previous rendering",
+            ),
+        ):
+            mc.ensureMetric(f"{p}{name}", helpText, "gauge")
+        for m in families:
+            labels = {"metric": m.name}
+            created, removed = churn[m]
+            mc.addMetric(f"{p}series_created_total", m.seriesCreated, labels)
+            mc.addMetric(f"{p}series_removed_total", m.seriesRemoved, labels)
+            mc.addMetric(f"{p}series_created", created, labels)
+            mc.addMetric(f"{p}series_removed", removed, labels)
+        mc.ensureMetric(
+            f"{p}churn_label_values",
+            "estimated series created and removed per label value, most churning only",
+            "gauge",
         )
-        env = Environment(loader=file_loader)
-        template = env.get_template("metrics.j2")
-
-        output = template.render(metrics=self.prepare()).strip() + "\n"
-        return output
+        for (metricName, label, value), count, _ in top:
+            mc.addMetric(
+                f"{p}churn_label_values",
+                count,
+                {"metric": metricName, "label": label, "value": value},
+            )
+        return mc
@@ -1,12 +1,33 @@
 #!/usr/bin/env python3
+import asyncio
 import copy
+import gzip
 import logging
+import math
+import os
+import re
+import threading
+import time
 
 import pytest
 from jinja2 import BaseLoader
 from jinja2 import Environment
 
+from macwinnie_pyhelpers.Metrics import HyperLogLog
+from macwinnie_pyhelpers.Metrics import Meter
+from macwinnie_pyhelpers.Metrics import MetricsCardinality
 from macwinnie_pyhelpers.Metrics import MetricsCollection
+from macwinnie_pyhelpers.Metrics import MetricsDirectory
+from macwinnie_pyhelpers.Metrics import MetricsRateTracker
+from macwinnie_pyhelpers.Metrics import MetricsRelabeler
+from macwinnie_pyhelpers.Metrics import MetricsScraper
+from macwinnie_pyhelpers.Metrics import MetricsWal
+from macwinnie_pyhelpers.Metrics import Observations
+from macwinnie_pyhelpers.Metrics import RatioRecordingRule
+from macwinnie_pyhelpers.Metrics import RecordingRule
+from macwinnie_pyhelpers.Metrics import RollingWindow
+from macwinnie_pyhelpers.Metrics import SpaceSaving
+from macwinnie_pyhelpers.Metrics import SumRecordingRule
 
 metric_names = [
     "example_job_1_result_unit",
@@ -258,6 +279,40 @@ def test_logs_when_changing_type_and_help_by_adding_new_metrics(caplog):
     ]
 
 
+def test_add_metric_lock_free_for_existing(mocker, caplog):
+    """values of existing metrics with unchanged definitions skip the collection lock"""
+    mc = MetricsCollection(threadSafe=True)
+    mc.addMetric("jobs_total", 1, helpText="Jobs", metricType="counter")
+    lock = mc._lock
+    mc._lock = mocker.MagicMock()
+    with caplog.at_level(level="DEBUG"):
+        mc.addMetric("jobs_total", 2, helpText=" Jobs ", metricType="counter")
+    mc._lock.__enter__.assert_not_called()
+    assert "Changed help for metric `jobs_total`." not in caplog.messages
+
+    mc.addMetric("jobs_total", 3, metricType="gauge")
+    assert mc._lock.__enter__.called
+    assert mc.metrics["jobs_total"].type == "gauge"
+    mc._lock = lock
+
+    class CreatedMeanwhile(dict):
+        """misses the first lookup, like one done before another thread finished"""
+
+        missed = False
+
+        def get(self, key, default=None):
+            if not self.missed:
+                self.missed = True
+                return default
+            return super().get(key, default)
+
+    metric = mc.metrics["jobs_total"]
+    mc.metrics = CreatedMeanwhile(mc.metrics)
+    mc.addMetric("jobs_total", 4)
+    assert mc.metrics["jobs_total"] is metric
+    assert metric.getInstance({}).value == 4
+
+
 def test_debug_message_for_fallback_on_no_given_metric_type(caplog):
     """check debug notice when creating a metric without type so fallback to `gauge` is used"""
     with caplog.at_level(level="DEBUG"):
@@ -781,3 +836,2347 @@ def test_empty_metric_instance_preparation(caplog):
     assert newMetric.render(metricName=mwa) in logDebugs
     assert newMetric.render(metricName=msh) in logDebugs
     assert newMetric.render(metricName=mst) in logDebugs
+
+
+@pytest.mark.parametrize(
+    ("valueString", "expected", "expectedType"),
+    (
+        ("1", 1, int),
+        ("-17", -17, int),
+        ("2.0", 2, int),
+        ("1e3", 1000, int),
+        ("2.5", 2.5, float),
+        ("-1.5e-3", -0.0015, float),
+        ("9007199254740992", 2**53, int),
+        ("1e300", 1e300, float),
+        ("-1e20", -1e20, float),
+        ("+Inf", float("inf"), float),
+        ("-Inf", float("-inf"), float),
+    ),
+)
+def test_parse_value(valueString, expected, expectedType):
+    """check parsing of sample values from metrics strings"""
+    value = MetricsCollection.parseValue(valueString)
+    assert value == expected
+    assert type(value) == expectedType
+
+
+def test_parse_value_nan():
+    """NaN is never equal to itself, so it has to be checked separately"""
+    value = MetricsCollection.parseValue("NaN")
+    assert type(value) == float
+    assert value != value
+
+
+@pytest.mark.parametrize(
+    ("valueString", "valid"),
+    (
+        ("NaN", True),
+        ("+Inf", True),
+        ("-1.5e-3", True),
+        ("+NaN", False),
+        ("-NaN", False),
+    ),
+)
+def test_value_regex(valueString, valid):
+    """check sample values accepted by the exposition format"""
+    assert bool(re.fullmatch(MetricsCollection.valueRegEx, valueString)) == valid
+
+
+@pytest.mark.parametrize(
+    ("value", "expected"),
+    (
+        (1, "1"),
+        (2.0, "2.0"),
+        (0.1, "0.1"),
+        (1e-07, "1e-07"),
+        (float("nan"), "NaN"),
+        (float("inf"), "+Inf"),
+        (float("-inf"), "-Inf"),
+        (True, "1"),
+        (False, "0"),
+        ("1.50", "1.50"),
+    ),
+)
+def test_format_value(value, expected):
+    """check the exposition format representation of sample values"""
+    assert MetricsCollection.formatValue(value) == expected
+
+
+def test_load_typed_values():
+    """check that typed collections parse values once while loading"""
+    loadString = """# TYPE typed_metric gauge
+typed_metric{kind="int"} 3
+typed_metric{kind="integral float"} 3.0
+typed_metric{kind="float"} 3.25
+typed_metric{kind="inf"} +Inf
+typed_metric{kind="nan"} NaN
+"""
+    untyped = MetricsCollection()
+    untyped.load(loadString)
+    assert [i.value for i in untyped.metrics["typed_metric"].instances] == [
+        "3",
+        "3.0",
+        "3.25",
+        "+Inf",
+        "NaN",
+    ]
+    assert str(untyped) == loadString
+
+    typed = MetricsCollection(typedValues=True)
+    typed.load(loadString)
+    values = [i.value for i in typed.metrics["typed_metric"].instances]
+    assert values[:4] == [3, 3, 3.25, float("inf")]
+    assert [type(v) for v in values] == [int, int, float, float, float]
+    assert str(typed) == loadString.replace("} 3.0", "} 3")
+
+
+def test_rate_tracker(caplog):
+    """check per-second rates of counters across consecutive collections"""
+    scrapes = [
+        """# TYPE requests_total counter
+requests_total{code="200"} 100
+requests_total{code="500"} 10
+# TYPE temperature gauge
+temperature 20
+""",
+        """# TYPE requests_total counter
+requests_total{code="200"} 150
+requests_total{code="500"} 4
+requests_total{code="404"} 1
+# TYPE temperature gauge
+temperature 25
+""",
+    ]
+    tracker = MetricsRateTracker()
+    collections = []
+    for scrape in scrapes:
+        mc = MetricsCollection()
+        mc.load(scrape)
+        collections.append(mc)
+
+    first = tracker.update(collections[0], timestamp=1000)
+    assert first.metrics == {}
+
+    with caplog.at_level(level="DEBUG"):
+        rates = tracker.update(collections[1], timestamp=1010)
+
+    assert list(rates.metrics.keys()) == ["requests_per_second"]
+    assert rates.metrics["requests_per_second"].type == "gauge"
+    assert {
+        i.labels["code"]: i.value for i in rates.metrics["requests_per_second"]
+    } == {"200": 5.0, "500": 0.4}
+    assert "Counter reset detected for `requests_total` series {'code': '500'}." in [
+        rec.message for rec in caplog.records if rec.levelno == logging.DEBUG
+    ]
+
+    with caplog.at_level(level="DEBUG"):
+        rates = tracker.update(collections[1], timestamp=1010)
+
+    assert rates.metrics == {}
+    assert "Timestamp 1010 is not after last update at 1010, no rates computed." in [
+        rec.message for rec in caplog.records if rec.levelno == logging.ERROR
+    ]
+
+
+def test_rate_tracker_name():
+    """check naming of rate gauges"""
+    tracker = MetricsRateTracker(suffix="_rate")
+    assert tracker.rateName("bytes_total") == "bytes_rate"
+    assert tracker.rateName("bytes") == "bytes_rate"
+
+
+def test_rate_tracker_clock(mocker):
+    """check updates without timestamp using the current time"""
+    clock = mocker.patch("macwinnie_pyhelpers.Metrics.time.time", return_value=100.0)
+    mc = MetricsCollection()
+    mc.addMetric("bytes_total", 10, helpText="bytes", metricType="counter")
+    tracker = MetricsRateTracker()
+    assert len(tracker.update(mc).metrics) == 0
+    mc.addMetric("bytes_total", 30)
+    clock.return_value = 102.0
+    assert tracker.update(mc).metrics["bytes_per_second"][0].value == 10
+    assert tracker.timestamp == 102.0
+
+
+def test_rolling_window():
+    """check incremental statistics of rolling windows against full recomputation"""
+    size = 4
+    window = RollingWindow(size)
+    assert len(window) == 0
+    for statistic in RollingWindow.statistics:
+        assert getattr(window, statistic)() == None
+
+    values = [5, 1, "3", 8, 2, 2, 9, 0.5, 7, 7, 1]
+    for i, value in enumerate(values):
+        window.append(value)
+        current = [float(v) for v in values[max(0, i + 1 - size) : i + 1]]
+        assert len(window) == len(current)
+        assert window.min() == min(current)
+        assert window.max() == max(current)
+        assert window.sum() == pytest.approx(sum(current))
+        assert window.mean() == pytest.approx(sum(current) / len(current))
+
+
+def test_rolling_window_size():
+    """a window has to hold values"""
+    with pytest.raises(ValueError):
+        RollingWindow(0)
+
+
+def test_metric_windows_rendering(caplog):
+    """check rolling window statistics being rendered as derived gauges"""
+    name = "queue_depth"
+    mc = MetricsCollection()
+    mc.addMetric(name, 4, {"queue": "a"}, helpText="Depth", metricType="gauge")
+    with caplog.at_level(level="DEBUG"):
+        mc.setWindow(name, 3, ["max", "mean", "nonsense"])
+
+    assert (
+        f"“nonsense” is not a valid window statistic, which are defined by {RollingWindow.statistics}"
+        in [rec.message for rec in caplog.records if rec.levelno == logging.ERROR]
+    )
+
+    for value in [8, 6, 1]:
+        mc.addMetric(name, value, {"queue": "a"})
+    mc.addMetric(name, 2, {"queue": "b"})
+
+    assert (
+        str(mc)
+        == """# HELP queue_depth Depth
+# TYPE queue_depth gauge
+queue_depth{queue="a"} 1
+queue_depth{queue="b"} 2
+
+# HELP queue_depth_window_max Rolling max over the last 3 values of queue_depth
+# TYPE queue_depth_window_max gauge
+queue_depth_window_max{queue="a"} 8.0
+queue_depth_window_max{queue="b"} 2.0
+
+# HELP queue_depth_window_mean Rolling mean over the last 3 values of queue_depth
+# TYPE queue_depth_window_mean gauge
+queue_depth_window_mean{queue="a"} 5.0
+queue_depth_window_mean{queue="b"} 2.0
+"""
+    )
+    derived = mc.metrics[name].windowRepresentation()
+    assert list(derived) == [f"{name}_window_max", f"{name}_window_mean"]
+    assert [i.value for i in derived[f"{name}_window_max"]["instances"]] == [8.0, 2.0]
+
+    mc.setWindow(name, None)
+    assert str(mc).count("window") == 0
+
+
+@pytest.mark.parametrize(
+    "metricType, label, suffixes",
+    [
+        ("histogram", "le", ["_bucket", "_sum", "_count"]),
+        ("summary", "quantile", ["", "_sum", "_count"]),
+    ],
+)
+def test_metric_windows_suffixes(metricType, label, suffixes):
+    """rolling windows of histograms and summaries are kept per sample name"""
+    name = "request_seconds"
+    mc = MetricsCollection()
+    mc.ensureMetric(name, metricType=metricType)
+    for value in [1, 3]:
+        mc.addMetric(name, value, {label: "0.5"}, suffix=suffixes[0])
+        mc.addMetric(name, value * 2, suffix=suffixes[1])
+        mc.addMetric(name, value * 4, suffix=suffixes[2])
+        if value == 1:
+            mc.setWindow(name, 2, ["max"])
+
+    derived = mc.metrics[name].windowRepresentation()
+    assert {
+        family: [(i.name, i.labels, i.value) for i in d["instances"]]
+        for family, d in derived.items()
+    } == {
+        f"{name}{suffixes[0]}_window_max": [
+            (f"{name}{suffixes[0]}_window_max", {label: "0.5"}, 3.0)
+        ],
+        f"{name}{suffixes[1]}_window_max": [
+            (f"{name}{suffixes[1]}_window_max", {}, 6.0)
+        ],
+        f"{name}{suffixes[2]}_window_max": [
+            (f"{name}{suffixes[2]}_window_max", {}, 12.0)
+        ],
+    }
+    rendered = str(mc)
+    assert f'{name}{suffixes[0]}_window_max{{{label}="0.5"}} 3.0' in rendered
+    assert f"{name}{suffixes[2]}_window_max 12.0" in rendered
+    loaded = MetricsCollection()
+    loaded.load(rendered)
+    assert len(loaded.metrics) == 4
+
+
+def test_render_selection():
+    """check rendering only selected metrics and instances"""
+    loadString = """# HELP health_up Service health
+# TYPE health_up gauge
+health_up{service="api"} 1
+health_up{service="db"} 0
+# HELP business_orders_total Orders
+# TYPE business_orders_total counter
+business_orders_total{shop="eu"} 5
+business_orders_total{shop="us"} 7
+# HELP business_revenue Revenue
+# TYPE business_revenue gauge
+business_revenue{shop="eu"} 10.5
+# HELP healthcheck_duration Health check duration
+# TYPE healthcheck_duration gauge
+healthcheck_duration{service="api"} 0.2
+"""
+    mc = MetricsCollection()
+    mc.load(loadString)
+
+    assert mc.render() == str(mc)
+    assert mc.selectNames("health") == ["health_up", "healthcheck_duration"]
+    assert mc.selectNames(["business_", "health_"], "business_rev") == [
+        "health_up",
+        "business_orders_total",
+    ]
+    assert mc.selectNames(exclude=["business"]) == [
+        "health_up",
+        "healthcheck_duration",
+    ]
+    assert mc.selectNames("nothing") == []
+
+    assert (
+        mc.render(include="health_")
+        == """# HELP health_up Service health
+# TYPE health_up gauge
+health_up{service="api"} 1
+health_up{service="db"} 0
+"""
+    )
+    assert (
+        mc.render(include="business", labelMatchers={"shop": "eu"})
+        == """# HELP business_orders_total Orders
+# TYPE business_orders_total counter
+business_orders_total{shop="eu"} 5
+
+# HELP business_revenue Revenue
+# TYPE business_revenue gauge
+business_revenue{shop="eu"} 10.5
+"""
+    )
+    assert (
+        mc.render(labelMatchers={"service": re.compile("a.*")})
+        == """# HELP health_up Service health
+# TYPE health_up gauge
+health_up{service="api"} 1
+
+# HELP healthcheck_duration Health check duration
+# TYPE healthcheck_duration gauge
+healthcheck_duration{service="api"} 0.2
+"""
+    )
+
+    # name index follows changes of the collection
+    mc.renameMetrics("health_up", "zz_up")
+    assert mc.selectNames("health") == ["healthcheck_duration"]
+    assert mc.selectNames("zz") == ["zz_up"]
+
+
+def test_render_shards():
+    """check series being distributed onto cached shard renderings"""
+    shards = 3
+    mc = MetricsCollection()
+    mc.addMetric("sharded_metric", helpText="Sharded", metricType="gauge")
+    for i in range(30):
+        mc.addMetric("sharded_metric", i, {"series": str(i)})
+
+    renderings = [mc.renderShard(k, shards) for k in range(shards)]
+    lines = [l for r in renderings for l in r.splitlines() if not l.startswith("#")]
+    assert sorted(lines) == sorted(
+        l for l in str(mc).splitlines() if not l.startswith("#")
+    )
+    assert all(r.startswith("# HELP sharded_metric Sharded") for r in renderings)
+
+    # cached as long as nothing changes
+    assert mc.renderShard(0, shards) is renderings[0]
+
+    # assignment is stable when series are added
+    assignment = {
+        i.labels["series"]: k
+        for k, part in enumerate(mc.metrics["sharded_metric"].partition(shards))
+        for i in part
+    }
+    for i in range(30, 60):
+        mc.addMetric("sharded_metric", i, {"series": str(i)})
+    assert mc.renderShard(0, shards) != renderings[0]
+    for k, part in enumerate(mc.metrics["sharded_metric"].partition(shards)):
+        for i in part:
+            if i.labels["series"] in assignment:
+                assert assignment[i.labels["series"]] == k
+
+    with pytest.raises(ValueError):
+        mc.renderShard(shards, shards)
+
+
+def test_jump_hash_moves_few_keys():
+    """only about `1/n` keys move when adding the n-th bucket"""
+    keys = [MetricsCollection.seriesHash("m", {"i": str(i)}) for i in range(1000)]
+    before = [MetricsCollection.jumpHash(k, 9) for k in keys]
+    after = [MetricsCollection.jumpHash(k, 10) for k in keys]
+    moved = [(b, a) for b, a in zip(before, after) if b != a]
+    assert all(a == 9 for b, a in moved)
+    assert 50 < len(moved) < 150
+    assert MetricsCollection.seriesHash(
+        "m", {"a": "1", "b": "2"}
+    ) == MetricsCollection.seriesHash("m", {"b": "2", "a": "1"})
+
+
+def test_histogram_observations():
+    """check observations being rendered as histogram samples"""
+    mc = MetricsCollection()
+    observations = mc.observe(
+        "request_seconds",
+        {"path": "/"},
+        buckets=[1, 0.1, float("inf")],
+        helpText="Request duration",
+    )
+    assert mc.observe("request_seconds", {"path": "/"}) is observations
+    for value in [0.05, 0.1, 0.5, 3]:
+        observations.observe(value)
+
+    assert (
+        str(mc)
+        == """# HELP request_seconds Request duration
+# TYPE request_seconds histogram
+request_seconds_bucket{path="/",le="0.1"} 2
+request_seconds_bucket{path="/",le="1.0"} 3
+request_seconds_bucket{path="/",le="+Inf"} 4
+request_seconds_sum{path="/"} 3.65
+request_seconds_count{path="/"} 4
+"""
+    )
+    # all samples of a histogram series belong to the same shard
+    shards = [len(part) for part in mc.metrics["request_seconds"].partition(4) if part]
+    assert shards == [5]
+
+
+def test_summary_observations_and_timers():
+    """check timing decorators and context managers for summaries"""
+    mc = MetricsCollection()
+
+    @mc.timed("job_seconds", {"job": "sync"}, metricType="summary")
+    def syncJob(value):
+        return value * 2
+
+    @mc.timed("job_seconds", {"job": "async"}, metricType="summary")
+    async def asyncJob(value):
+        await asyncio.sleep(0)
+        return value * 3
+
+    assert syncJob(2) == 4
+    assert syncJob.__name__ == "syncJob"
+    assert asyncio.run(asyncJob(2)) == 6
+    with mc.time("job_seconds", {"job": "block"}):
+        pass
+    with pytest.raises(RuntimeError):
+        with mc.time("job_seconds", {"job": "block"}):
+            raise RuntimeError("observed anyway")
+
+    metric = mc.metrics["job_seconds"]
+    assert metric.type == "summary"
+    rendered = str(mc)
+    for job, count in (("sync", 1), ("async", 1), ("block", 2)):
+        assert f'job_seconds_count{{job="{job}"}} {count}\n' in rendered
+        sumInstance = metric.observe({"job": job}).instances[0]
+        assert sumInstance.name == "job_seconds_sum"
+        assert 0 <= sumInstance.value < 1
+    assert "_bucket" not in rendered
+
+
+def test_observations_on_gauge(caplog):
+    """observations are only meant for histograms and summaries"""
+    mc = MetricsCollection()
+    mc.addMetric("some_gauge", metricType="gauge")
+    with caplog.at_level(level="DEBUG"):
+        assert mc.observe("some_gauge") is None
+
+    assert (
+        "Observations are only supported for “histogram” and “summary” metrics, but “some_gauge” is “gauge”."
+        in [rec.message for rec in caplog.records if rec.levelno == logging.ERROR]
+    )
+    assert len(mc.metrics["some_gauge"]) == 0
+
+    def job():
+        return 42
+
+    assert mc.timed("some_gauge")(job) is job
+    with mc.time("some_gauge"):
+        pass
+    assert len(mc.metrics["some_gauge"]) == 0
+
+
+def test_observations_created_concurrently():
+    """observations created by another thread while waiting for the lock are reused"""
+    mc = MetricsCollection(threadSafe=True)
+    observations = mc.observe("wait_seconds", {"job": "a"})
+    metric = mc.metrics["wait_seconds"]
+
+    class CreatedMeanwhile(dict):
+        """misses the first lookup, like one done before another thread finished"""
+
+        missed = False
+
+        def get(self, key, default=None):
+            if not self.missed:
+                self.missed = True
+                return default
+            return super().get(key, default)
+
+    metric.observations = CreatedMeanwhile(metric.observations)
+    assert mc.observe("wait_seconds", {"job": "a"}) is observations
+    assert len(metric) == len(Observations.defaultBuckets) + 3
+
+
+def test_observations_change_version(mocker):
+    """observing skips the lock of the metric, but still changes the version"""
+    mc = MetricsCollection(threadSafe=True)
+    histogram = mc.observe("wait_seconds", {"job": "a"}, buckets=[1])
+    summary = mc.observe("size_bytes", {"job": "a"})
+    metric = mc.metrics["wait_seconds"]
+    rendered = str(mc)
+    version = mc.version()
+    lock = metric.lock
+    metric.lock = mocker.MagicMock()
+    histogram.observe(0.5)
+    metric.lock.__enter__.assert_not_called()
+    metric.lock = lock
+    assert mc.version() != version
+    version = mc.version()
+    summary.observe(10)
+    assert mc.version() != version
+    assert str(mc) != rendered
+    assert (metric.observed(), mc.metrics["size_bytes"].observed()) == (1, 1)
+
+
+def test_histogram_buckets_of_later_series(caplog):
+    """the buckets of a histogram are defined by its first series"""
+    mc = MetricsCollection()
+    first = mc.observe("size_bytes", {"kind": "a"}, buckets=[10, 100])
+    with caplog.at_level(level="DEBUG"):
+        second = mc.observe("size_bytes", {"kind": "b"}, buckets=[1, 1000])
+        third = mc.observe("size_bytes", {"kind": "c"}, buckets=[100, 10])
+    assert first.bounds == second.bounds == third.bounds == [10.0, 100.0]
+    warnings = [rec.message for rec in caplog.records if rec.levelno == logging.WARNING]
+    assert warnings == [
+        "Ignoring buckets [1.0, 1000.0] for a new series of “size_bytes”, the histogram uses [10.0, 100.0]."
+    ]
+
+
+def test_histogram_default_buckets():
+    """histograms use default buckets if none are given"""
+    mc = MetricsCollection()
+    observations = mc.observe("default_seconds")
+    assert observations.bounds == list(Observations.defaultBuckets)
+    assert len(mc.metrics["default_seconds"]) == len(Observations.defaultBuckets) + 3
+
+
+def test_thread_safe_updates_and_rendering():
+    """check concurrent updates being atomic while rendering concurrently"""
+    mc = MetricsCollection(threadSafe=True)
+    mc.ensureMetric("shared_total", metricType="counter")
+    threads = 8
+    increments = 500
+    errors = []
+    done = threading.Event()
+
+    def writer(idx):
+        try:
+            for i in range(increments):
+                mc.incMetric("shared_total", 1, {"kind": "shared"})
+                mc.addMetric(f"worker_{idx}_value", i, {"series": str(i % 7)})
+        except Exception as e:  # pragma: no cover
+            errors.append(e)
+
+    def reader():
+        try:
+            while not done.is_set():
+                rendered = str(mc)
+                assert rendered.endswith("\n")
+        except Exception as e:  # pragma: no cover
+            errors.append(e)
+
+    readerThread = threading.Thread(target=reader)
+    readerThread.start()
+    writers = [threading.Thread(target=writer, args=(i,)) for i in range(threads)]
+    for t in writers:
+        t.start()
+    for t in writers:
+        t.join()
+    done.set()
+    readerThread.join()
+
+    assert errors == []
+    assert mc.metrics["shared_total"][0].value == threads * increments
+    assert len(mc.metrics) == threads + 1
+    for i in range(threads):
+        assert len(mc.metrics[f"worker_{i}_value"]) == 7
+    assert f'shared_total{{kind="shared"}} {threads * increments}\n' in str(mc)
+
+
+def test_thread_safe_consistent_snapshot():
+    """changes done while rendering wait until all metrics are copied"""
+    mc = MetricsCollection(threadSafe=True)
+    mc.addMetric("first", 1, helpText="first", metricType="gauge")
+    mc.addMetric("second", 1, helpText="second", metricType="gauge")
+    first = mc.metrics["first"]
+    representation = first.representation
+    writers = []
+
+    def change():
+        mc.addMetric("second", 2)
+        mc.setHelp("second", "changed")
+        mc.renameMetrics("second", "renamed")
+
+    def slowRepresentation(*args, **kwargs):
+        writer = threading.Thread(target=change)
+        writer.start()
+        writer.join(0.2)
+        writers.append(writer)
+        return representation(*args, **kwargs)
+
+    first.representation = slowRepresentation
+    rendered = str(mc)
+    first.representation = representation
+    for writer in writers:
+        writer.join()
+
+    assert "# HELP second second\n" in rendered
+    assert "second 1\n" in rendered
+    assert "renamed" not in rendered
+    rendered = str(mc)
+    assert "# HELP renamed changed\n" in rendered
+    assert "renamed 2\n" in rendered
+
+
+def test_inc_metric_creates_and_parses():
+    """increasing creates missing instances and works on loaded string values"""
+    mc = MetricsCollection()
+    mc.load("loaded_total 3")
+    mc.incMetric("loaded_total", 2)
+    mc.incMetric("loaded_total", 5, {"new": "series"})
+    assert [i.value for i in mc.metrics["loaded_total"]] == [5, 5]
+
+
+def test_collectors(caplog):
+    """check collectors being run on render and merged into the output"""
+    mc = MetricsCollection()
+    mc.addMetric("queue_depth", 1, {"queue": "static"}, metricType="gauge")
+    calls = []
+
+    def queues(collection):
+        calls.append(True)
+        collection.addMetric("queue_depth", 5, {"queue": "lazy"}, metricType="gauge")
+        collection.addMetric(
+            "disk_usage", len(calls), helpText="Disk usage", metricType="gauge"
+        )
+
+    def failing(collection):
+        raise RuntimeError("broken")
+
+    mc.registerCollector(queues, minInterval=60)
+    mc.registerCollector(failing)
+
+    with caplog.at_level(level="DEBUG"):
+        rendered = str(mc)
+    assert (
+        rendered
+        == """# TYPE queue_depth gauge
+queue_depth{queue="static"} 1
+queue_depth{queue="lazy"} 5
+
+# HELP disk_usage Disk usage
+# TYPE disk_usage gauge
+disk_usage 1
+"""
+    )
+    assert "Collector “failing” failed: broken" in [
+        rec.message for rec in caplog.records if rec.levelno == logging.ERROR
+    ]
+
+    # reused within minimal interval
+    assert str(mc) == rendered
+    assert len(calls) == 1
+    assert mc.render(include="disk").endswith("# TYPE disk_usage gauge\ndisk_usage 1\n")
+    assert "disk_usage 1" in mc.renderShard(0, 1)
+
+    mc.collectors["queues"].minInterval = 0
+    assert "disk_usage 2" in str(mc)
+
+    mc.unregisterCollector("queues")
+    mc.unregisterCollector("failing")
+    assert str(mc) == '# TYPE queue_depth gauge\nqueue_depth{queue="static"} 1\n'
+
+
+def test_collector_timeout(caplog):
+    """slow collectors do not stretch the rendering, their result is used later"""
+    mc = MetricsCollection()
+    release = threading.Event()
+
+    def slow(collection):
+        release.wait(5)
+        collection.addMetric("slow_metric", 1)
+
+    mc.registerCollector(slow, timeout=0.05)
+    with caplog.at_level(level="DEBUG"):
+        started = time.monotonic()
+        assert str(mc) == "\n"
+        assert time.monotonic() - started < 1
+    assert (
+        "Collector “slow” did not finish within 0.05 seconds, using last result."
+        in [rec.message for rec in caplog.records if rec.levelno == logging.WARNING]
+    )
+
+    release.set()
+    mc.collectors["slow"].future.result(timeout=5)
+    assert str(mc) == "slow_metric 1\n"
+
+    with caplog.at_level(level="DEBUG"):
+        mc.registerCollector(slow, timeout=0.05)
+    assert "Replacing already registered collector “slow”." in [
+        rec.message for rec in caplog.records if rec.levelno == logging.WARNING
+    ]
+    mc.unregisterCollector("slow")
+
+
+def test_write_textfile(tmp_path, mocker):
+    """check atomic writing of metrics files only on changes"""
+    path = tmp_path / "app.prom"
+    mc = MetricsCollection()
+    mc.addMetric("textfile_metric", 1)
+
+    assert mc.writeTextfile(str(path))
+    assert path.read_text() == str(mc)
+    assert oct(path.stat().st_mode & 0o777) == oct(0o644)
+    assert not mc.writeTextfile(str(path))
+
+    # existing file with same content is not rewritten by a new collection
+    other = MetricsCollection()
+    other.addMetric("textfile_metric", 1)
+    assert not other.writeTextfile(str(path))
+
+    mc.addMetric("textfile_metric", 2)
+    assert mc.writeTextfile(str(path))
+    assert "textfile_metric 2" in path.read_text()
+
+    # removed files are written again
+    path.unlink()
+    assert mc.writeTextfile(str(path))
+
+    # failing writes leave neither target nor temporary files behind
+    mocker.patch("os.replace", side_effect=OSError("disk full"))
+    mc.addMetric("textfile_metric", 3)
+    with pytest.raises(OSError):
+        mc.writeTextfile(str(path))
+    assert "textfile_metric 2" in path.read_text()
+    assert sorted(p.name for p in tmp_path.iterdir()) == ["app.prom"]
+
+
+def test_write_textfiles(tmp_path):
+    """check fanning out multiple collections into separate files"""
+    collections = {}
+    for name in ["first", "second"]:
+        mc = MetricsCollection()
+        mc.addMetric(f"{name}_metric", 1)
+        collections[str(tmp_path / f"{name}.prom")] = mc
+
+    assert MetricsCollection.writeTextfiles(collections) == {
+        path: True for path in collections
+    }
+    assert MetricsCollection.writeTextfiles(collections) == {
+        path: False for path in collections
+    }
+    assert (tmp_path / "second.prom").read_text() == "second_metric 1\n"
+
+
+def test_remove_metrics(caplog):
+    """check removing instances and whole metrics"""
+    mc = prepareMetricsObjectForTest()
+    name = metric_names[2]
+    before = len(mc.metrics[name])
+    assert mc.removeMetric(name, metric_labels[2][1])
+    assert len(mc.metrics[name]) == before - 1
+    assert mc.metrics[name].instances == [
+        mc.metrics[name][0],
+        mc.metrics[name][1],
+    ]
+    assert metric_labels[2][1]["label1"] not in str(mc)
+
+    with caplog.at_level(level="DEBUG"):
+        assert not mc.removeMetric(name, metric_labels[2][1])
+        assert not mc.removeMetric("unknown_metric")
+        assert mc.removeMetrics(name)
+        assert not mc.removeMetrics(name)
+    assert name not in mc.metrics
+    assert mc.selectNames(name) == []
+    debugLogs = [rec.message for rec in caplog.records if rec.levelno == logging.DEBUG]
+    assert f"No instance of “unknown_metric” with labels {{}} to remove." in debugLogs
+    assert f"No metric “{name}” to remove." in debugLogs
+
+
+def test_metrics_directory(tmp_path):
+    """check incremental reloading of exposition files in a directory"""
+    first = tmp_path / "first.prom"
+    second = tmp_path / "second.prom"
+    (tmp_path / "ignored.txt").write_text("ignored_metric 1\n")
+    first.write_text(
+        """# HELP shared_metric Shared between files
+# TYPE shared_metric gauge
+shared_metric{file="first"} 1
+# HELP first_only Only in first file
+first_only 1
+"""
+    )
+    second.write_text(
+        """# TYPE shared_metric gauge
+shared_metric{file="second"} 2
+"""
+    )
+
+    directory = MetricsDirectory(str(tmp_path), typedValues=True)
+    assert directory.refresh()
+    assert not directory.refresh()
+    assert (
+        str(directory)
+        == """# HELP shared_metric Shared between files
+# TYPE shared_metric gauge
+shared_metric{file="first"} 1
+shared_metric{file="second"} 2
+
+# HELP first_only Only in first file
+first_only 1
+"""
+    )
+    sharedMetric = directory.collection.metrics["shared_metric"]
+
+    # touched but same content is not reloaded
+    os.utime(second, ns=(0, 0))
+    assert not directory.refresh()
+
+    # changed file replaces its contribution only
+    first.write_text(
+        """# TYPE shared_metric gauge
+shared_metric{file="first",new="label"} 3
+"""
+    )
+    assert directory.refresh()
+    assert directory.collection.metrics["shared_metric"] is sharedMetric
+    assert "first_only" not in directory.collection.metrics
+    assert [i.labels for i in sharedMetric] == [
+        {"file": "second"},
+        {"file": "first", "new": "label"},
+    ]
+
+    # deleted file removes its series and families
+    second.unlink()
+    assert directory.refresh()
+    assert [i.value for i in sharedMetric] == [3]
+    first.unlink()
+    assert directory.refresh()
+    assert directory.collection.metrics == {}
+
+
+def test_metrics_directory_shared_series(tmp_path):
+    """series, help and type exported by multiple files survive deleting one"""
+    a = tmp_path / "a.prom"
+    b = tmp_path / "b.prom"
+    a.write_text(
+        """# HELP x from a
+# TYPE x gauge
+x{k="v"} 1
+"""
+    )
+    b.write_text(
+        """# HELP x from b
+# TYPE x counter
+x{k="v"} 2
+x{k="w"} 2
+"""
+    )
+    directory = MetricsDirectory(str(tmp_path), typedValues=True)
+    directory.refresh()
+    x = directory.collection.metrics["x"]
+    assert (x.helpText, x.type) == ("from b", "counter")
+    assert [i.value for i in x] == [2, 2]
+
+    # the file with the last name keeps winning if another one changes
+    a.write_text(
+        """# HELP x from a
+# TYPE x gauge
+x{k="v"} 3
+"""
+    )
+    directory.refresh()
+    assert [i.value for i in x] == [2, 2]
+
+    b.unlink()
+    directory.refresh()
+    assert (x.helpText, x.type) == ("from a", "gauge")
+    assert [(i.labels, i.value) for i in x] == [({"k": "v"}, 3)]
+
+    b.write_text('x{k="v"} 4\n')
+    directory.refresh()
+    assert (x.helpText, x.type) == ("from a", "gauge")
+    assert [i.value for i in x] == [4]
+
+    # dropping the series from the file loaded last applies the other value again
+    b.write_text('x{k="w"} 5\n')
+    directory.refresh()
+    assert [(i.labels, i.value) for i in x] == [({"k": "v"}, 3), ({"k": "w"}, 5)]
+
+
+def test_render_gzip():
+    """check gzip compressed rendering being cached until changes"""
+    mc = prepareMetricsObjectForTest()
+    compressed = mc.renderGzip()
+    assert gzip.decompress(compressed).decode() == str(mc)
+    assert mc.renderGzip() is compressed
+    assert mc.renderGzip(compressLevel=1) is not compressed
+
+    mc.addMetric(metric_names[0], 42)
+    changed = mc.renderGzip()
+    assert changed is not compressed
+    assert gzip.decompress(changed).decode() == str(mc)
+
+    assert gzip.decompress(MetricsCollection().renderGzip()) == b"\n"
+
+
+def test_render_stream_matches_stripped_template():
+    """streamed rendering strips surrounding whitespace like a full rendering"""
+    loadString = "first_metric 1\n# HELP second_metric Second\nsecond_metric 2\n"
+    mc = MetricsCollection()
+    mc.load(loadString)
+    metrics = mc.prepare()
+    expected = mc.template().render(metrics=metrics).strip() + "\n"
+    assert "".join(mc._stream(metrics)) == expected
+    assert str(mc) == expected
+
+
+def test_wal_restores_state(tmp_path, caplog):
+    """check the state of a collection surviving a restart by its write-ahead log"""
+    path = str(tmp_path / "state")
+    mc = MetricsCollection()
+    mc.enableWal(path, syncInterval=0)
+    mc.addMetric("requests_total", 5, {"code": "200"}, "Requests", "counter")
+    mc.incMetric("requests_total", 2, {"code": "200"})
+    mc.incMetric("requests_total", 1, {"code": "500"})
+    mc.addMetric("temperature", 21.5, helpText="Temperature", metricType="gauge")
+    mc.addMetric("removed_metric", 1)
+    mc.addMetric("removed_metric", 2, {"other": "series"})
+    mc.removeMetric("removed_metric", {"other": "series"})
+    mc.removeMetrics("removed_metric")
+    with caplog.at_level(level="DEBUG"):
+        mc.addMetric("temperature", "unknown", {"sensor": "broken"})
+    assert "Value `unknown` of “temperature” is not numeric and not logged." in [
+        rec.message for rec in caplog.records if rec.levelno == logging.WARNING
+    ]
+    mc.removeMetric("temperature", {"sensor": "broken"})
+    # no `disableWal`, so simulate a crash after the last synced batch
+
+    restored = MetricsCollection()
+    restored.enableWal(path)
+    assert str(restored) == str(mc)
+    assert restored.metrics["requests_total"][0].value == 7
+    assert restored.metrics["requests_total"].type == "counter"
+    assert "removed_metric" not in str(restored)
+    assert os.path.exists(f"{path}.snapshot")
+    assert os.path.getsize(f"{path}.wal") == 0
+
+    restored.addMetric("temperature", 22.0)
+    restored.disableWal()
+    again = MetricsCollection()
+    again.enableWal(path)
+    assert "temperature 22\n" in str(again)
+    again.disableWal()
+
+
+def test_wal_compaction_and_truncated_log(tmp_path, caplog):
+    """check compaction keeping the log small and torn records being ignored"""
+    path = str(tmp_path / "state")
+    mc = MetricsCollection(threadSafe=True)
+    wal = mc.enableWal(path, syncInterval=0, maxBytes=200)
+    for i in range(100):
+        mc.addMetric("compacted_total", i, {"series": str(i % 3)}, metricType="counter")
+    wal.close()
+    assert os.path.getsize(f"{path}.wal") < 400
+    assert not os.path.exists(f"{path}.wal.old")
+
+    with open(f"{path}.wal", "ab") as f:
+        f.write(MetricsWal._value.pack(MetricsWal.VALUE, 0, 1.0)[:7])
+    restored = MetricsCollection()
+    with caplog.at_level(level="DEBUG"):
+        restored.enableWal(path)
+    assert f"Ignoring incomplete records at the end of “{path}.wal”." in [
+        rec.message for rec in caplog.records if rec.levelno == logging.WARNING
+    ]
+    assert [i.value for i in restored.metrics["compacted_total"]] == [99, 97, 98]
+    restored.disableWal()
+
+
+def test_wal_series_ids_not_reused(tmp_path):
+    """ids of removed series are never given to new ones"""
+    path = str(tmp_path / "state")
+    mc = MetricsCollection()
+    mc.enableWal(path, syncInterval=0)
+    mc.addMetric("a", 1)
+    mc.addMetric("b", 2)
+    mc.removeMetric("a")
+    mc.addMetric("c", 3)
+    mc.addMetric("b", 20)
+
+    restored = MetricsCollection()
+    restored.enableWal(path)
+    assert {name: m[0].value for name, m in restored.metrics.items() if len(m)} == {
+        "b": 20,
+        "c": 3,
+    }
+    restored.disableWal()
+
+
+def test_wal_removal_after_restart(tmp_path):
+    """series restored from the snapshot stay removed after the next restart"""
+    path = str(tmp_path / "state")
+    mc = MetricsCollection()
+    mc.enableWal(path, syncInterval=0)
+    mc.addMetric("x", 5, {"k": "v"})
+    mc.addMetric("y", 1)
+    mc.addMetric("z", 1)
+    mc.disableWal()
+
+    restarted = MetricsCollection()
+    restarted.enableWal(path, syncInterval=0)
+    assert restarted.metrics["x"].getInstance({"k": "v"}).value == 5
+    restarted.removeMetric("x", {"k": "v"})
+    restarted.removeMetrics("y")
+    restarted.wal.flush()
+    # compacting on every record, also on removals
+    restarted.wal.maxBytes = 1
+    restarted.removeMetric("z")
+    assert not os.path.exists(f"{path}.wal.old")
+    restarted.disableWal()
+
+    again = MetricsCollection()
+    again.enableWal(path)
+    assert all(len(m) == 0 for m in again.metrics.values())
+    again.disableWal()
+
+
+def test_wal_rename_and_merge_after_restart(tmp_path):
+    """renames, merges and changed definitions are kept across restarts"""
+    path = str(tmp_path / "state")
+    mc = MetricsCollection()
+    mc.enableWal(path, syncInterval=0)
+    mc.addMetric("a_total", 5, {"x": "1"}, metricType="counter")
+    mc.addMetric("b_total", 7, {"x": "2"}, metricType="counter")
+    mc.renameMetrics("a_total", "c_total")
+    mc.disableWal()
+
+    restarted = MetricsCollection()
+    restarted.enableWal(path, syncInterval=0)
+    assert sorted(restarted.metrics) == ["b_total", "c_total"]
+    restarted.mergeMetrics("c_total", "b_total")
+    restarted.setHelp("c_total", "merged")
+    # unchanged definitions do not compact
+    compact = restarted.wal.compact
+    restarted.wal.compact = None
+    restarted.setType("c_total", "counter")
+    restarted.addMetric("c_total", 7, {"x": "2"}, helpText="merged")
+    restarted.wal.compact = compact
+    restarted.disableWal()
+
+    again = MetricsCollection()
+    again.enableWal(path)
+    assert list(again.metrics) == ["c_total"]
+    metric = again.metrics["c_total"]
+    assert (metric.type, metric.helpText) == ("counter", "merged")
+    assert sorted((i.labels["x"], i.value) for i in metric.instances) == [
+        ("1", 5),
+        ("2", 7),
+    ]
+    again.setType("c_total", "gauge")
+    again.disableWal()
+
+    last = MetricsCollection()
+    last.enableWal(path)
+    assert last.metrics["c_total"].type == "gauge"
+    last.disableWal()
+
+
+def test_wal_compaction_waits_for_running_one(tmp_path):
+    """a compaction waits for the one running in background and skips strings"""
+    path = str(tmp_path / "state")
+    mc = MetricsCollection(threadSafe=True)
+    wal = mc.enableWal(path, syncInterval=0)
+    mc.addMetric("state", 1)
+    mc.metrics["state"].addMetric("n/a", {"kind": "string"})
+    snapshot = wal.snapshot
+    release = threading.Event()
+
+    def slowSnapshot():
+        release.wait()
+        return snapshot()
+
+    wal.snapshot = slowSnapshot
+    wal.compact(wait=False)
+    running = wal._compaction
+    assert isinstance(running, threading.Thread)
+    threading.Timer(0.1, release.set).start()
+    wal.compact()
+    assert not running.is_alive()
+    mc.disableWal()
+
+    restored = MetricsCollection()
+    restored.enableWal(path)
+    assert [i.labels for i in restored.metrics["state"]] == [{}]
+    restored.disableWal()
+
+
+@pytest.mark.parametrize(
+    ("data", "message"),
+    (
+        (b"\x00\x00\x00", "Ignoring incomplete records at the end of “{path}”."),
+        (
+            MetricsWal._define.pack(MetricsWal.DEFINE, 0, 100) + b"{}",
+            "Ignoring incomplete records at the end of “{path}”.",
+        ),
+        (b"\x02\x00", "Ignoring incomplete records at the end of “{path}”."),
+        (b"\x09", "Unknown record at byte 0 of “{path}”."),
+    ),
+)
+def test_wal_replay_broken_records(tmp_path, caplog, data, message):
+    """check broken records ending the replay of a file"""
+    path = tmp_path / "broken.wal"
+    path.write_bytes(data)
+    with caplog.at_level(level="DEBUG"):
+        assert MetricsWal.replay(str(path), MetricsCollection()) == 0
+    assert message.format(path=path) in [rec.message for rec in caplog.records]
+
+
+@pytest.mark.parametrize(
+    ("value", "expected"),
+    (("1.5", 1.5), (2, 2.0), ("unknown", None), (None, None)),
+)
+def test_wal_numeric(value, expected):
+    """only numeric values are logged"""
+    assert MetricsWal.numeric(value) == expected
+
+
+def test_load_with_relabeling():
+    """check relabel rules being applied while loading"""
+    loadString = """# HELP http_requests_total handled requests
+# TYPE http_requests_total counter
+http_requests_total{code="200",path="/",pod="web-1"} 10
+http_requests_total{code="500",path="/",pod="web-1"} 2
+http_requests_total{code="200",path="/health",pod="web-2"} 99
+# HELP go_goroutines number of goroutines
+# TYPE go_goroutines gauge
+go_goroutines{pod="web-1"} 8
+"""
+    relabeler = MetricsRelabeler(
+        [
+            {"action": "drop", "source_labels": ["__name__"], "regex": "go_.*"},
+            {"action": "drop", "source_labels": ["path"], "regex": "/health"},
+            {
+                "source_labels": ["pod", "code"],
+                "regex": "(.*)-(\\d+);(\\d).*",
+                "target_label": "class",
+                "replacement": "${3}xx@$1",
+            },
+            {
+                "source_labels": ["__name__"],
+                "regex": "(.*)",
+                "target_label": "__name__",
+                "replacement": "app_$1",
+            },
+            {"action": "labelmap", "regex": "p(od|ath)", "replacement": "k8s_p$1"},
+            {"action": "labeldrop", "regex": "code|pod|path"},
+        ]
+    )
+    mc = MetricsCollection()
+    mc.load(loadString, relabeler=relabeler)
+
+    assert list(mc.metrics) == ["app_http_requests_total"]
+    metric = mc.metrics["app_http_requests_total"]
+    assert metric.type == "counter"
+    assert metric.helpText == "handled requests"
+    assert [i.labels for i in metric] == [
+        {"k8s_pod": "web-1", "k8s_path": "/", "class": "2xx@web"},
+        {"k8s_pod": "web-1", "k8s_path": "/", "class": "5xx@web"},
+    ]
+
+
+def test_relabeler_rules(caplog):
+    """check keep, labelkeep and invalid rules"""
+    relabeler = MetricsRelabeler(
+        [
+            {"action": "keep", "source_labels": ["job"], "regex": "api|db"},
+            {"action": "labelkeep", "regex": "job"},
+        ]
+    )
+    assert relabeler.relabel("up", {"job": "api", "instance": "a:1"}) == (
+        "up",
+        {"job": "api"},
+    )
+    assert relabeler.relabel("up", {"job": "apis"}) is None
+    assert relabeler.relabel("up", {}) is None
+
+    emptied = MetricsRelabeler([{"target_label": "__name__", "replacement": ""}])
+    with caplog.at_level(level="DEBUG"):
+        assert emptied.relabel("up", {}) is None
+    assert (
+        "Relabeling removed the metric name of a series, dropping it."
+        in caplog.messages
+    )
+
+    with pytest.raises(ValueError):
+        MetricsRelabeler([{"action": "hashmod"}])
+    with pytest.raises(ValueError):
+        MetricsRelabeler([{"source_labels": ["job"]}])
+
+
+@pytest.mark.parametrize(
+    ("regex", "replacement", "value", "expected"),
+    (
+        ("(.*)-(.*)", "${2}_$1", "a-b", "b_a"),
+        ("(?P<zone>.*)", "zone=$zone", "eu", "zone=eu"),
+        # missing groups and names running on expand to an empty string
+        ("(.*)", "$2", "a", None),
+        ("(.*)", "$1abc", "a", None),
+        ("(.*)", "${1}abc", "a", "aabc"),
+        ("(.*)", "$$1 costs $", "a", "$1 costs $"),
+        # the regex has to match the whole value, also before a trailing newline
+        ("a$", "matched", "a\n", None),
+        ("a", "matched", "ab", None),
+    ),
+)
+def test_relabeler_replacement(regex, replacement, value, expected):
+    """check expanding replacements like Prometheus"""
+    relabeler = MetricsRelabeler(
+        [
+            {
+                "source_labels": ["source"],
+                "regex": regex,
+                "target_label": "target",
+                "replacement": replacement,
+            }
+        ]
+    )
+    assert relabeler.relabel("up", {"source": value})[1].get("target") == expected
+
+
+def test_select():
+    """check PromQL-like selectors being resolved by the inverted index"""
+    mc = MetricsCollection()
+    for job, code, value in [
+        ("api", "200", 1),
+        ("api", "500", 2),
+        ("api", "503", 3),
+        ("db", "500", 4),
+        ("", "404", 5),
+    ]:
+        labels = {"code": code}
+        if job:
+            labels["job"] = job
+        mc.addMetric("http_requests_total", value, labels, metricType="counter")
+    mc.addMetric("up", 1, {"job": "api"})
+
+    def values(selector):
+        return [i.value for i in mc.select(selector)]
+
+    assert values('http_requests_total{job="api",code=~"5.."}') == [2, 3]
+    assert values('http_requests_total{job!="api"}') == [4, 5]
+    assert values('http_requests_total{job=""}') == [5]
+    assert values('http_requests_total{job=~"|db"}') == [4, 5]
+    assert values('http_requests_total{job!~"a.*", code!="404"}') == [4]
+    assert values('{job="api"}') == [1, 2, 3, 1]
+    assert values('{__name__=~"u.", job="api"}') == [1]
+    assert values("up") == [1]
+    assert values("missing") == []
+
+    assert values('http_requests_total{job!=""}') == [1, 2, 3, 4]
+    assert values('{job=~".+"}') == [1, 2, 3, 4, 1]
+
+    mc.removeMetric("http_requests_total", {"job": "api", "code": "500"})
+    mc.addMetric("http_requests_total", 6, {"job": "api", "code": "502"})
+    assert values('http_requests_total{code=~"50."}') == [3, 4, 6]
+    # removing the last series of a label value updates the index
+    mc.removeMetric("up", {"job": "api"})
+    assert values('{job="api"}') == [1, 3, 6]
+    assert mc.metrics["up"].postings() == {}
+
+    metric = mc.metrics["http_requests_total"]
+    assert [i.value for i in metric.selectInstances([("code", "=~", "40.")])] == [5]
+    with pytest.raises(ValueError):
+        metric.selectInstances([("code", "==", "404")])
+
+
+@pytest.mark.parametrize(
+    "selector",
+    (
+        "1up",
+        "",
+        'up{job="a" code="b"}',
+        'up{job=~"("}',
+        "http_requests_total{job=api}",
+    ),
+)
+def test_select_invalid(selector):
+    """check malformed selectors being rejected"""
+    with pytest.raises(ValueError):
+        MetricsCollection().select(selector)
+
+
+@pytest.mark.parametrize(
+    ("value", "op", "expected", "matches"),
+    (
+        ("api", "=~", "a.*", True),
+        ("api", "!~", re.compile("a.*"), False),
+        ("api", "=", "api", True),
+        ("api", "!=", "api", False),
+    ),
+)
+def test_match_value(value, op, expected, matches):
+    """check single values against label matchers"""
+    assert MetricsCollection.matchValue(value, op, expected) == matches
+
+
+def test_match_value_unknown_operator():
+    """unknown operators are rejected"""
+    with pytest.raises(ValueError):
+        MetricsCollection.matchValue("api", "==", "api")
+
+
+def test_select_histogram_samples():
+    """check selecting single samples of histograms"""
+    mc = MetricsCollection()
+    mc.observe("latency_seconds", {"path": "/"}, buckets=[0.1, 1]).observe(0.5)
+    assert [
+        (i.name, i.labels.get("le"))
+        for i in mc.select('latency_seconds_bucket{le=~"1.*|\\\\+Inf"}')
+    ] == [
+        ("latency_seconds_bucket", "1.0"),
+        ("latency_seconds_bucket", "+Inf"),
+    ]
+    assert [i.value for i in mc.select("latency_seconds_count")] == [1]
+    assert len(mc.select('latency_seconds{path="/"}')) == 5
+    # `__name__` matchers see the sample names
+    assert len(mc.select('{__name__="latency_seconds_bucket"}')) == 3
+    assert [i.name for i in mc.select('{__name__=~"latency_seconds_(sum|count)"}')] == [
+        "latency_seconds_sum",
+        "latency_seconds_count",
+    ]
+    assert mc.select('{__name__="latency_seconds"}') == []
+
+
+def test_frame_round_trip():
+    """check converting a collection to a DataFrame and back"""
+    pd = pytest.importorskip("pandas")
+    mc = MetricsCollection()
+    mc.addMetric(
+        "http_requests_total",
+        1,
+        {"job": "api", "code": "200"},
+        helpText="handled requests",
+        metricType="counter",
+    )
+    mc.addMetric("http_requests_total", 2, {"job": "api", "code": "500"})
+    mc.addMetric("http_requests_total", 3, {"job": "db"})
+    mc.observe(
+        "latency_seconds", {"job": "api"}, buckets=[1], helpText="latency"
+    ).observe(0.5)
+
+    frame = mc.toFrame()
+    assert list(frame.columns) == list(MetricsCollection.frameColumns) + [
+        "job",
+        "code",
+        "le",
+    ]
+    assert len(frame) == 7
+    assert all(frame[c].dtype == "category" for c in frame.columns if c != "__value__")
+    assert frame["__value__"].tolist() == [1, 2, 3, 1, 1, 0.5, 1]
+    assert frame["code"].isna().tolist() == [False, False] + [True] * 5
+
+    restored = MetricsCollection()
+    restored.fromFrame(frame)
+    assert str(restored) == str(mc)
+
+    doubled = frame[frame["__name__"] == "http_requests_total"].copy()
+    doubled["__value__"] *= 2
+    restored.fromFrame(doubled)
+    assert [i.value for i in restored.metrics["http_requests_total"]] == [2, 4, 6]
+
+    analysis = MetricsCollection()
+    analysis.fromFrame(
+        pd.DataFrame(
+            {"__name__": ["ratio", "ratio"], "__value__": [0.25, 0.75], "shard": [1, 2]}
+        )
+    )
+    assert str(analysis) == 'ratio{shard="1"} 0.25\nratio{shard="2"} 0.75\n'
+    with pytest.raises(ValueError):
+        analysis.fromFrame(pd.DataFrame({"__name__": ["ratio"]}))
+
+
+def test_frame_conversions():
+    """check label and value conversions and the bulk update of metrics"""
+    pd = pytest.importorskip("pandas")
+    mc = MetricsCollection()
+    mc.load(
+        """# HELP loaded_total loaded
+# TYPE loaded_total counter
+loaded_total{kind="a"} 1.5
+loaded_total{kind="b"} 2
+other 1
+"""
+    )
+    frame = mc.toFrame(["loaded_total"])
+    assert frame["__value__"].tolist() == [1.5, 2]
+
+    target = MetricsCollection()
+    target.addMetric("loaded_total", 0, {"kind": "a"}, "old help", "gauge")
+    target.addRecordingRule(SumRecordingRule("loaded:sum", "loaded_total"))
+    target.fromFrame(frame)
+    assert target.metrics["loaded_total"].type == "counter"
+    assert target.metrics["loaded_total"].helpText == "loaded"
+    assert target.metrics["loaded:sum"][0].value == 3.5
+
+    # integral floats of numeric label columns, e.g. with missing values
+    numbers = MetricsCollection()
+    numbers.fromFrame(
+        pd.DataFrame(
+            {
+                "__name__": ["shard_size"] * 3,
+                "__value__": [1.0, 2.0, 1e300],
+                "shard": [1, None, 2.5],
+                "zone": pd.Categorical(["a", "", "b"]),
+            }
+        )
+    )
+    assert [(i.labels, i.value) for i in numbers.metrics["shard_size"]] == [
+        ({"shard": "1", "zone": "a"}, 1),
+        ({}, 2),
+        ({"shard": "2.5", "zone": "b"}, 1e300),
+    ]
+
+
+def test_frame_into_logged_collection(tmp_path):
+    """instances added from a DataFrame are written into the write-ahead log"""
+    pd = pytest.importorskip("pandas")
+    path = str(tmp_path / "state")
+    mc = MetricsCollection()
+    mc.enableWal(path, syncInterval=0)
+    mc.fromFrame(pd.DataFrame({"__name__": ["a", "b", "a"], "__value__": [1, 2, 3]}))
+    mc.disableWal()
+    restored = MetricsCollection()
+    restored.enableWal(path)
+    assert str(restored) == str(mc)
+    assert [restored.metrics[name][0].value for name in ("a", "b")] == [3, 2]
+    restored.disableWal()
+
+
+def test_merge_collection():
+    """check merging collections with extra labels"""
+    mc = MetricsCollection()
+    mc.addMetric("up", 1, {"job": "node"}, helpText="target up", metricType="gauge")
+    other = MetricsCollection()
+    other.addMetric("up", 0, {"instance": "a"}, helpText="other help")
+    other.addMetric(
+        "jobs_total", 3, {"job": "inner"}, helpText="jobs", metricType="counter"
+    )
+    mc.mergeCollection(other, {"job": "federate"})
+    assert mc.metrics["up"].helpText == "target up"
+    assert [i.labels for i in mc.metrics["up"]] == [
+        {"job": "node"},
+        {"instance": "a", "job": "federate"},
+    ]
+    assert [i.labels for i in mc.metrics["jobs_total"]] == [
+        {"exported_job": "inner", "job": "federate"}
+    ]
+    assert mc.metrics["jobs_total"].type == "counter"
+
+
+def test_scraper(caplog):
+    """check concurrent scraping of local exporters with reused connections"""
+    payload = b"""# HELP requests_total handled requests
+# TYPE requests_total counter
+requests_total{instance="inner"} 7
+"""
+    connections = []
+
+    async def exporter(reader, writer):
+        connections.append(writer)
+        while True:
+            requestLine = await reader.readline()
+            if not requestLine:
+                break
+            path = requestLine.split()[1].decode()
+            while (await reader.readline()) not in (b"\r\n", b""):
+                pass
+            if path == "/slow":
+                # never answer, wait for the scraper to give up
+                await reader.read()
+                break
+            if path == "/gzip":
+                body = gzip.compress(payload.replace(b"7", b"8"))
+                head = b"HTTP/1.1 200 OK\r\nContent-Encoding: gzip\r\nTransfer-Encoding: chunked\r\n\r\n"
+                middle = len(body) // 2
+                writer.write(head)
+                for chunk in (body[:middle], body[middle:]):
+                    writer.write(b"%x\r\n%s\r\n" % (len(chunk), chunk))
+                writer.write(b"0\r\nX-Checksum: none\r\n\r\n")
+            elif path == "/metrics":
+                writer.write(
+                    b"HTTP/1.1 200 OK\r\nContent-Length: %d\r\n\r\n%s"
+                    % (len(payload), payload)
+                )
+            else:
+                writer.write(b"HTTP/1.1 404 Not Found\r\nContent-Length: 0\r\n\r\n")
+            await writer.drain()
+        writer.close()
+
+    async def run():
+        servers = [
+            await asyncio.start_server(exporter, "127.0.0.1", 0) for _ in range(4)
+        ]
+        addresses = [
+            f"127.0.0.1:{server.sockets[0].getsockname()[1]}" for server in servers
+        ]
+        scraper = MetricsScraper(
+            [
+                f"http://{address}/{path}"
+                for address, path in zip(
+                    addresses, ("metrics", "gzip", "missing", "slow")
+                )
+            ],
+            job="exporters",
+            timeout=0.3,
+        )
+        first = await scraper.scrape()
+        second = await scraper.scrape()
+        await scraper.close()
+        for server in servers:
+            server.close()
+            await server.wait_closed()
+        return addresses, first, second
+
+    with caplog.at_level(level="DEBUG"):
+        addresses, first, second = asyncio.run(run())
+
+    # three connections were kept alive and reused, the timed out one was closed
+    assert len(connections) == 5
+    for scraped in (first, second):
+        assert [(i.labels, i.value) for i in scraped.metrics["up"]] == [
+            ({"job": "exporters", "instance": address}, up)
+            for address, up in zip(addresses, (1, 1, 0, 0))
+        ]
+        assert [i.value for i in scraped.metrics["requests_total"]] == ["7", "8"]
+        assert len(scraped.metrics["scrape_duration_seconds"]) == 4
+    assert first.metrics["requests_total"][0].labels == {
+        "exported_instance": "inner",
+        "job": "exporters",
+        "instance": addresses[0],
+    }
+    assert first.metrics["requests_total"].type == "counter"
+    assert (
+        f"Scraping “http://{addresses[2]}/missing” failed: HTTP status 404"
+        in caplog.messages
+    )
+    assert (
+        f"Scraping “http://{addresses[3]}/slow” timed out after 0.3s."
+        in caplog.messages
+    )
+
+
+def test_scraper_responses(caplog, mocker):
+    """check redirects, informational responses, stale series and the concurrency"""
+    payload = b"""# TYPE jobs gauge
+jobs{queue="a"} 1
+jobs{queue="b"} 2
+"""
+    responses = {
+        "/redirect": b"HTTP/1.1 302 Found\r\nLocation: metrics?format=text\r\nContent-Length: 0\r\n\r\n",
+        "/loop": b"HTTP/1.1 301 Moved\r\nLocation: /loop\r\nContent-Length: 0\r\n\r\n",
+        "/continue": b"HTTP/1.1 100 Continue\r\n\r\nHTTP/1.1 200 OK\r\nContent-Length: %d\r\n\r\n%s"
+        % (len(payload), payload),
+        "/switch": b"HTTP/1.1 101 Switching Protocols\r\nUpgrade: h2c\r\n\r\n",
+        "/invalid": b"garbage\r\n\r\n",
+        "/unframed": b"HTTP/1.0 200 OK\r\n\r\n" + payload,
+    }
+    state = {"active": 0, "maxActive": 0, "stale": 0}
+
+    async def exporter(reader, writer):
+        while True:
+            requestLine = await reader.readline()
+            if not requestLine:
+                break
+            path = requestLine.split()[1].decode().split("?")[0]
+            while (await reader.readline()) not in (b"\r\n", b""):
+                pass
+            if path == "/drop":
+                break
+            if path == "/wait":
+                state["active"] += 1
+                state["maxActive"] = max(state["maxActive"], state["active"])
+                await asyncio.sleep(0.05)
+                state["active"] -= 1
+            if path == "/stale" and state["stale"] == 2:
+                response = b"HTTP/1.1 500 Error\r\nContent-Length: 0\r\n\r\n"
+            elif path == "/stale":
+                body = b"".join(payload.splitlines(keepends=True)[: 3 - state["stale"]])
+                response = b"HTTP/1.1 200 OK\r\nContent-Length: %d\r\n\r\n%s" % (
+                    len(body),
+                    body,
+                )
+            elif path in ("/metrics", "/wait"):
+                response = b"HTTP/1.1 200 OK\r\nContent-Length: %d\r\n\r\n%s" % (
+                    len(payload),
+                    payload,
+                )
+            else:
+                response = responses[path]
+            writer.write(response)
+            await writer.drain()
+            if path == "/stale":
+                # the connection is kept alive but closed by the server meanwhile
+                state["stale"] += 1
+                break
+            if path in ("/unframed", "/switch", "/invalid"):
+                break
+        writer.close()
+
+    paths = ("redirect", "loop", "continue", "switch", "invalid", "unframed", "drop")
+
+    async def run():
+        servers = [await asyncio.start_server(exporter, "127.0.0.1", 0) for _ in paths]
+        addresses = [
+            f"127.0.0.1:{server.sockets[0].getsockname()[1]}" for server in servers
+        ]
+        scraper = MetricsScraper(
+            [f"http://{address}/{path}" for address, path in zip(addresses, paths)]
+        )
+        responses_ = await scraper.scrape()
+        address = addresses[0]
+        bounded = MetricsScraper([f"http://{address}/wait"] * 5, concurrency=2)
+        await bounded.scrape()
+        await bounded.close()
+        stale = MetricsScraper([f"http://{address}/stale"], job="stale")
+        collection = MetricsCollection()
+        scrapes = []
+        for _ in range(3):
+            await stale.scrape(collection)
+            scrapes.append([i.labels["queue"] for i in collection.metrics["jobs"]])
+        # closing a connection can fail if the server reset it meanwhile
+        writer = mocker.Mock(wait_closed=mocker.AsyncMock(side_effect=OSError))
+        scraper._connections[("host", 80, False)] = [(None, writer)]
+        await scraper.close()
+        writer.close.assert_called_once()
+        for server in servers:
+            server.close()
+            await server.wait_closed()
+        return addresses, responses_, scrapes
+
+    with caplog.at_level(level="DEBUG"):
+        addresses, scraped, scrapes = asyncio.run(run())
+
+    up = {i.labels["instance"]: i.value for i in scraped.metrics["up"]}
+    assert [up[address] for address in addresses] == [1, 0, 1, 0, 0, 1, 0]
+    assert len(scraped.metrics["jobs"]) == 6
+    for address, path, error in (
+        (addresses[1], "loop", "more than 10 redirects"),
+        (addresses[3], "switch", "unexpected switch of the protocol"),
+        (addresses[4], "invalid", "invalid status line b'garbage\\r\\n'"),
+        (addresses[6], "drop", "connection closed by the server"),
+    ):
+        assert f"Scraping “http://{address}/{path}” failed: {error}" in caplog.messages
+    # the requests of the bounded scraper waited for each other
+    assert state["maxActive"] == 2
+    # series the target stopped exposing and of the failed target are removed, the
+    # later scrapes retried on a new connection after the server closed the last one
+    assert scrapes == [["a", "b"], ["a"], []]
+    assert state["stale"] == 3
+
+
+def test_load_histogram_samples():
+    """check samples of loaded histograms and summaries being kept by their metric"""
+    loadString = """# HELP latency_seconds request latency
+# TYPE latency_seconds histogram
+latency_seconds_bucket{le="0.1"} 1
+latency_seconds_bucket{le="+Inf"} 3
+latency_seconds_sum 2.5
+latency_seconds_count 3
+
+# HELP rpc_seconds rpc latency
+# TYPE rpc_seconds summary
+rpc_seconds{quantile="0.5"} 0.2
+rpc_seconds_sum 1.5
+rpc_seconds_count 4
+
+# HELP queue_count queue length
+# TYPE queue_count gauge
+queue_count 3
+"""
+    mc = MetricsCollection()
+    mc.load(loadString)
+    assert list(mc.metrics) == ["latency_seconds", "rpc_seconds", "queue_count"]
+    assert [i.suffix for i in mc.metrics["latency_seconds"]] == [
+        "_bucket",
+        "_bucket",
+        "_sum",
+        "_count",
+    ]
+    assert [i.suffix for i in mc.metrics["rpc_seconds"]] == ["", "_sum", "_count"]
+    assert str(mc) == loadString
+
+    # samples of a histogram of the collection, untyped samples and the former layout
+    mc.load('latency_seconds_bucket{le="1"} 2\nrequests_count 5\n')
+    assert len(mc.metrics["latency_seconds"]) == 5
+    assert mc.metrics["latency_seconds"][4].labels == {"le": "1"}
+    assert mc.metrics["requests_count"].type is None
+    separate = MetricsCollection()
+    separate.load(loadString, groupSamples=False)
+    assert len(separate.metrics["latency_seconds"]) == 0
+    assert len(separate.metrics["latency_seconds_bucket"]) == 2
+    assert separate.metrics["rpc_seconds_sum"][0].value == "1.5"
+
+
+def test_load_histogram_samples_relabeled(caplog):
+    """check relabeled histogram samples and buckets with invalid bounds"""
+    loadString = """# TYPE latency_seconds histogram
+latency_seconds_bucket{le="0.5"} 1
+latency_seconds_bucket{le="fast"} 2
+latency_seconds_bucket{le="+Inf"} 3
+latency_seconds_count 3
+"""
+    relabeler = MetricsRelabeler(
+        [
+            {
+                "source_labels": ["__name__"],
+                "regex": "latency_(.*)",
+                "target_label": "__name__",
+                "replacement": "api_latency_$1",
+            }
+        ]
+    )
+    mc = MetricsCollection()
+    mc.load(loadString, relabeler=relabeler)
+    assert list(mc.metrics) == ["api_latency_seconds"]
+    metric = mc.metrics["api_latency_seconds"]
+    assert metric.type == "histogram"
+    assert [i.suffix for i in metric] == ["_bucket"] * 3 + ["_count"]
+
+    with caplog.at_level(level="DEBUG"):
+        quantiles = mc.histogramQuantile(0.5, "api_latency_seconds")
+    assert (
+        "Ignoring bucket of “api_latency_seconds” with invalid bound “fast”."
+        in caplog.messages
+    )
+    assert quantiles.metrics["api_latency_seconds_quantile"][0].value == 0.5
+
+
+@pytest.mark.parametrize(
+    "q, expected",
+    [
+        (0.5, {"api": 0.5, "db": 3.5}),
+        (0.95, {"api": 0.95, "db": 4.85}),
+        (0, {"api": 0, "db": 0}),
+        (1, {"api": 1, "db": 5}),
+        (1.5, {"api": math.inf, "db": math.inf}),
+        (-1, {"api": -math.inf, "db": -math.inf}),
+    ],
+)
+def test_histogram_quantile(q, expected):
+    """check quantile estimation from histogram buckets"""
+    mc = MetricsCollection()
+    mc.ensureMetric("latency_seconds", helpText="latency", metricType="histogram")
+    for job, instance, buckets in (
+        ("api", "a", {"+Inf": 2, "0.5": 1, "1": 2, "2": 2}),
+        ("api", "b", {"+Inf": 2, "0.5": 1, "1": 2, "2": 2}),
+        ("db", "c", {"+Inf": 5, "0.5": 0, "2": 0, "5": 5}),
+    ):
+        for le, count in buckets.items():
+            labels = {"job": job, "instance": instance, "le": le}
+            mc.addMetric("latency_seconds", str(count), labels, suffix="_bucket")
+
+    byJob = mc.histogramQuantile(q, "latency_seconds", by=["job"])
+    assert {
+        i.labels["job"]: i.value for i in byJob.metrics["latency_seconds_quantile"]
+    } == pytest.approx(expected)
+    assert byJob.metrics["latency_seconds_quantile"][0].labels["quantile"] == (
+        MetricsCollection.formatValue(q)
+    )
+
+    bySeries = mc.histogramQuantile([q, q], "latency_seconds")
+    assert [
+        i.labels["instance"] for i in bySeries.metrics["latency_seconds_quantile"]
+    ] == ["a", "b", "c"]
+
+
+def test_histogram_quantile_edge_cases(caplog):
+    """check quantiles of missing, empty or incomplete histograms"""
+    mc = MetricsCollection()
+    with caplog.at_level(level="DEBUG"):
+        assert (
+            len(mc.histogramQuantile(0.5, "missing").metrics["missing_quantile"]) == 0
+        )
+    assert "Histogram “missing” does not exist." in caplog.messages
+    assert math.isnan(MetricsCollection.bucketQuantile(0.5, [1, math.inf], [0, 0]))
+    assert math.isnan(MetricsCollection.bucketQuantile(0.5, [1, 2], [1, 2]))
+    assert math.isnan(MetricsCollection.bucketQuantile(math.nan, [1, math.inf], [1, 2]))
+    assert MetricsCollection.bucketQuantile(0.9, [1, math.inf], [1, 2]) == 1
+    assert MetricsCollection.bucketQuantile(0.1, [-1, math.inf], [1, 2]) == -1
+
+    mc.observe("latency_seconds", buckets=[1, 2]).observe(1.5)
+    quantile = mc.histogramQuantile(0.5, "latency_seconds")
+    assert str(quantile).endswith('latency_seconds_quantile{quantile="0.5"} 1.5\n')
+
+
+def test_recording_rules(mocker):
+    """check derived metrics being updated incrementally along the dependency graph"""
+    mc = MetricsCollection()
+    mc.addMetric("errors_total", 1, {"job": "api", "pod": "a"}, "errors", "counter")
+    mc.addMetric(
+        "requests_total", 10, {"job": "api", "pod": "a"}, "requests", "counter"
+    )
+    mc.addMetric("requests_total", "30", {"job": "api", "pod": "b"})
+    mc.addMetric("requests_total", 5, {"job": "db", "pod": "c"})
+
+    mc.addRecordingRule(
+        SumRecordingRule("job:requests:sum", "requests_total", by=["job"])
+    )
+    mc.addRecordingRule(SumRecordingRule("job:errors:sum", "errors_total", by=["job"]))
+    ratio = mc.addRecordingRule(
+        RatioRecordingRule(
+            "job:error_ratio", "job:errors:sum", "job:requests:sum", "error ratio"
+        )
+    )
+
+    def derived(name):
+        return {i.labels.get("job"): i.value for i in mc.metrics[name]}
+
+    assert derived("job:requests:sum") == {"api": 40, "db": 5}
+    assert derived("job:error_ratio") == {"api": 0.025}
+
+    evaluate = mocker.spy(ratio, "evaluate")
+    mc.incMetric("errors_total", 3, {"job": "api", "pod": "a"})
+    mc.addMetric("errors_total", 0, {"job": "db", "pod": "c"})
+    mc.addMetric("requests_total", 35, {"job": "api", "pod": "b"})
+    assert derived("job:error_ratio") == {"api": 4 / 45, "db": 0.0}
+    mc.removeMetric("requests_total", {"job": "db", "pod": "c"})
+    assert derived("job:requests:sum") == {"api": 45}
+    assert derived("job:error_ratio") == {"api": 4 / 45}
+    assert evaluate.call_count == 0
+
+    mc.removeMetrics("errors_total")
+    assert len(mc.metrics["job:errors:sum"]) == 0
+    assert len(mc.metrics["job:error_ratio"]) == 0
+
+    assert mc.removeRecordingRule("job:error_ratio")
+    assert "job:error_ratio" not in mc.metrics
+    assert not mc.removeRecordingRule("job:error_ratio")
+
+
+def test_recording_rules_graph():
+    """check cycles being refused and opaque rules being evaluated on demand"""
+    mc = MetricsCollection()
+    mc.addMetric("temperature_celsius", 20, {"room": "a"}, "temperature", "gauge")
+    mc.addRecordingRule(SumRecordingRule("total_celsius", "temperature_celsius"))
+    calls = []
+
+    def fahrenheit(metric):
+        calls.append(metric.name)
+        return [(i.labels, i.value * 9 / 5 + 32) for i in metric]
+
+    mc.addRecordingRule(
+        RecordingRule("temperature_fahrenheit", ["temperature_celsius"], fahrenheit)
+    )
+    with pytest.raises(ValueError):
+        mc.addRecordingRule(SumRecordingRule("temperature_celsius", "total_celsius"))
+    with pytest.raises(ValueError):
+        mc.addRecordingRule(SumRecordingRule("loop", "loop"))
+    with pytest.raises(ValueError):
+        mc.addRecordingRule(SumRecordingRule("total_celsius", "temperature_celsius"))
+
+    mc.addMetric("temperature_celsius", 25, {"room": "b"})
+    mc.addMetric("temperature_celsius", 30, {"room": "b"})
+    assert calls == ["temperature_celsius"]
+    assert 'temperature_fahrenheit{room="b"} 86.0' in str(mc)
+    assert calls == ["temperature_celsius"] * 2
+    str(mc)
+    assert calls == ["temperature_celsius"] * 2
+    assert [i.value for i in mc.metrics["total_celsius"]] == [50]
+
+
+def test_recording_rules_inputs(caplog):
+    """check suffixed and non-numeric inputs, divisions by zero and replaced inputs"""
+    mc = MetricsCollection()
+    mc.ensureMetric("errors", metricType="summary")
+    mc.ensureMetric("requests", metricType="summary")
+    mc.addRecordingRule(SumRecordingRule("errors:sum", "errors", by=["job"]))
+    mc.addRecordingRule(RatioRecordingRule("error_ratio", "errors", "requests"))
+    manual = mc.addRecordingRule(RecordingRule("manual", ["errors"]))
+    for job, errors, requests in (("a", 0, 0), ("b", 2, 0), ("c", "nan", 0)):
+        mc.addMetric("errors", errors, {"job": job})
+        mc.addMetric("requests", requests, {"job": job})
+    # suffixed samples do not take part in sums and ratios
+    mc.addMetric("errors", 7, {"job": "a"}, suffix="_count")
+    mc.addMetric("requests", 9, {"job": "a"}, suffix="_count")
+
+    def derived(name):
+        return {i.labels["job"]: i.value for i in mc.metrics[name]}
+
+    ratios = derived("error_ratio")
+    assert math.isnan(ratios["a"]) and math.isnan(ratios["c"])
+    assert ratios["b"] == math.inf
+    assert math.isnan(derived("errors:sum")["c"])
+
+    with caplog.at_level(level="DEBUG"):
+        mc.addMetric("errors", "many", {"job": "b"})
+        mc.addMetric("errors", 3, {"job": "d"})
+    assert "Recording rules ignore non-numeric value “many”." in caplog.messages
+    assert mc.metrics["errors"].getInstance({"job": "b"}).value == "many"
+    assert "b" not in derived("errors:sum")
+    assert "b" not in derived("error_ratio")
+    mc.evaluateRecordingRules()
+    assert sorted(derived("errors:sum")) == ["a", "c", "d"]
+    assert sorted(derived("error_ratio")) == ["a", "c"]
+    assert not manual.dirty and len(mc.metrics["manual"]) == 0
+
+    # renamed and merged inputs are replaced as a whole
+    mc.renameMetrics("requests", "calls")
+    assert len(mc.metrics["error_ratio"]) == 0
+    mc.addMetric("requests", 4, {"job": "d"}, metricType="summary")
+    mc.mergeMetrics("requests", "calls")
+    assert derived("error_ratio") == {"a": ratios["a"], "c": ratios["c"], "d": 0.75}
+    assert mc.renameMetrics("errors", "failures")
+    assert len(mc.metrics["errors:sum"]) == 0
+    mc.mergeMetrics("errors", "failures")
+    assert sorted(derived("errors:sum")) == ["a", "c", "d"]
+
+
+def test_views():
+    """check views renaming and relabeling a collection while rendering"""
+    mc = MetricsCollection()
+    mc.addMetric(
+        "requests_total", 3, {"region": "us", "code": "200"}, "requests", "counter"
+    )
+    mc.addMetric("requests_total", 1, {"code": "500"})
+    mc.addMetric("temperature", 20, helpText="temperature")
+
+    view = mc.view("tenant_", {"region": "eu"}, labelMap={"code": "status"})
+    expected = """# HELP tenant_requests_total requests
+# TYPE tenant_requests_total counter
+tenant_requests_total{exported_region="us",status="200",region="eu"} 3
+tenant_requests_total{status="500",region="eu"} 1
+
+# HELP tenant_temperature temperature
+tenant_temperature{region="eu"} 20
+"""
+    assert str(view) == expected
+    assert view.render(include="temp") == expected.split("\n\n")[1]
+
+    mc.addMetric("temperature", 21)
+    assert 'tenant_temperature{region="eu"} 21' in str(view)
+    assert [i.labels for i in mc.metrics["requests_total"]] == [
+        {"region": "us", "code": "200"},
+        {"code": "500"},
+    ]
+    assert str(mc.view()) == str(mc)
+
+    relabeled = mc.view(
+        relabeler=MetricsRelabeler(
+            [{"action": "drop", "source_labels": ["code"], "regex": "5.."}]
+        )
+    )
+    assert 'code="500"' not in str(relabeled)
+    assert 'requests_total{region="us",code="200"} 3' in str(relabeled)
+
+
+def test_views_keep_names(caplog):
+    """check relabel rules of views not renaming samples away from their family"""
+    mc = MetricsCollection()
+    mc.addMetric("requests_total", 3, {"job": "api"}, "requests", "counter")
+    with pytest.raises(ValueError):
+        mc.view(
+            relabeler=MetricsRelabeler(
+                [{"target_label": "__name__", "replacement": "calls_total"}]
+            )
+        )
+    view = mc.view(
+        relabeler=MetricsRelabeler(
+            [{"action": "labelmap", "regex": "job", "replacement": "__name__"}]
+        )
+    )
+    with caplog.at_level(level="DEBUG"):
+        rendered = str(view)
+    assert rendered == str(mc)
+    assert (
+        "Relabeling renamed “requests_total” to “api” in a view, keeping the name."
+        in caplog.messages
+    )
+
+
+def test_aggregating_merge(caplog):
+    """check merging worker collections adding up counters, histograms and summaries"""
+    fleet = MetricsCollection()
+    for worker, latencies in enumerate(([0.05, 0.5], [0.2, 2, 3])):
+        mc = MetricsCollection()
+        mc.addMetric(
+            "jobs_total", str(len(latencies)), helpText="jobs", metricType="counter"
+        )
+        mc.addMetric("queue", worker, helpText="queue length", metricType="gauge")
+        observations = mc.observe(
+            "latency_seconds", buckets=[0.1, 1], helpText="latency"
+        )
+        rpc = mc.observe("rpc_seconds", metricType="summary", helpText="rpc")
+        mc.addMetric("rpc_seconds", 0.1, {"quantile": "0.5"})
+        for latency in latencies:
+            observations.observe(latency)
+            rpc.observe(latency)
+        with caplog.at_level(level="DEBUG"):
+            fleet.mergeCollection(mc, aggregate=True)
+
+    assert [i.value for i in fleet.metrics["jobs_total"]] == [5]
+    assert [i.value for i in fleet.metrics["queue"]] == [1]
+    assert [i.value for i in fleet.metrics["latency_seconds"]] == pytest.approx(
+        [1, 3, 5, 5.75, 5]
+    )
+    # the quantile of the first worker is taken over, the one of the second skipped
+    assert [(i.suffix, i.value) for i in fleet.metrics["rpc_seconds"]] == [
+        ("_sum", pytest.approx(5.75)),
+        ("_count", 5),
+        ("", 0.1),
+    ]
+    assert (
+        "Skipped 1 quantiles of summary “rpc_seconds”, they cannot be aggregated."
+        in caplog.messages
+    )
+
+    fleet.addMetric("jobs_previous_total", 2, metricType="counter")
+    fleet.mergeMetrics("jobs_total", "jobs_previous_total", aggregate=True)
+    assert [i.value for i in fleet.metrics["jobs_total"]] == [7]
+
+    # samples of the same series are summed up before merging, rules see the result
+    fleet.addMetric("jobs_total", "7")
+    fleet.addRecordingRule(SumRecordingRule("jobs:sum", "jobs_total"))
+    fleet._mergeInstances("jobs_total", [({}, "", 7), ({}, "", "7")], aggregate=True)
+    assert [i.value for i in fleet.metrics["jobs_total"]] == [21]
+    assert [i.value for i in fleet.metrics["jobs:sum"]] == [21]
+
+
+def test_sketches():
+    """check distinct count estimation and heavy hitters"""
+    hll = HyperLogLog(precision=10)
+    for i in range(20000):
+        hll.add(f"pod-{i % 5000}")
+    assert len(hll) == pytest.approx(5000, rel=0.1)
+    # the hash is not salted per process, so estimates are reproducible
+    assert len(hll) == 4946
+    small = HyperLogLog(precision=4)
+    for value in (b"x", "x", 1, "1"):
+        small.add(value)
+    assert len(small) == 2
+    assert len(HyperLogLog()) == 0
+    with pytest.raises(ValueError):
+        HyperLogLog(precision=20)
+
+    sketch = SpaceSaving(capacity=8)
+    for value in ["a"] * 50 + ["b"] * 30 + ["c"] * 20 + [str(i) for i in range(100)]:
+        sketch.add(value)
+    # values more frequent than 1 / capacity of all are never evicted
+    assert sketch.top(2) == [("a", 50, 0), ("b", 30, 0)]
+    assert len(sketch.top()) == 8
+
+    sketch = SpaceSaving(capacity=3)
+    for value in "aaaaabbbc":
+        sketch.add(value)
+    sketch.add("d")
+    sketch.add("e")
+    # “c” and then “d” were the least frequent ones, their counts are inherited
+    assert sketch.top() == [("a", 5, 0), ("b", 3, 0), ("e", 3, 2)]
+    for _ in range(20):
+        sketch.add("b")
+    sketch.add("f", 4)
+    assert sketch.top() == [("b", 23, 0), ("f", 7, 3), ("a", 5, 0)]
+    assert len(sketch._heap) == sketch.capacity
+
+
+def test_cardinality_report(tmp_path):
+    """check cardinality analysis of collections and exposition files"""
+    mc = MetricsCollection()
+    for i in range(300):
+        mc.addMetric(
+            "requests_total",
+            1,
+            {"code": str(200 + i % 3), "pod": f"pod-{i}"},
+            "requests",
+            "counter",
+        )
+    mc.observe("latency_seconds", {"path": "/"}, buckets=[1], helpText="latency")
+    mc.addMetric("up", 1, helpText="up")
+    path = tmp_path / "metrics.prom"
+    path.write_text(str(mc))
+
+    for source in ("collection", "file"):
+        analysis = MetricsCardinality(topValues=2)
+        if source == "collection":
+            analysis.addCollection(mc)
+        else:
+            analysis.addFile(str(path))
+        report = analysis.report()
+        assert [(m["name"], m["series"]) for m in report] == [
+            ("requests_total", 300),
+            ("latency_seconds", 4),
+            ("up", 1),
+        ]
+        labels = report[0]["labels"]
+        assert [label["name"] for label in labels] == ["pod", "code"]
+        assert labels[0]["distinct"] == pytest.approx(300, rel=0.05)
+        assert labels[1]["distinct"] == 3
+        assert [(value, count) for value, count, _ in labels[1]["top"]] == [
+            ("200", 100),
+            ("201", 100),
+        ]
+        assert report[2]["labels"] == []
+
+    # label values are unescaped
+    path.write_text('info{path="C:\\\\tmp",quote="say \\"hi\\"",text="a\\nb"} 1\n')
+    analysis = MetricsCardinality()
+    analysis.addFile(str(path))
+    assert [label["top"][0][0] for label in analysis.report()[0]["labels"]] == [
+        "C:\\tmp",
+        'say "hi"',
+        "a\nb",
+    ]
+
+
+def test_instrumentation(caplog):
+    """check the collection exposing its own costs"""
+    mc = MetricsCollection()
+    mc.enableInstrumentation()
+    mc.load(metrics_string)
+    # sizes are counted in bytes, not characters
+    mc.addMetric("temperature", 21, helpText="temperature in °C", metricType="gauge")
+    with caplog.at_level(level="DEBUG"):
+        mc.addMetric("invalid-name", 1)
+    mc.renderGzip()
+    mc.renderGzip()
+    mc.renderShard(0, 2)
+    mc.renderShard(0, 2)
+    output = str(mc)
+
+    instrumentation = MetricsCollection(typedValues=True)
+    instrumentation.load(output[output.index("# HELP metrics_collection_families") :])
+
+    def value(name, **labels):
+        return (
+            instrumentation.metrics[f"metrics_collection_{name}"]
+            .getInstance(labels)
+            .value
+        )
+
+    assert value("families") == len(mc.metrics)
+    assert value("series") == sum(len(m) for m in mc.metrics.values())
+    assert set(
+        i.labels["phase"]
+        for i in instrumentation.metrics["metrics_collection_load_seconds_total"]
+    ) == {"types", "helps", "families", "instances", "comments"}
+    # the second compressed and sharded renderings were answered by the caches
+    assert value("renders_total") == 2
+    compressed = mc.renderGzip()
+    shard = mc.renderShard(0, 2)
+    assert value("render_bytes_total") == len(gzip.decompress(compressed)) + len(
+        shard.encode()
+    )
+    assert value("last_render_bytes") == len(shard.encode())
+    assert (
+        value("render_gzip_bytes_total")
+        == value("last_render_gzip_bytes")
+        == len(compressed)
+    )
+    assert value("cache_requests_total", cache="shard", result="hit") == 1
+    assert value("validation_failures_total", kind="metric_name") >= 1
+    assert value("cache_requests_total", cache="gzip", result="hit") == 1
+    assert value("cache_hit_ratio", cache="gzip") == 0.5
+
+    mc.disableInstrumentation()
+    assert "metrics_collection_" not in str(mc)
+
+
+def test_churn_tracking():
+    """check series created and removed between renderings"""
+    mc = MetricsCollection()
+    mc.addMetric("requests", 1, {"path": "/"}, "requests", "counter")
+    mc.addMetric("requests", 1, {"path": "/old"})
+    churn = mc.enableChurnTracking(topValues=3)
+    mc.addMetric("requests", 2, {"path": "/"})
+    for i in range(4):
+        mc.addMetric("requests", 1, {"path": "/", "session": f"s{i}"})
+    mc.removeMetric("requests", {"path": "/old"})
+    mc.addMetric("sessions", 4, helpText="sessions", metricType="gauge")
+
+    def values(output):
+        result = MetricsCollection(typedValues=True)
+        result.load(output[output.index("# HELP metrics_collection_series") :])
+        return result
+
+    first = values(str(mc))
+    assert (
+        first.metrics["metrics_collection_series_created_total"]
+        .getInstance({"metric": "requests"})
+        .value
+        == 6
+    )
+    assert (
+        first.metrics["metrics_collection_series_created"]
+        .getInstance({"metric": "requests"})
+        .value
+        == 4
+    )
+    assert (
+        first.metrics["metrics_collection_series_removed"]
+        .getInstance({"metric": "requests"})
+        .value
+        == 1
+    )
+    assert (
+        first.metrics["metrics_collection_series_created"]
+        .getInstance({"metric": "sessions"})
+        .value
+        == 1
+    )
+    top = first.metrics["metrics_collection_churn_label_values"]
+    assert len(top) == 3
+    assert top.getInstance({"metric": "requests", "label": "path", "value": "/"})
+
+    # churn is reset by rendering
+    second = values(str(mc))
+    assert all(
+        i.value == 0 for i in second.metrics["metrics_collection_series_created"]
+    )
+    assert churn.labelValues.capacity == 24
+
+    # cached renderings are reused until another rendering ends their interval
+    mc.addMetric("requests", 1, {"path": "/new"})
+
+    def created(output):
+        return (
+            values(output)
+            .metrics["metrics_collection_series_created"]
+            .getInstance({"metric": "requests"})
+            .value
+        )
+
+    compressed = mc.renderGzip()
+    assert created(gzip.decompress(compressed).decode()) == 1
+    assert mc.renderGzip() is compressed
+    assert created(mc.renderShard(0, 1)) == 0
+    assert mc.renderShard(0, 1) is mc.renderShard(0, 1)
+    assert created(gzip.decompress(mc.renderGzip()).decode()) == 0
+
+    mc.disableChurnTracking()
+    assert "metrics_collection_" not in str(mc)
+    assert mc.metrics["requests"].churn is None
+
+
+def test_meter():
+    """check moving rates of a meter decaying lazily per tick"""
+    mc = MetricsCollection()
+    meter = mc.meter("requests_per_second", {"path": "/"}, "request rate")
+    assert mc.meter("requests_per_second", {"path": "/"}) is meter
+    assert [i.labels["window"] for i in mc.metrics["requests_per_second"]] == [
+        "1m",
+        "5m",
+        "15m",
+    ]
+    # ticks are aligned to the monotonic clock
+    start = meter.lastTick * Meter.tickInterval
+    for _ in range(50):
+        meter.mark()
+    # no full tick passed yet
+    assert meter.tick(start + Meter.tickInterval / 2) == [0.0, 0.0, 0.0]
+    assert meter.uncounted == 50
+
+    # the first tick initializes all rates
+    meter.sync(start + Meter.tickInterval)
+    assert [i.value for i in mc.metrics["requests_per_second"]] == [10.0] * 3
+
+    # idle for a minute: the 1 minute rate decays by 1/e
+    rates = meter.tick(start + Meter.tickInterval + 60)
+    assert rates[0] == pytest.approx(10 / math.e)
+    assert rates[1] == pytest.approx(10 * math.exp(-60 / 300))
+    assert rates[2] == pytest.approx(10 * math.exp(-60 / 900))
+
+    # events counted over several ticks are spread evenly
+    meter.mark(120)
+    rates = meter.tick(start + Meter.tickInterval + 120)
+    assert rates[0] == pytest.approx(10 / math.e**2 + 2 * (1 - 1 / math.e))
+    assert meter.count == 170
+
+    output = str(mc)
+    assert "# TYPE requests_per_second gauge" in output
+    assert 'requests_per_second{path="/",window="1m"}' in output
+
+
+def test_meter_on_counter(caplog):
+    """meters are only meant for gauges"""
+    mc = MetricsCollection()
+    mc.ensureMetric("some_total", metricType="counter")
+    with caplog.at_level(level="DEBUG"):
+        assert mc.meter("some_total") is None
+        assert mc.meter("some_rate", {"window": "1h"}) is None
+
+    errors = [rec.message for rec in caplog.records if rec.levelno == logging.ERROR]
+    assert (
+        "Meters are only supported for “gauge” metrics, but “some_total” is “counter”."
+        in errors
+    )
+    assert (
+        "The label “window” is reserved for the rates of meters of “some_rate”."
+        in errors
+    )
+    assert len(mc.metrics["some_total"]) == len(mc.metrics["some_rate"]) == 0
+
+
+def test_meter_lifecycle(mocker):
+    """check meters being detached by removal and cached renderings following ticks"""
+    clock = mocker.patch("macwinnie_pyhelpers.Metrics.time.monotonic")
+    clock.return_value = 1000 * Meter.tickInterval
+    mc = MetricsCollection(threadSafe=True)
+    meter = mc.meter("jobs_per_second", {"queue": "a"})
+    metric = mc.metrics["jobs_per_second"]
+
+    class CreatedMeanwhile(dict):
+        """misses the first lookup, like one done before another thread finished"""
+
+        missed = False
+
+        def get(self, key, default=None):
+            if not self.missed:
+                self.missed = True
+                return default
+            return super().get(key, default)
+
+    metric.meters = CreatedMeanwhile(metric.meters)
+    assert mc.meter("jobs_per_second", {"queue": "a"}) is meter
+
+    meter.mark(10)
+    compressed = mc.renderGzip()
+    assert mc.renderGzip() is compressed
+    # the version follows the ticks of the meters, so the cache is refreshed
+    clock.return_value += Meter.tickInterval
+    assert (
+        'jobs_per_second{queue="a",window="1m"} 2.0'
+        in gzip.decompress(mc.renderGzip()).decode()
+    )
+
+    # removing a rate of the meter detaches it
+    assert mc.removeMetric("jobs_per_second", {"queue": "a"}) is False
+    assert mc.meter("jobs_per_second", {"queue": "a"}) is meter
+    mc.removeMetric("jobs_per_second", {"queue": "a", "window": "5m"})
+    renewed = mc.meter("jobs_per_second", {"queue": "a"})
+    assert renewed is not meter
+    assert len(metric) == 3